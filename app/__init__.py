@@ -1,5 +1,4 @@
 import logging
-import logging.config
 import os
 
 from flask import Flask
@@ -7,27 +6,71 @@ from flask import Flask
 from config import config_by_env, LOG_DIR
 
 
-def create_app():
+def create_app(test_config=None):
     app = Flask(__name__)
 
     app.config.from_object(config_by_env)
+    if test_config:
+        app.config.update(test_config)
 
-    from app.db_model import db, ma
+    from app.cache import rate_cache
+    from app.http_cache import http_cache
+    from app.idempotency import response_cache
+    from app.db_model import db
     from app.api1 import bp1
+    from app.metrics import metrics, request_metrics
+    from app.query_budget import query_guard
+    from app.replicas import replica_router
     app.register_blueprint(bp1)
+    app.register_blueprint(metrics)
 
     from app.errors import handlers
 
+    from app.commands import idempotency_cli, init_db_command, ledger_cli, money_cli, rollup_cli, trades_cli
+    from app.logs import configure_logging
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(rollup_cli)
+    app.cli.add_command(ledger_cli)
+    app.cli.add_command(idempotency_cli)
+    app.cli.add_command(trades_cli)
+    app.cli.add_command(money_cli)
+
     os.makedirs(LOG_DIR, exist_ok=True)
-    logging.config.dictConfig(app.config['LOG_CONFIG'])
+    configure_logging(app.config['LOG_CONFIG'], app.config['LOG_QUEUE'])
     app.logger = logging.getLogger('backend.app')
 
     db.init_app(app)
-    ma.init_app(app)
+    rate_cache.init_app(app)
+    response_cache.init_app(app)
+    http_cache.init_app(app)
+    request_metrics.init_app(app)
+    query_guard.init_app(app)
+    replica_router.init_app(app)
 
-    with app.app_context():
-        db.create_all()
+    if app.config['AUTO_CREATE_SCHEMA']:
+        with app.app_context():
+            db.create_all(bind=None)  # replicas get the schema by the replication
 
     app.logger.info('Crypto trader service startup')
 
     return app
+
+
+def init_worker(app):
+    """
+    Prepare the application built in the gunicorn master for the forked worker process, the worker must not
+    share the DB connections and the log queue of the master
+
+    :param app: Flask application preloaded by the master
+    """
+    from app.db_model import db
+    from app.logs import start_listener
+    from app.metrics import pool_metrics, request_metrics
+
+    with app.app_context():
+        for bind in [None] + list(app.config.get('SQLALCHEMY_BINDS') or ()):
+            db.get_engine(app, bind=bind).dispose()
+    if app.config['LOG_QUEUE']:
+        start_listener()
+    pool_metrics.reset()
+    request_metrics.clear()
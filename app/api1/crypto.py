@@ -1,10 +1,23 @@
+import base64
+import collections
+import csv
+import io
+import itertools
 from datetime import datetime
 
-from flask import request
-from flask_restx import Namespace, fields, Resource
+from flask import request, Response, stream_with_context
+from flask_restx import Namespace, fields, inputs, Resource
+from sqlalchemy import func
+from sqlalchemy.orm import aliased
 
 import app.db_model as db
+from app import archive, money, serializers
+from app.cache import rate_cache
 from app.errors.exceptions import BackendError
+from app.http_cache import conditional, http_cache
+from app.idempotency import HEADER as IDEMPOTENCY_HEADER, idempotent
+from app.query_budget import query_budget
+from app.replicas import PRIMARY_HEADER, read_only
 
 
 class CryptoDto:
@@ -24,7 +37,10 @@ class CryptoDto:
         'id': fields.Integer(description='ID of the currency'),
         'shortcut': fields.String(description='Currency shortcut(3 letter)'),
         'name': fields.String(description='Currency name'),
-        'actual_rate': fields.Float(description='Actual rate for the given exchange currency')
+        'actual_rate': fields.Float(description='Actual rate for the given exchange currency'),
+        'scale': fields.Integer(min=0, max=money.MAX_SCALE,
+                                description=f'Decimal places of the amounts, only of the new currency '
+                                            f'(default {money.DEFAULT_SCALE})')
     })
     currencies = exchanges_api.model('currencies updates', {
         'method': fields.String(required=True, enum=['POST', 'PUT', 'DELETE'],
@@ -36,6 +52,10 @@ class CryptoDto:
         'currency_in': fields.String(required=True, description='Currency in the trade'),
         'currency_out': fields.String(required=True, description='Currency out the trade'),
     })
+    rates = exchanges_api.model('rates tick', {
+        'ids': fields.List(fields.Integer, required=True, description='Crypto-currency ids within any exchanges'),
+        'rates': fields.List(fields.Float, required=True, description='Actual rates in the order of the ids')
+    })
 
     history_api = Namespace('history', description='History of all trades within all exchanges')
     history = history_api.model('trades history', {
@@ -48,6 +68,13 @@ _exchange_post = CryptoDto.exchange_post
 _exchange_deposit = CryptoDto.exchange_deposit
 _currencies = CryptoDto.currencies
 _trade = CryptoDto.trade
+_rates = CryptoDto.rates
+_idempotency_key = {IDEMPOTENCY_HEADER: {'in': 'header', 'type': 'string',
+                                         'description': 'Unique key of the request, its retry returns the stored '
+                                                        'response without running it again'}}
+_read_primary = {PRIMARY_HEADER: {'in': 'header', 'type': 'string', 'enum': ['1'],
+                                  'description': 'Read from the primary DB instead of a replica, '
+                                                 'e.g. right after a write of the client'}}
 history_api = CryptoDto.history_api
 
 _history_parser = history_api.parser()
@@ -59,51 +86,676 @@ _history_parser.add_argument('date_from', type=str, location='args',
                              help='Trades from date format: "%Y-%m-%dT%H:%M:%SZ"')
 _history_parser.add_argument('date_to', type=str, location='args',
                              help='Trades to date format: "%Y-%m-%dT%H:%M:%SZ"')
+_history_parser.add_argument('cursor', type=str, location='args',
+                             help='Cursor of the next page, empty value for the first page')
+_history_parser.add_argument('archived', type=inputs.boolean, location='args', default=False,
+                             help='Include the archived months, they are read from the archive files')
+
+_export_parser = _history_parser.copy()
+for _argument in ('offset', 'limit', 'cursor', 'archived'):
+    _export_parser.remove_argument(_argument)
+_export_parser.add_argument('format', type=str, location='args', choices=('ndjson', 'csv'), default='ndjson',
+                            help='Export format')
+
+_analytics_parser = _export_parser.copy()
+_analytics_parser.remove_argument('format')
+_analytics_parser.add_argument('bucket', type=str, location='args', choices=tuple(db.BUCKET_FORMATS), default='hour',
+                               help='Time bucket of the aggregation')
+_analytics_parser.add_argument('source', type=str, location='args', choices=('trades', 'rollups'), default='trades',
+                               help='Aggregate trades or hourly rollups, rollups filter dates by the hour start')
+
+_list_parser = exchanges_api.parser()
+_list_parser.add_argument('limit', type=int, location='args', help='Page size')
+_list_parser.add_argument('cursor', type=int, location='args', help='Next cursor of the previous page')
+_list_parser.add_argument('fields', type=str, location='args', help='Comma separated fields of the items')
+
+_exchanges_parser = _list_parser.copy()
+_exchanges_parser.add_argument('include', type=str, location='args', choices=('currency',),
+                               help='Include the currencies of the exchanges')
+
+HISTORY_PAGE_SIZE = 100
+LIST_PAGE_SIZE = 100
+MAX_LIST_PAGE_SIZE = 1000
+EXCHANGE_KEYS = ('id', 'name')
+EXPORT_BATCH_SIZE = 1000
+EXPORT_CSV_HEADER = ('id', 'date', 'exchange_id', 'amount', 'currency_in', 'currency_out')
+CURSOR_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def parse_fields(value, keys):
+    """
+    Return the keys of the fields argument, all keys without it
+
+    :param str value: comma separated keys
+    :param tuple keys: allowed keys
+    """
+    if not value:
+        return keys
+
+    fields = tuple(field.strip() for field in value.split(','))
+    unknown = [field for field in fields if field not in keys]
+    if unknown:
+        raise BackendError(f'Unknown fields: {", ".join(unknown)}. Possible fields: {", ".join(keys)}')
+    return fields
+
+
+def list_page(query, id_column, args):
+    """
+    Return (query, limit) of the page after the cursor, the items are ordered by the id
+
+    :param query: query selecting the id as the first column
+    :param id_column: id column of the items
+    :param args: parsed arguments of the list parser
+    """
+    limit = LIST_PAGE_SIZE if args.limit is None else args.limit
+    if not 1 <= limit <= MAX_LIST_PAGE_SIZE:
+        raise BackendError(f'Invalid limit: {limit}. Possible limit: 1 to {MAX_LIST_PAGE_SIZE}')
+    if args.cursor:
+        query = query.filter(id_column > args.cursor)
+    return query.order_by(id_column).limit(limit), limit
+
+
+def list_result(name, rows, fields, limit):
+    """
+    Return serialized page of the projected rows, the next cursor is the id of the last item of the full page
+
+    :param str name: name of the items
+    :param list rows: rows of the list_page query
+    :param tuple fields: keys of the projected columns after the id
+    :param int limit: limit of the list_page
+    """
+    next_cursor = rows[-1][0] if len(rows) == limit else None
+    return {name: [serializers.projected_dict(row, fields, 1) for row in rows], "next_cursor": next_cursor}
+
+
+def exchanges_page(args):
+    """
+    Return (query, fields, limit) of the page of the exchanges
+
+    :param args: parsed arguments of the exchanges parser
+    """
+    fields = parse_fields(args.fields, EXCHANGE_KEYS)
+    columns = {'id': db.Exchange.id, 'name': db.Exchange.name}
+
+    query = db.Exchange.query.with_entities(db.Exchange.id, *(columns[field] for field in fields))
+    query, limit = list_page(query, db.Exchange.id, args)
+    return query, fields, limit
+
+
+def currencies_page(exchange_id, args):
+    """
+    Return (query, fields, limit) of the page of the currencies of the exchange
+
+    :param int exchange_id: Exchange id
+    :param args: parsed arguments of the list parser
+    """
+    fields = parse_fields(args.fields, serializers.CURRENCY_KEYS)
+
+    query = db.Currency.query.with_entities(db.Currency.id, *serializers.currency_columns(fields)) \
+        .filter_by(exchange_id=exchange_id)
+    query, limit = list_page(query, db.Currency.id, args)
+    return query, fields, limit
+
+
+def currencies_result(exchange_id, rows, fields, limit, args):
+    """
+    Return serialized page of the currencies of the exchange
+
+    :param int exchange_id: Exchange id
+    :param list rows: rows of the currencies_page query
+    :param tuple fields: fields of the currencies_page
+    :param int limit: limit of the currencies_page
+    :param args: parsed arguments of the list parser
+    """
+    # every exchange has its exchange currency
+    if not rows and not args.cursor:
+        raise BackendError(f'Exchange with id: {exchange_id} does not exist.')
+    return list_result('currencies', rows, fields, limit)
+
+
+def exchange_currencies(exchange_ids):
+    """
+    Return currency_rows query of the currencies of all exchanges of the page
+
+    :param list exchange_ids: Exchange ids
+    """
+    query = db.Currency.query.filter(db.Currency.exchange_id.in_(exchange_ids)).order_by(db.Currency.id)
+    return serializers.currency_rows(query)
+
+
+def include_currencies(result, rows, currencies):
+    """
+    Add the serialized currencies to the exchanges of the page
+
+    :param dict result: list_result of the exchanges
+    :param list rows: rows of the exchanges_page query
+    :param list currencies: rows of the exchange_currencies query
+    """
+    by_exchange = collections.defaultdict(list)
+    for currency in currencies:
+        by_exchange[currency.exchange_id].append(serializers.currency_dict(currency))
+    for exchange, row in zip(result['exchanges'], rows):
+        exchange['currency'] = by_exchange[row[0]]
+
+
+def encode_cursor(date, trade_id):
+    """
+    Return opaque history cursor pointing after the trade
+
+    :param datetime date: date of the last trade of the page
+    :param int trade_id: id of the last trade of the page
+    """
+    key = f'{date.strftime(CURSOR_DATE_FORMAT)}|{trade_id}'
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Return (date, id) keyset of the history cursor
+
+    :param str cursor: cursor from the encode_cursor
+    """
+    try:
+        date, trade_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.strptime(date, CURSOR_DATE_FORMAT), int(trade_id)
+    except ValueError:
+        raise BackendError(f'Invalid history cursor: {cursor}')
+
+
+def parse_date(value):
+    """
+    Return datetime of the date filter or None without it
+
+    :param str value: date in the format "%Y-%m-%dT%H:%M:%SZ"
+    """
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ') if value else None
+
+
+def history_query(args):
+    """
+    Return trades query filtered by the history arguments and ordered by the (date, id) keyset
+
+    :param args: parsed arguments of the history parser
+    """
+    query = filter_trades(db.Trade.query, db.Trade, db.Trade.date, args)
+    return query.order_by(db.Trade.date, db.Trade.id)
+
+
+def filter_trades(query, model, date_column, args):
+    """
+    Return query of trades or trade rollups filtered by the history arguments
+
+    :param query: query to filter
+    :param model: Trade or TradeRollup class
+    :param date_column: date column of the model
+    :param args: parsed arguments of the history parser
+    """
+    if args.exchange_id:
+        query = query.filter(model.exchange_id == args.exchange_id)
+    if args.date_from:
+        query = query.filter(date_column >= parse_date(args.date_from))
+    if args.date_to:
+        query = query.filter(date_column <= parse_date(args.date_to))
+    if args.search:
+        # each side gets its own subquery, a parameter repeated in the statement is not bound by positional drivers
+        query = query.filter(db.match_currencies(model.currency_in_id, args.search) |
+                             db.match_currencies(model.currency_out_id, args.search))
+
+    return query
+
+
+def history_page(args):
+    """
+    Return (query, limit) of the history page, limit is None for the offset pages without the cursor
+
+    :param args: parsed arguments of the history parser
+    """
+    query = serializers.trade_rows(history_query(args))
+
+    if args.cursor is None:
+        return query.offset(args.offset).limit(args.limit), None
+
+    if args.cursor:
+        date, trade_id = decode_cursor(args.cursor)
+        query = query.filter((db.Trade.date > date) | ((db.Trade.date == date) & (db.Trade.id > trade_id)))
+    limit = args.limit or HISTORY_PAGE_SIZE
+    return query.limit(limit), limit
+
+
+def history_result(rows, limit):
+    """
+    Return serialized history page
+
+    :param list rows: rows of the history_page query
+    :param limit: limit of the history_page
+    """
+    if limit is None:
+        return serializers.dump_trades(rows)
+
+    next_cursor = encode_cursor(rows[-1].date, rows[-1].id) if len(rows) == limit else None
+    return {"trades": serializers.dump_trades(rows), "next_cursor": next_cursor}
+
+
+def export_row(trade):
+    """
+    Return CSV row of the trade
+
+    :param trade: row of the trade_rows query
+    """
+    # amount is in the units of the currency in, like in the other formats
+    return (trade.id, trade.date.isoformat(), trade.exchange_id, money.from_units(trade.amount, trade.in_scale),
+            trade.in_shortcut, trade.out_shortcut)
+
+
+def archived_history(args):
+    """
+    Return serialized history page of the archived trades followed by the trades of the table,
+    the archived months are older than the months kept in the table
+
+    :param args: parsed arguments of the history parser
+    """
+    if args.cursor is None:
+        start = args.offset or 0
+        stop = None if args.limit is None else start + args.limit
+    else:
+        start, stop = 0, args.limit or HISTORY_PAGE_SIZE
+
+    after = decode_cursor(args.cursor) if args.cursor else None
+    trades = archive.archived_trades(args.exchange_id, parse_date(args.date_from), parse_date(args.date_to),
+                                     args.search, after)
+    page, count = [], 0
+    for trade in trades:
+        if stop is not None and count >= stop:
+            break
+        if count >= start:
+            page.append(trade)
+        count += 1
+
+    if stop is None or count < stop:
+        # the rest of the page is read from the table, after the cursor or after the skipped archived trades
+        table_args = type(args)(args)
+        if args.cursor is None:
+            table_args.offset = max(start - count, 0)
+            table_args.limit = None if stop is None else stop - start - len(page)
+        else:
+            table_args.limit = stop - len(page)
+        query, _ = history_page(table_args)
+        page.extend(serializers.dump_trades(query.all()))
+
+    if args.cursor is None:
+        return page
+    next_cursor = None
+    if len(page) == stop:
+        next_cursor = encode_cursor(archive.trade_date(page[-1]), page[-1]['id'])
+    return {"trades": page, "next_cursor": next_cursor}
+
+
+def analytics_query(args):
+    """
+    Return query of trade count and amount sum, min and max by exchange, currency pair and time bucket
+
+    :param args: parsed arguments of the analytics parser
+    """
+    currency_in = aliased(db.Currency)
+    currency_out = aliased(db.Currency)
+
+    if args.source == 'rollups':
+        if args.bucket == 'minute':
+            raise BackendError('Rollups are hourly, use hour or day bucket.')
+        model = db.TradeRollup
+        bucket = db.time_bucket(model.bucket, args.bucket)
+        aggregates = (func.sum(model.count), func.sum(model.volume),
+                      func.min(model.min_amount), func.max(model.max_amount))
+        query = filter_trades(model.query, model, model.bucket, args)
+    else:
+        model = db.Trade
+        bucket = db.time_bucket(model.date, args.bucket)
+        aggregates = (func.count(model.id), func.sum(model.amount), func.min(model.amount), func.max(model.amount))
+        query = filter_trades(model.query, model, model.date, args)
+
+    # amounts are in the units of the currency in, converted by its scale
+    return query.with_entities(model.exchange_id, currency_in.shortcut, currency_out.shortcut, bucket, *aggregates,
+                               currency_in.scale) \
+        .join(currency_in, model.currency_in_id == currency_in.id) \
+        .join(currency_out, model.currency_out_id == currency_out.id) \
+        .group_by(model.exchange_id, currency_in.id, currency_out.id, currency_in.shortcut,
+                  currency_out.shortcut, currency_in.scale, bucket) \
+        .order_by(bucket, model.exchange_id, currency_in.id, currency_out.id)
+
+
+def analytics_result(rows):
+    """
+    Return serialized rows of the analytics_query
+    """
+    return [{"exchange_id": exchange_id, "currency_in": shortcut_in, "currency_out": shortcut_out,
+             "bucket": bucket if isinstance(bucket, str) else bucket.isoformat(), "count": count,
+             "volume": money.from_units(volume, scale), "min_amount": money.from_units(min_amount, scale),
+             "max_amount": money.from_units(max_amount, scale)}
+            for exchange_id, shortcut_in, shortcut_out, bucket, count, volume, min_amount, max_amount, scale in rows]
+
+
+def currency_rate_query(exchange_id, shortcut):
+    """
+    Return query of the (id, actual_rate, scale) row of the exchange currency
+
+    :param int exchange_id: Exchange id
+    :param str shortcut: currency shortcut
+    """
+    return db.Currency.query.with_entities(db.Currency.id, db.Currency.actual_rate, db.Currency.scale) \
+        .filter_by(shortcut=shortcut, exchange_id=exchange_id)
+
+
+def exchange_currency(exchange_id, shortcut):
+    """
+    Return (id, actual_rate, scale) row of the exchange currency from the rate cache or DB
+
+    :param int exchange_id: Exchange id
+    :param str shortcut: currency shortcut
+    :return: row with id, actual_rate and scale or None when the currency does not exist
+    """
+    key = (exchange_id, shortcut)
+    currency = rate_cache.get(key)
+    if currency is None:
+        currency = currency_rate_query(exchange_id, shortcut).first()
+        if currency:
+            rate_cache.set(key, currency)
+
+    return currency
+
+
+def check_shortcut(shortcut, field):
+    """
+    Check that the currency shortcut has 3 alphabetic letters
+
+    :param str shortcut: currency shortcut
+    :param str field: name of the request field used in the error message
+    """
+    if len(shortcut) != 3 or not shortcut.isalpha():
+        raise ValueError(f'Value "{field}"({shortcut}) is not alphabetic or length is not 3.')
+
+
+def parse_exchange(data):
+    """
+    Return validated (name, currency_shortcut, currency_name) of the new exchange
+
+    :param dict data: exchange from the request
+    """
+    name = data.get('name')
+    currency_shortcut = data.get('currency_shortcut').upper()
+    currency_name = data.get('currency_name', None)
+
+    check_shortcut(currency_shortcut, 'currency_shortcut')
+    if not name.isalpha():
+        raise ValueError(f'Value "name"({name}) is not alphabetic.')
+    if currency_name and not currency_name.isalpha():
+        raise ValueError(f'Value "currency_name"({currency_name}) is not alphabetic.')
+
+    return name, currency_shortcut, currency_name
+
+
+def parse_currency_changes(data, exchange_id):
+    """
+    Return validated changes of the exchange crypto-currencies grouped by method,
+    the currency deleted by an earlier item cannot be edited, an edit followed by the delete is dropped by it
+
+    :param list data: currency changes from the request
+    :param int exchange_id: Exchange id
+    :return: list of new currency rows, dict of changed values by currency id and set of deleted currency ids
+    """
+    created = []
+    edited = {}
+    deleted = set()
+    for item in data:
+        method = item.get('method')
+
+        # --------- Create ---------
+        if method == 'POST':
+            name = item["currency"].get('name', None)
+            shortcut = item["currency"].get('shortcut').upper()
+            actual_rate = item["currency"].get('actual_rate')
+            scale = item["currency"].get('scale')
+
+            if not shortcut:
+                raise BackendError('Missing currency shortcut.')
+            check_shortcut(shortcut, 'shortcut')
+            if name and not name.isalpha():
+                raise ValueError(f'Value "name"({name}) is not alphabetic.')
+            if not actual_rate:
+                raise BackendError('Missing currency actual_rate.')
+
+            created.append({"name": name, "shortcut": shortcut, "actual_rate": money.to_rate(actual_rate),
+                            "exchange_id": exchange_id, "crypto": True,
+                            "scale": money.DEFAULT_SCALE if scale is None else scale})
+
+        # --------- Edit ---------
+        elif method == 'PUT':
+            cur_id = item["currency"].get('id')
+            name = item["currency"].get('name', None)
+            shortcut = (item["currency"].get('shortcut') or '').upper()
+            actual_rate = item["currency"].get('actual_rate', None)
+
+            if not cur_id:
+                raise BackendError('Missing currency id for editing.')
+            if item["currency"].get('scale') is not None:
+                # the total and the trades of the currency are kept in the units of its scale
+                raise BackendError('Scale of the existing currency cannot be changed.')
+            if cur_id in deleted:
+                raise BackendError(f'Crypto-currency with id: {cur_id} does not exist.')
+
+            changes = edited.setdefault(cur_id, {})
+            if name:
+                changes['name'] = name
+            if shortcut:
+                changes['shortcut'] = shortcut
+            if actual_rate:
+                changes['actual_rate'] = money.to_rate(actual_rate)
+
+        # --------- Delete ---------
+        elif method == 'DELETE':
+            deleted.add(item["currency"].get('id'))
+
+    return created, edited, deleted
+
+
+def parse_rates(data):
+    """
+    Return fixed point rates by currency id of the rates tick
+
+    :param dict data: payload with the ids and the rates in their order
+    """
+    ids = data.get('ids')
+    rates = data.get('rates')
+
+    if len(ids) != len(rates):
+        raise BackendError(f'Length of ids({len(ids)}) and rates({len(rates)}) is not the same.')
+    if not all(rate > 0 for rate in rates):
+        raise ValueError('Value "rates" must contain only positive rates.')
+    return {currency_id: money.to_rate(rate, 'rates') for currency_id, rate in zip(ids, rates)}
+
+
+def parse_trade(item):
+    """
+    Return validated (amount, shortcut_in, shortcut_out) of the trade
+
+    :param dict item: trade from the request
+    """
+    amount = item.get('amount')
+    shortcut_in = item.get('currency_in').upper()
+    shortcut_out = item.get('currency_out').upper()
+
+    check_shortcut(shortcut_in, 'currency_in')
+    check_shortcut(shortcut_out, 'currency_out')
+
+    if shortcut_in == shortcut_out:
+        raise BackendError('Currency in and out is the same.')
+
+    return amount, shortcut_in, shortcut_out
+
+
+def batch_currencies_query(exchange_id, data):
+    """
+    Return query of the exchange currencies used by the trades, locked for the batch
+
+    :param int exchange_id: Exchange id
+    :param list data: trades from the request
+    """
+    shortcuts = {item.get(key).upper() for item in data for key in ('currency_in', 'currency_out')}
+    # rows are locked in the id order, so concurrent batches cannot deadlock each other
+    return db.Currency.query.with_entities(db.Currency.id, db.Currency.shortcut, db.Currency.actual_rate,
+                                           db.Currency.scale, db.balance().label('total')) \
+        .filter(db.Currency.exchange_id == exchange_id, db.Currency.shortcut.in_(shortcuts)) \
+        .order_by(db.Currency.id).with_for_update()
+
+
+def apply_trade(exchange_id, item, currencies, totals, date):
+    """
+    Validate the trade of the batch and apply it on the currency totals
+
+    :param int exchange_id: Exchange id
+    :param dict item: trade from the request
+    :param dict currencies: currencies of the exchange by shortcut
+    :param dict totals: currency totals by currency id, updated in place
+    :param datetime date: date of the trade
+    :return: Trade row for the bulk insert
+    """
+    amount, shortcut_in, shortcut_out = parse_trade(item)
+
+    currency_in = currencies.get(shortcut_in)
+    currency_out = currencies.get(shortcut_out)
+
+    if not currency_in:
+        raise BackendError(f'Shortcut: {shortcut_in} does not exist for the exchange.')
+    if not currency_out:
+        raise BackendError(f'Shortcut: {shortcut_out} does not exist for the exchange.')
+
+    units = money.to_units(amount, currency_in.scale)
+    total = totals[currency_in.id]
+    if total < units:
+        raise BackendError(f'Not enough currency to trade, actual:{money.from_units(total, currency_in.scale)} '
+                           f'and trade amount: {amount}')
+
+    totals[currency_in.id] -= units
+    totals[currency_out.id] += money.convert(units, currency_in, currency_out)
+
+    return {"exchange_id": exchange_id, "amount": units, "currency_in_id": currency_in.id,
+            "currency_out_id": currency_out.id, "date": date}
+
+
+def apply_trades(exchange_id, data, currencies, date):
+    """
+    Validate the trades of the batch and apply them on the currency totals, every trade succeeds or fails on its own
+
+    :param int exchange_id: Exchange id
+    :param list data: trades from the request
+    :param list currencies: rows of the batch_currencies_query
+    :param datetime date: date of the trades
+    :return: Trade rows for the bulk insert, results of the trades and list of (currency, change of the total)
+    """
+    totals = {currency.id: currency.total for currency in currencies}
+    by_shortcut = {currency.shortcut: currency for currency in currencies}
+
+    trades = []
+    results = []
+    for index, item in enumerate(data):
+        try:
+            trades.append(apply_trade(exchange_id, item, by_shortcut, totals, date))
+        except (BackendError, ValueError) as error:
+            results.append({"index": index, "status": "error", "message": str(error)})
+        else:
+            results.append({"index": index, "status": "success"})
+
+    changes = [(currency, totals[currency.id] - currency.total) for currency in currencies]
+    return trades, results, changes
 
 
 @exchanges_api.route('')
 class CryptoExchange(Resource):
 
+    @exchanges_api.expect(_exchanges_parser, validate=True)
+    @exchanges_api.doc(params=_read_primary)
+    @read_only
+    @query_budget(2)  # exchanges, currencies of the page
+    def get(self):
+        """ Get page of the exchanges, with their currencies by include=currency """
+        args = _exchanges_parser.parse_args()
+        query, fields, limit = exchanges_page(args)
+        rows = query.all()
+        result = list_result('exchanges', rows, fields, limit)
+
+        if args.include == 'currency':
+            # currencies of all exchanges of the page are loaded by one query
+            include_currencies(result, rows, exchange_currencies([row[0] for row in rows]).all() if rows else [])
+
+        return serializers.json_response(result)
+
     @exchanges_api.expect(_exchange_post, validate=True)
+    @query_budget(4)  # name check, 2 inserts, the currency reloaded for the response
     def post(self):
         """ Add new crypto exchange """
-        name = request.json.get('name')
-        currency_shortcut = request.json.get('currency_shortcut').upper()
-        currency_name = request.json.get('currency_name', None)
-
-        if len(currency_shortcut) != 3 or not currency_shortcut.isalpha():
-            raise ValueError(f'Value "currency_shortcut"({currency_shortcut}) is not alphabetic or length is not 3.')
-        if not name.isalpha():
-            raise ValueError(f'Value "name"({name}) is not alphabetic.')
-        if currency_name and not currency_name.isalpha():
-            raise ValueError(f'Value "currency_name"({currency_name}) is not alphabetic.')
+        name, currency_shortcut, currency_name = parse_exchange(request.json)
 
         if not db.Exchange.query.filter_by(name=name).first():
-            currency = db.Currency(name=currency_name, shortcut=currency_shortcut, actual_rate=1, crypto=False)
+            currency = db.Currency(name=currency_name, shortcut=currency_shortcut, actual_rate=money.to_rate(1),
+                                   crypto=False)
             exchange = db.Exchange(name=name, currency=[currency])
             db.add_object(currency)
             db.save_changes(exchange)
 
-            return db.exchange_schema.dump(exchange), 201
+            row = tuple(getattr(currency, field) for field in serializers.CURRENCY_FIELDS)
+            return serializers.exchange_dict((currency.exchange_id, name), [row]), 201
         else:
             raise BackendError(f'Exchange with name: {name} is already exists.')
 
 
+@exchanges_api.route('/rates')
+class ExchangeRates(Resource):
+
+    @exchanges_api.expect(_rates, validate=True)
+    @query_budget(2)  # rates, versions of the exchanges
+    def put(self):
+        """ Update actual rates of crypto-currencies within all exchanges """
+        rates = parse_rates(request.json)
+
+        updated = db.update_rates(rates)
+        db.save_changes()
+        db.bump_version(currency_ids=list(rates))
+        rate_cache.invalidate_currencies(set(rates))
+        http_cache.invalidate()
+
+        return {"updated": updated}, 200
+
+
+@exchanges_api.route('/cache')
+class RateCacheStats(Resource):
+
+    @query_budget(0)
+    def get(self):
+        """ Get counters of the rate cache of the worker """
+        return rate_cache.stats(), 200
+
+
 @exchanges_api.route("/<int:exchange_id>")
 @exchanges_api.param('exchange_id', 'Exchange id')
 class ExchangeDeposit(Resource):
 
     @exchanges_api.expect(_exchange_deposit, validate=True)
+    @exchanges_api.doc(params=_idempotency_key)
+    @idempotent
+    @query_budget(3)
     def post(self, exchange_id):
         """ Deposit to the exchange """
         amount = request.json.get('amount')
-        exchange = db.Exchange.query.get(exchange_id)
+        # the exchange currency is the only not crypto currency of the exchange
+        currency = db.Currency.query.with_entities(db.Currency.id, db.Currency.scale) \
+            .filter_by(exchange_id=exchange_id, crypto=False).first()
 
-        if not exchange:
+        if not currency:
             raise BackendError(f'Exchange with id: {exchange_id} does not exist.')
 
-        exchange.currency[0].total += amount  # first currency is the exchange currency
+        db.deposit(currency.id, money.to_units(amount, currency.scale))
         db.save_changes()
+        db.bump_version(exchange_id)
+        http_cache.invalidate(exchange_id)
 
         return {"status": "success"}, 200
 
@@ -112,7 +764,22 @@ class ExchangeDeposit(Resource):
 @exchanges_api.param('exchange_id', 'Exchange id')
 class ExchangeCurrencies(Resource):
 
+    @exchanges_api.expect(_list_parser, validate=True)
+    @exchanges_api.doc(params=_read_primary, responses={304: 'Not modified since the ETag'})
+    @conditional
+    @read_only
+    @query_budget(1)
+    def get(self, exchange_id):
+        """ Get page of the currencies of the exchange """
+        args = _list_parser.parse_args()
+        query, fields, limit = currencies_page(exchange_id, args)
+
+        return serializers.json_response(currencies_result(exchange_id, query.all(), fields, limit, args))
+
     @exchanges_api.expect([_currencies], validate=True)
+    @exchanges_api.doc(params=_idempotency_key)
+    @idempotent
+    @query_budget(7)  # exchange, delete, edited currencies, their updates, insert, version, response
     def put(self, exchange_id):
         """ Update crypto-currencies within exchange """
         data = request.json
@@ -121,58 +788,38 @@ class ExchangeCurrencies(Resource):
         if not exchange:
             raise BackendError(f'Exchange with id: {exchange_id} does not exist.')
 
-        for item in data:
-            method = item.get('method')
-
-            # --------- Create ---------
-            if method == 'POST':
-                name = item["currency"].get('name', None)
-                shortcut = item["currency"].get('shortcut').upper()
-                actual_rate = item["currency"].get('actual_rate')
-
-                if not shortcut:
-                    raise BackendError('Missing currency shortcut.')
-                elif len(shortcut) != 3 or not shortcut.isalpha():
-                    raise ValueError(f'Value "shortcut"({shortcut}) is not alphabetic or length is not 3.')
-                if name and not name.isalpha():
-                    raise ValueError(f'Value "name"({name}) is not alphabetic.')
-                if not actual_rate:
-                    raise BackendError('Missing currency actual_rate.')
-
-                currency = db.Currency(name=name, shortcut=shortcut, actual_rate=actual_rate, exchange_id=exchange_id,
-                                       crypto=True)
-                db.add_object(currency)
-
-            # --------- Edit ---------
-            elif method == 'PUT':
-                cur_id = item["currency"].get('id')
-                name = item["currency"].get('name', None)
-                shortcut = item["currency"].get('shortcut', None).upper()
-                actual_rate = item["currency"].get('actual_rate', None)
-
-                if not cur_id:
-                    raise BackendError('Missing currency id for editing.')
-
-                currency = db.Currency.query.filter_by(id=cur_id, exchange_id=exchange_id, crypto=True).first()
-                if not currency:
+        created, edited, deleted = parse_currency_changes(data, exchange_id)
+
+        # every method is applied as one set: the edited currencies are checked before the deletes, like by the
+        # item by item order, deletes then free the shortcuts for edits and then for new currencies
+        currencies = {}
+        if edited:
+            currencies = db.Currency.query.filter(db.Currency.id.in_(list(edited)), db.Currency.crypto.is_(True),
+                                                  db.Currency.exchange_id == exchange_id).all()
+            currencies = {currency.id: currency for currency in currencies}
+            for cur_id in edited:
+                if cur_id not in currencies:
                     raise BackendError(f'Crypto-currency with id: {cur_id} does not exist.')
 
-                if name:
-                    currency.name = name
-                if shortcut:
-                    currency.shortcut = shortcut
-                if actual_rate:
-                    currency.actual_rate = actual_rate
+        if deleted:
+            db.Currency.query.filter(db.Currency.id.in_(deleted), db.Currency.exchange_id == exchange_id) \
+                .delete(synchronize_session=False)
 
-            # --------- Delete ---------
-            elif method == 'DELETE':
-                cur_id = item["currency"].get('id')
-                db.Currency.query.filter_by(id=cur_id, exchange_id=exchange_id).delete()
+        if edited:
+            for cur_id, changes in edited.items():
+                if cur_id not in deleted:
+                    for key, value in changes.items():
+                        setattr(currencies[cur_id], key, value)
+            db.flush_changes()
 
+        db.bulk_insert(db.Currency, created)
         db.save_changes()
-        currencies = db.Currency.query.filter_by(exchange_id=exchange_id).all()
+        db.bump_version(exchange_id)
+        rate_cache.invalidate_exchange(exchange_id)
+        http_cache.invalidate(exchange_id)
+        currencies = serializers.currency_rows(db.Currency.query.filter_by(exchange_id=exchange_id)).all()
 
-        return db.currencies_schema.dump(currencies), 200
+        return serializers.json_response(serializers.dump_currencies(currencies))
 
 
 @exchanges_api.route("/<int:exchange_id>/trades")
@@ -180,70 +827,146 @@ class ExchangeCurrencies(Resource):
 class ExchangeTrade(Resource):
 
     @exchanges_api.expect(_trade, validate=True)
+    @exchanges_api.doc(params=_idempotency_key)
+    @idempotent
+    @query_budget(7)  # 2 currencies on the rate cache miss, withdraw, deposit, rollup, version, insert
     def post(self, exchange_id):
         """ Create trade """
-        amount = request.json.get('amount')
-        shortcut_in = request.json.get('currency_in').upper()
-        shortcut_out = request.json.get('currency_out').upper()
-
-        if len(shortcut_in) != 3 or not shortcut_in.isalpha():
-            raise ValueError(f'Value "currency_in"({shortcut_in}) is not alphabetic or length is not 3.')
-        if len(shortcut_out) != 3 or not shortcut_out.isalpha():
-            raise ValueError(f'Value "currency_out"({shortcut_out}) is not alphabetic or length is not 3.')
+        amount, shortcut_in, shortcut_out = parse_trade(request.json)
 
-        if shortcut_in == shortcut_out:
-            raise BackendError('Currency in and out is the same.')
+        currency_in = exchange_currency(exchange_id, shortcut_in)
+        currency_out = exchange_currency(exchange_id, shortcut_out)
 
-        exchange = db.Exchange.query.get(exchange_id)
-
-        if not exchange:
+        if not (currency_in and currency_out) and not db.Exchange.query.get(exchange_id):
             raise BackendError(f'Exchange with id: {exchange_id} does not exist')
-
-        currency_in = db.Currency.query.filter_by(shortcut=shortcut_in, exchange_id=exchange_id).first()
-        currency_out = db.Currency.query.filter_by(shortcut=shortcut_out, exchange_id=exchange_id).first()
-
         if not currency_in:
             raise BackendError(f'Shortcut: {shortcut_in} does not exist for the exchange.')
         if not currency_out:
             raise BackendError(f'Shortcut: {shortcut_out} does not exist for the exchange.')
 
-        if currency_in.total < amount:
-            raise BackendError(f'Not enough currency to trade, actual:{currency_in.total} and trade amount: {amount}')
+        units = money.to_units(amount, currency_in.scale)
+        if not db.withdraw(currency_in.id, units):
+            total = db.Currency.query.with_entities(db.balance()).filter_by(id=currency_in.id).scalar()
+            if total is None:
+                # the cached currency was deleted meanwhile
+                rate_cache.invalidate_exchange(exchange_id)
+                raise BackendError(f'Shortcut: {shortcut_in} does not exist for the exchange.')
+            raise BackendError(f'Not enough currency to trade, actual:{money.from_units(total, currency_in.scale)} '
+                               f'and trade amount: {amount}')
+        if not db.deposit(currency_out.id, money.convert(units, currency_in, currency_out)):
+            # the cached currency was deleted meanwhile, the withdrawal is rolled back
+            rate_cache.invalidate_exchange(exchange_id)
+            raise BackendError(f'Shortcut: {shortcut_out} does not exist for the exchange.')
 
-        # currency in must convert to exchange currency and than into currency out
-        result_value = amount*currency_in.actual_rate*currency_out.actual_rate
+        trade = {"exchange_id": exchange_id, "amount": units, "currency_in_id": currency_in.id,
+                 "currency_out_id": currency_out.id, "date": datetime.utcnow()}
+        db.update_rollups([trade])
+        db.save_changes(db.Trade(**trade))
+        db.bump_version(exchange_id)
+        http_cache.invalidate(exchange_id)
 
-        currency_in.total -= amount
-        currency_out.total += result_value
+        return {"status": "success"}, 200
 
-        trade = db.Trade(exchange_id=exchange_id, amount=amount, currency_in=currency_in, currency_out=currency_out)
-        db.save_changes(trade)
 
-        return {"status": "success"}, 200
+@exchanges_api.route("/<int:exchange_id>/trades/batch")
+@exchanges_api.param('exchange_id', 'Exchange id')
+class ExchangeTradeBatch(Resource):
+
+    @exchanges_api.expect([_trade], validate=True)
+    @exchanges_api.doc(params=_idempotency_key)
+    @idempotent
+    @query_budget(8)  # exchange, locked currencies, 1 update per traded currency (3 in tests), insert, rollups, version
+    def post(self, exchange_id):
+        """ Create trades in one transaction, every trade succeeds or fails on its own """
+        data = request.json
+        exchange = db.Exchange.query.get(exchange_id)
+
+        if not exchange:
+            raise BackendError(f'Exchange with id: {exchange_id} does not exist')
+
+        currencies = batch_currencies_query(exchange_id, data).all()
+        trades, results, changes = apply_trades(exchange_id, data, currencies, datetime.utcnow())
+
+        for currency, change in changes:
+            if change < 0 and not db.withdraw(currency.id, -change):
+                raise BackendError(f'Not enough currency {currency.shortcut} to trade, balance changed meanwhile.')
+            elif change > 0 and not db.deposit(currency.id, change):
+                rate_cache.invalidate_exchange(exchange_id)
+                raise BackendError(f'Shortcut: {currency.shortcut} does not exist for the exchange.')
+
+        db.bulk_insert(db.Trade, trades)
+        db.update_rollups(trades)
+        db.save_changes()
+        db.bump_version(exchange_id)
+        http_cache.invalidate(exchange_id)
+
+        return {"executed": len(trades), "failed": len(data) - len(trades), "results": results}, 200
 
 
 @history_api.route('')
 class HistoryAPI(Resource):
 
     @history_api.expect(_history_parser, validate=True)
+    @history_api.doc(params=_read_primary, responses={304: 'Not modified since the ETag of the exchange_id filter'})
+    @conditional
+    @read_only
+    @query_budget(1)
     def get(self):
         """ Get all trades within all exchanges """
         args = _history_parser.parse_args()
+        if args.archived:
+            return serializers.json_response(archived_history(args))
+        query, limit = history_page(args)
+
+        return serializers.json_response(history_result(query.all(), limit))
+
+
+@history_api.route('/export')
+class HistoryExport(Resource):
+
+    @history_api.expect(_export_parser, validate=True)
+    @history_api.doc(params=_read_primary)
+    @read_only
+    def get(self):
+        """ Stream all trades matching the history filters as NDJSON or CSV """
+        args = _export_parser.parse_args()
+        # rows are fetched in batches by a server-side cursor and serialized one by one
+        trades = serializers.trade_rows(history_query(args)).yield_per(EXPORT_BATCH_SIZE)
+
+        if args.format == 'csv':
+            response = Response(stream_with_context(self._csv(trades)), mimetype='text/csv')
+        else:
+            response = Response(stream_with_context(self._ndjson(trades)), mimetype='application/x-ndjson')
+        response.headers['Content-Disposition'] = f'attachment; filename=history.{args.format}'
+
+        return response
+
+    @staticmethod
+    def _ndjson(trades):
+        for trade in trades:
+            yield serializers.dumps(serializers.trade_dict(trade)) + b'\n'
+
+    @staticmethod
+    def _csv(trades):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+
+        for row in itertools.chain([EXPORT_CSV_HEADER], map(export_row, trades)):
+            writer.writerow(row)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+
+@history_api.route('/analytics')
+class HistoryAnalytics(Resource):
+
+    @history_api.expect(_analytics_parser, validate=True)
+    @history_api.doc(params=_read_primary)
+    @read_only
+    @query_budget(1)
+    def get(self):
+        """ Get trade count and amount sum, min and max by exchange, currency pair and time bucket """
+        args = _analytics_parser.parse_args()
 
-        query = db.Trade.query
-        if args.exchange_id:
-            query = query.filter_by(exchange_id=args.exchange_id)
-        if args.date_from:
-            date = datetime.strptime(args.date_from, '%Y-%m-%dT%H:%M:%SZ')
-            query = query.filter(db.Trade.date >= date)
-        if args.date_to:
-            date = datetime.strptime(args.date_to, '%Y-%m-%dT%H:%M:%SZ')
-            query = query.filter(db.Trade.date <= date)
-        if args.search:
-            currencies = db.Currency.query.filter(db.Currency.name.like('%' + args.search + '%')).all()
-            currencies = [currency.id for currency in currencies]
-            query = query.filter((db.Trade.currency_in_id.in_(currencies)) | (db.Trade.currency_out_id.in_(currencies)))
-
-        result = query.offset(args.offset).limit(args.limit).all()
-
-        return db.trades_schema.dump(result), 200
+        return serializers.json_response(analytics_result(analytics_query(args)))
@@ -0,0 +1,151 @@
+import gzip
+import os
+from datetime import datetime, timedelta
+
+from flask import current_app as app
+from sqlalchemy import func
+
+import app.db_model as db
+from app import serializers
+from app.query_budget import extend_budget
+
+BATCH_SIZE = 1000  # trades fetched by one round trip of the archival
+DATE_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')  # isoformat with and without the microseconds
+
+
+def archive_path(month):
+    """
+    Return path of the archive file of the trades of the month
+
+    :param datetime.date month: first day of the month
+    """
+    return os.path.join(app.config['TRADE_ARCHIVE_DIR'], f'trade-{month:%Y-%m}.ndjson.gz')
+
+
+def trade_date(trade):
+    """
+    Return date of the archived trade
+
+    :param dict trade: trade serialized like TradeSchema
+    """
+    date = trade['date']
+    return datetime.strptime(date, DATE_FORMATS[0] if '.' in date else DATE_FORMATS[1])
+
+
+def archive_month(month):
+    """
+    Move the trades of the month from the trade table into its gzip NDJSON file, without commit
+
+    The file is complete before the trades are dropped, an interrupted archival writes it again.
+
+    :param datetime.date month: first day of the month
+    :return: number of the archived trades
+    """
+    partition = db.TradePartition.query.get(month) or db.TradePartition(month=month)
+    if partition.archived:
+        raise ValueError(f'Trades of {month:%Y-%m} are already archived in {partition.path}.')
+
+    start, end = db.month_range(month)
+    trades = serializers.trade_rows(db.Trade.query.filter(db.Trade.date >= start, db.Trade.date < end)) \
+        .order_by(db.Trade.date, db.Trade.id).yield_per(BATCH_SIZE)
+    path = archive_path(month)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    rows = 0
+    with gzip.open(path + '.tmp', 'wb') as file:
+        for trade in trades:
+            file.write(serializers.dumps(serializers.trade_dict(trade)) + b'\n')
+            rows += 1
+    os.replace(path + '.tmp', path)
+
+    db.drop_trades(month)
+    partition.archived = datetime.utcnow()
+    partition.path = path
+    partition.rows = rows
+    db.add_object(partition)
+    return rows
+
+
+def archive_trades(keep):
+    """
+    Archive the months of the trades before the recent months, every month is committed on its own
+
+    :param int keep: number of the recent months kept in the trade table, the current month included
+    :return: list of (month, number of the archived trades)
+    """
+    cutoff = db.month_start(datetime.utcnow())
+    for _ in range(keep - 1):
+        cutoff = db.month_start(cutoff - timedelta(days=1))
+    cutoff = db.month_range(cutoff)[0]
+
+    archived = []
+    while True:
+        first = db.db.session.query(func.min(db.Trade.date)).filter(db.Trade.date < cutoff).scalar()
+        if first is None:
+            return archived
+        month = db.month_start(first)
+        archived.append((month, archive_month(month)))
+        db.save_changes()
+        # the cached history reads do not include the archived trades anymore
+        db.bump_version()
+
+
+def read_archive(path):
+    """
+    Yield the trades of the archive file, ordered by the (date, id) keyset
+
+    :param str path: path of the archive file
+    """
+    with gzip.open(path, 'rb') as file:
+        for line in file:
+            yield serializers.loads(line)
+
+
+def archived_trades(exchange_id=None, date_from=None, date_to=None, search=None, after=None):
+    """
+    Yield the archived trades matching the history filters, ordered by the (date, id) keyset
+
+    Only the files of the months within the date filters are read. The search matches the archived currency
+    names and shortcuts like the history query on the database.
+
+    :param int exchange_id: Exchange id
+    :param datetime date_from: the first date
+    :param datetime date_to: the last date
+    :param str search: search query
+    :param tuple after: (date, id) keyset of the history cursor, the trades after it are yielded
+    """
+    extend_budget(1)
+    query = db.TradePartition.query.filter(db.TradePartition.archived.isnot(None))
+    starts = [date for date in (date_from, after[0] if after else None) if date]
+    if starts:
+        query = query.filter(db.TradePartition.month >= db.month_start(max(starts)))
+    if date_to:
+        query = query.filter(db.TradePartition.month <= date_to.date())
+    paths = [partition.path for partition in query.order_by(db.TradePartition.month)]
+
+    matches = _search_matcher(search)
+    for path in paths:
+        for trade in read_archive(path):
+            date = trade_date(trade)
+            if date_to and date > date_to:
+                return
+            if (date_from and date < date_from) or (after and (date, trade['id']) <= after) or \
+                    (exchange_id and trade['exchange'] != exchange_id):
+                continue
+            if matches and not (matches(trade['currency_in']) or matches(trade['currency_out'])):
+                continue
+            yield trade
+
+
+def _search_matcher(search):
+    if not search:
+        return None
+    search = search.lower()
+    # Postgres matches any part of the name or shortcut, the other databases the prefix
+    substring = db.db.engine.dialect.name == 'postgresql'
+
+    def matches(currency):
+        values = [(currency[key] or '').lower() for key in ('name', 'shortcut')] if currency else []
+        return any(search in value if substring else value.startswith(search) for value in values)
+
+    return matches
@@ -0,0 +1,692 @@
+"""
+Async serving mode of the crypto API, the same routes are served by asyncio with an async DB driver.
+
+Requests are validated by the models and the business rules of app.api1.crypto, the queries are built
+by the same ORM code and executed by the databases package (asyncpg on Postgres, aiosqlite on SQLite).
+"""
+import collections
+import csv
+import functools
+import inspect
+import io
+from datetime import datetime
+
+from databases import Database
+from jsonschema import RefResolver
+from sqlalchemy import func, select
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_etags, quote_etag
+
+import app.db_model as db
+from app import create_app, idempotency, money, serializers
+from app.api1 import crypto
+from app.cache import rate_cache
+from app.errors.exceptions import BackendError, ConflictError
+from app.http_cache import http_cache, version_etag
+
+API = '/api/v1/crypto'
+
+# nested models of the payloads are resolved like flask-restx does with the swagger definitions
+_resolver = RefResolver.from_schema({'definitions': {name: model.__schema__
+                                                     for name, model in crypto.exchanges_api.models.items()}})
+
+
+def json_response(obj, status=200):
+    """
+    Return JSON response with the encoded object, formatted like the sync API responses
+
+    :param obj: serializable object
+    :param int status: response status code
+    """
+    return Response(serializers.encode(obj), status_code=status, media_type='application/json')
+
+
+def api_errors(handler):
+    """
+    Return errors of the request handler as message with 400 status code, like the error handlers of the sync API
+    """
+    @functools.wraps(handler)
+    async def wrapper(request):
+        logger = request.app.state.logger
+        try:
+            return await handler(request)
+        except ConflictError as error:
+            logger.warning(error.message)
+            return json_response({"message": error.message}, 409)
+        except BackendError as error:
+            logger.exception(error)
+            return json_response({"message": error.message}, 400)
+        except HTTPException as error:
+            return json_response(getattr(error, 'data', None) or {"message": error.description}, error.code)
+        except Exception as error:
+            logger.exception('Unhandled Exception: %s', error)
+            return json_response({"message": str(error)}, 400)
+
+    return wrapper
+
+
+async def after_commit(request, func, *args):
+    """
+    Call the version bump or the cache invalidation after the commit of the changes of the request, at once
+    without the transaction of the idempotency key, the transaction of the handler is nested into it
+
+    :param request: Starlette request
+    :param func: function invalidating the cache or coroutine function executing the statement
+    """
+    callbacks = getattr(request.state, 'after_commit', None)
+    if callbacks is None:
+        await call(functools.partial(func, *args))
+    else:
+        callbacks.append(functools.partial(func, *args))
+
+
+async def call(callback):
+    """ Call the callback, await the result of the coroutine function """
+    result = callback()
+    if inspect.isawaitable(result):
+        await result
+
+
+def replay(stored, fingerprint):
+    """
+    Return the stored response of the key, like app.idempotency.replay
+
+    :param tuple stored: (fingerprint, status, response) of the key
+    :param str fingerprint: fingerprint of the retried request
+    """
+    status, body = idempotency.stored_response(stored, fingerprint)
+    return Response(body, status_code=status, media_type='application/json',
+                    headers={idempotency.REPLAYED_HEADER: 'true'})
+
+
+def idempotent(handler):
+    """
+    Store the response of the write handler under the Idempotency-Key header like app.idempotency.idempotent,
+    the key is inserted in the transaction of the key and the handler changes are committed with it
+    """
+    @functools.wraps(handler)
+    async def wrapper(request):
+        key = request.headers.get(idempotency.HEADER)
+        if key is None:
+            return await handler(request)
+        idempotency.check_key(key)
+
+        route = f'{request.method} {request.url.path}'
+        fingerprint = idempotency.request_fingerprint(await request.body())
+        stored = idempotency.response_cache.get((key, route))
+        if stored:
+            return replay(stored, fingerprint)
+
+        database = request.app.state.database
+        table = db.IdempotencyKey.__table__
+        where = (table.c.key == key) & (table.c.route == route)
+        stored_key = select([table.c.fingerprint, table.c.status, table.c.response, table.c.created]).where(where)
+        request.state.after_commit = []
+
+        async with database.transaction():
+            record = await database.fetch_one(stored_key)
+            if record and record[3] >= idempotency.expired_before():
+                return replay((record[0], record[1], record[2]), fingerprint)
+
+            if record:
+                # expired key is used again by a new request
+                await database.execute(table.delete().where(where))
+            try:
+                async with database.transaction():
+                    await database.execute(table.insert().values(key=key, route=route, fingerprint=fingerprint,
+                                                                 created=datetime.utcnow()))
+            except Exception:
+                # the concurrent request with the same key committed first, the drivers raise their own errors
+                record = await database.fetch_one(stored_key)
+                if record is None:
+                    raise
+                return replay((record[0], record[1], record[2]), fingerprint)
+
+            response = await handler(request)
+            await database.execute(table.update().where(where).values(status=response.status_code,
+                                                                      response=response.body))
+
+        for callback in request.state.after_commit:
+            await call(callback)
+        idempotency.response_cache.set((key, route), (fingerprint, response.status_code, response.body))
+        return response
+
+    return wrapper
+
+
+async def exchange_version(database, exchange_id):
+    """
+    Return version of the exchange from the cache of app.http_cache or DB, None when the exchange does not exist
+
+    :param database: async database
+    :param int exchange_id: Exchange id
+    """
+    key = http_cache.version_key(exchange_id)
+    version = http_cache.versions.get(key)
+    if version is None:
+        table = db.Exchange.__table__
+        version = await database.fetch_val(select([table.c.version]).where(table.c.id == exchange_id))
+        if version is not None:
+            http_cache.versions.set(key, version)
+    return version
+
+
+def conditional(handler):
+    """
+    Serve GET of the exchange data with the ETag of the exchange version like app.http_cache.conditional
+    """
+    @functools.wraps(handler)
+    async def wrapper(request):
+        exchange_id = request.path_params.get('exchange_id')
+        if exchange_id is None:
+            try:
+                exchange_id = int(request.query_params['exchange_id'])
+            except (KeyError, ValueError):
+                return await handler(request)
+        version = await exchange_version(request.app.state.database, exchange_id)
+        if version is None:
+            return await handler(request)
+
+        etag = version_etag(exchange_id, version)
+        headers = {'ETag': quote_etag(etag), 'Cache-Control': 'no-cache'}  # clients revalidate every poll
+        if etag in parse_etags(request.headers.get('If-None-Match')):
+            return Response(status_code=304, headers=headers)
+
+        key = (f'{request.url.path}?{request.url.query}', exchange_id, version)
+        cached = http_cache.responses.get(key)
+        if cached is None:
+            response = await handler(request)
+            if response.status_code == 200:
+                http_cache.responses.set(key, response.body)
+        else:
+            response = Response(cached, media_type='application/json')
+        response.headers.update(headers)
+        return response
+
+    return wrapper
+
+
+def in_flask_context(request, func, *args):
+    """
+    Return result of the sync function called with the application context of the Flask application,
+    run it in a worker thread by run_in_threadpool
+
+    :param request: Starlette request
+    :param func: sync function
+    """
+    with request.app.state.flask_app.app_context():
+        return func(*args)
+
+
+async def payload(request, model, many=False):
+    """
+    Return JSON payload of the request validated by the flask-restx model
+
+    :param request: Starlette request
+    :param model: flask-restx model of the payload
+    :param bool many: payload is a list of the models
+    """
+    data = await request.json()
+    for item in (data if many and isinstance(data, list) else [data]):
+        model.validate(item, _resolver)
+    return data
+
+
+def parse_args(parser, params):
+    """
+    Return query parameters parsed by the arguments of the flask-restx parser
+
+    :param parser: flask-restx request parser
+    :param params: query parameters of the request
+    """
+    args = parser.result_class()
+    for argument in parser.args:
+        value = params.get(argument.name)
+        if value is not None:
+            try:
+                value = argument.type(value)
+            except (TypeError, ValueError):
+                raise BackendError(f'Value "{argument.name}"({value}) is not valid. {argument.help or ""}')
+            if argument.choices and value not in argument.choices:
+                raise BackendError(f'Value "{argument.name}"({value}) is not a valid choice.')
+        args[argument.name] = argument.default if value is None else value
+
+    return args
+
+
+async def fetch_rows(database, query):
+    """
+    Return rows of the ORM query as named tuples, like the rows of Query.all()
+
+    :param database: async database
+    :param query: ORM query
+    """
+    records = await database.fetch_all(query.statement)
+    if not records:
+        return []
+    row = collections.namedtuple('Row', list(records[0].keys()), rename=True)
+    return [row(*(record[index] for index in range(len(row._fields)))) for record in records]
+
+
+async def iterate_rows(database, query):
+    """
+    Yield rows of the ORM query as named tuples, fetched by a cursor
+
+    :param database: async database
+    :param query: ORM query
+    """
+    row = None
+    async for record in database.iterate(query.statement):
+        if row is None:
+            row = collections.namedtuple('Row', list(record.keys()), rename=True)
+        yield row(*(record[index] for index in range(len(row._fields))))
+
+
+async def insert(database, statement):
+    """
+    Execute INSERT and return id of the new row
+
+    :param database: async database
+    :param statement: INSERT of one row
+    """
+    if database.url.dialect == 'postgresql':
+        return await database.execute(statement.returning(statement.table.c.id))
+    return await database.execute(statement)
+
+
+async def update(database, statement):
+    """
+    Execute UPDATE (or INSERT from SELECT) and return number of the changed rows, within a transaction
+
+    :param database: async database
+    :param statement: UPDATE or INSERT of rows with id column
+    """
+    if database.url.dialect == 'postgresql':
+        return len(await database.fetch_all(statement.returning(statement.table.c.id)))
+    # SQLite reports the changes of the last statement of the connection, the transaction holds the connection
+    await database.execute(statement)
+    return await database.fetch_val('SELECT changes()')
+
+
+async def withdraw(database, currency_id, amount):
+    """
+    Subtract amount from the currency balance, within a transaction
+
+    :param database: async database
+    :param int currency_id: Currency id
+    :param int amount: units to subtract
+    :return: True when the balance was enough
+    """
+    if db.ledger_mode():
+        await database.execute(db.lock_statement(currency_id))
+    return await update(database, db.withdraw_statement(currency_id, amount)) == 1
+
+
+async def deposit(database, currency_id, amount):
+    """
+    Add amount to the currency balance, within a transaction
+
+    :param database: async database
+    :param int currency_id: Currency id
+    :param int amount: units to add
+    :return: True when the currency exists
+    """
+    return await update(database, db.deposit_statement(currency_id, amount)) == 1
+
+
+async def exchange_exists(database, exchange_id):
+    table = db.Exchange.__table__
+    return await database.fetch_val(select([table.c.id]).where(table.c.id == exchange_id)) is not None
+
+
+async def exchange_currency(database, exchange_id, shortcut):
+    """
+    Return (id, actual_rate, scale) row of the exchange currency from the rate cache or DB
+
+    :param database: async database
+    :param int exchange_id: Exchange id
+    :param str shortcut: currency shortcut
+    :return: row with id, actual_rate and scale or None when the currency does not exist
+    """
+    key = (exchange_id, shortcut)
+    currency = rate_cache.get(key)
+    if currency is None:
+        rows = await fetch_rows(database, crypto.currency_rate_query(exchange_id, shortcut).limit(1))
+        currency = rows[0] if rows else None
+        if currency:
+            rate_cache.set(key, currency)
+
+    return currency
+
+
+async def update_rollups(database, trades):
+    """
+    Add trades into the hourly rollups, within the transaction of the trades
+
+    :param database: async database
+    :param list trades: Trade rows
+    """
+    upsert = db.rollup_upsert(database.url.dialect)
+    for rollup in db.aggregate_rollups(trades):
+        await database.execute(upsert.bindparams(**rollup))
+
+
+@api_errors
+async def create_exchange(request):
+    """ Add new crypto exchange """
+    database = request.app.state.database
+    data = await payload(request, crypto._exchange_post)
+    name, currency_shortcut, currency_name = crypto.parse_exchange(data)
+    table = db.Exchange.__table__
+
+    async with database.transaction():
+        if await database.fetch_val(select([table.c.id]).where(table.c.name == name)) is not None:
+            raise BackendError(f'Exchange with name: {name} is already exists.')
+        exchange_id = await insert(database, table.insert().values(name=name, version=0))
+        currency = {"name": currency_name, "shortcut": currency_shortcut, "actual_rate": money.to_rate(1),
+                    "total": 0, "crypto": False, "exchange_id": exchange_id, "scale": money.DEFAULT_SCALE}
+        currency['id'] = await insert(database, db.Currency.__table__.insert().values(**currency))
+
+    row = tuple(currency[field] for field in serializers.CURRENCY_FIELDS)
+    return json_response(serializers.exchange_dict((exchange_id, name), [row]), 201)
+
+
+@api_errors
+async def exchange_list(request):
+    """ Get page of the exchanges, with their currencies by include=currency """
+    database = request.app.state.database
+    args = parse_args(crypto._exchanges_parser, request.query_params)
+    query, fields, limit = crypto.exchanges_page(args)
+
+    rows = await fetch_rows(database, query)
+    result = crypto.list_result('exchanges', rows, fields, limit)
+    if args.include == 'currency':
+        ids = [row[0] for row in rows]
+        crypto.include_currencies(result, rows,
+                                  await fetch_rows(database, crypto.exchange_currencies(ids)) if ids else [])
+    return json_response(result)
+
+
+@api_errors
+async def exchange_rates(request):
+    """ Update actual rates of crypto-currencies within all exchanges """
+    database = request.app.state.database
+    rates = crypto.parse_rates(await payload(request, crypto._rates))
+    table = db.Currency.__table__
+
+    async with database.transaction():
+        updated = await database.fetch_val(select([func.count()]).select_from(table)
+                                           .where(table.c.id.in_(list(rates)) & table.c.crypto.is_(True)))
+        if rates:
+            await database.execute_many(db.RATE_UPDATE, [{'currency_id': currency_id, 'rate': rate}
+                                                         for currency_id, rate in rates.items()])
+    await database.execute(db.bump_version_statement(currency_ids=list(rates)))
+    rate_cache.invalidate_currencies(set(rates))
+    http_cache.invalidate()
+
+    return json_response({"updated": updated})
+
+
+async def rate_cache_stats(request):
+    """ Get counters of the rate cache of the worker """
+    return json_response(rate_cache.stats())
+
+
+@api_errors
+@idempotent
+async def exchange_deposit(request):
+    """ Deposit to the exchange """
+    database = request.app.state.database
+    exchange_id = request.path_params['exchange_id']
+    amount = (await payload(request, crypto._exchange_deposit)).get('amount')
+    # the exchange currency is the only not crypto currency of the exchange
+    query = db.Currency.query.with_entities(db.Currency.id, db.Currency.scale) \
+        .filter_by(exchange_id=exchange_id, crypto=False)
+
+    async with database.transaction():
+        currency = await database.fetch_one(query.statement)
+        if not currency:
+            raise BackendError(f'Exchange with id: {exchange_id} does not exist.')
+        await database.execute(db.deposit_statement(currency[0], money.to_units(amount, currency[1])))
+    await after_commit(request, database.execute, db.bump_version_statement(exchange_id))
+    await after_commit(request, http_cache.invalidate, exchange_id)
+
+    return json_response({"status": "success"})
+
+
+@api_errors
+@conditional
+async def exchange_currency_list(request):
+    """ Get page of the currencies of the exchange """
+    exchange_id = request.path_params['exchange_id']
+    args = parse_args(crypto._list_parser, request.query_params)
+    query, fields, limit = crypto.currencies_page(exchange_id, args)
+
+    rows = await fetch_rows(request.app.state.database, query)
+    return json_response(crypto.currencies_result(exchange_id, rows, fields, limit, args))
+
+
+@api_errors
+@idempotent
+async def exchange_currencies(request):
+    """ Update crypto-currencies within exchange """
+    database = request.app.state.database
+    exchange_id = request.path_params['exchange_id']
+    data = await payload(request, crypto._currencies, many=True)
+    table = db.Currency.__table__
+
+    async with database.transaction():
+        if not await exchange_exists(database, exchange_id):
+            raise BackendError(f'Exchange with id: {exchange_id} does not exist.')
+
+        created, edited, deleted = crypto.parse_currency_changes(data, exchange_id)
+
+        # every method is applied as one set, in the order of the sync API
+        if edited:
+            rows = await database.fetch_all(select([table.c.id]).where(table.c.id.in_(list(edited)) &
+                                                                       table.c.crypto.is_(True) &
+                                                                       (table.c.exchange_id == exchange_id)))
+            existing = {row[0] for row in rows}
+            for cur_id in edited:
+                if cur_id not in existing:
+                    raise BackendError(f'Crypto-currency with id: {cur_id} does not exist.')
+
+        if deleted:
+            await database.execute(table.delete().where(table.c.id.in_(deleted) & (table.c.exchange_id == exchange_id)))
+
+        for cur_id, changes in edited.items():
+            if changes and cur_id not in deleted:
+                await database.execute(table.update().where(table.c.id == cur_id).values(**changes))
+
+        if created:
+            await database.execute_many(table.insert(), [dict(currency, total=0) for currency in created])
+
+        currencies = await fetch_rows(database, serializers.currency_rows(
+            db.Currency.query.filter_by(exchange_id=exchange_id)))
+    await after_commit(request, database.execute, db.bump_version_statement(exchange_id))
+    await after_commit(request, rate_cache.invalidate_exchange, exchange_id)
+    await after_commit(request, http_cache.invalidate, exchange_id)
+
+    return json_response(serializers.dump_currencies(currencies))
+
+
+@api_errors
+@idempotent
+async def exchange_trade(request):
+    """ Create trade """
+    database = request.app.state.database
+    exchange_id = request.path_params['exchange_id']
+    amount, shortcut_in, shortcut_out = crypto.parse_trade(await payload(request, crypto._trade))
+
+    currency_in = await exchange_currency(database, exchange_id, shortcut_in)
+    currency_out = await exchange_currency(database, exchange_id, shortcut_out)
+
+    if not (currency_in and currency_out) and not await exchange_exists(database, exchange_id):
+        raise BackendError(f'Exchange with id: {exchange_id} does not exist')
+    if not currency_in:
+        raise BackendError(f'Shortcut: {shortcut_in} does not exist for the exchange.')
+    if not currency_out:
+        raise BackendError(f'Shortcut: {shortcut_out} does not exist for the exchange.')
+
+    units = money.to_units(amount, currency_in.scale)
+    async with database.transaction():
+        if not await withdraw(database, currency_in.id, units):
+            table = db.Currency.__table__
+            total = await database.fetch_val(select([db.balance(table.c)]).where(table.c.id == currency_in.id))
+            if total is None:
+                # the cached currency was deleted meanwhile
+                rate_cache.invalidate_exchange(exchange_id)
+                raise BackendError(f'Shortcut: {shortcut_in} does not exist for the exchange.')
+            raise BackendError(f'Not enough currency to trade, actual:{money.from_units(total, currency_in.scale)} '
+                               f'and trade amount: {amount}')
+        value = money.convert(units, currency_in, currency_out)
+        if not await deposit(database, currency_out.id, value):
+            # the cached currency was deleted meanwhile, the withdrawal is rolled back
+            rate_cache.invalidate_exchange(exchange_id)
+            raise BackendError(f'Shortcut: {shortcut_out} does not exist for the exchange.')
+
+        trade = {"exchange_id": exchange_id, "amount": units, "currency_in_id": currency_in.id,
+                 "currency_out_id": currency_out.id, "date": datetime.utcnow()}
+        await update_rollups(database, [trade])
+        await database.execute(db.Trade.__table__.insert().values(**trade))
+    await after_commit(request, database.execute, db.bump_version_statement(exchange_id))
+    await after_commit(request, http_cache.invalidate, exchange_id)
+
+    return json_response({"status": "success"})
+
+
+@api_errors
+@idempotent
+async def exchange_trade_batch(request):
+    """ Create trades in one transaction, every trade succeeds or fails on its own """
+    database = request.app.state.database
+    exchange_id = request.path_params['exchange_id']
+    data = await payload(request, crypto._trade, many=True)
+
+    async with database.transaction():
+        if not await exchange_exists(database, exchange_id):
+            raise BackendError(f'Exchange with id: {exchange_id} does not exist')
+
+        currencies = await fetch_rows(database, crypto.batch_currencies_query(exchange_id, data))
+        trades, results, changes = crypto.apply_trades(exchange_id, data, currencies, datetime.utcnow())
+
+        for currency, change in changes:
+            if change < 0 and not await withdraw(database, currency.id, -change):
+                raise BackendError(f'Not enough currency {currency.shortcut} to trade, balance changed meanwhile.')
+            elif change > 0 and not await deposit(database, currency.id, change):
+                rate_cache.invalidate_exchange(exchange_id)
+                raise BackendError(f'Shortcut: {currency.shortcut} does not exist for the exchange.')
+
+        if trades:
+            await database.execute_many(db.Trade.__table__.insert(), trades)
+        await update_rollups(database, trades)
+    await after_commit(request, database.execute, db.bump_version_statement(exchange_id))
+    await after_commit(request, http_cache.invalidate, exchange_id)
+
+    return json_response({"executed": len(trades), "failed": len(data) - len(trades), "results": results})
+
+
+@api_errors
+@conditional
+async def history(request):
+    """ Get all trades within all exchanges """
+    args = parse_args(crypto._history_parser, request.query_params)
+    if args.archived:
+        # the archive files and their catalog are read by the sync code in a worker thread
+        return json_response(await run_in_threadpool(in_flask_context, request, crypto.archived_history, args))
+    query, limit = crypto.history_page(args)
+
+    rows = await fetch_rows(request.app.state.database, query)
+    return json_response(crypto.history_result(rows, limit))
+
+
+def csv_line(row):
+    """
+    Return the row as a CSV line
+
+    :param tuple row: values of the line
+    """
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(row)
+    return buffer.getvalue()
+
+
+async def export_csv(trades):
+    yield csv_line(crypto.EXPORT_CSV_HEADER)
+    async for trade in trades:
+        yield csv_line(crypto.export_row(trade))
+
+
+async def export_ndjson(trades):
+    async for trade in trades:
+        yield serializers.dumps(serializers.trade_dict(trade)) + b'\n'
+
+
+@api_errors
+async def history_export(request):
+    """ Stream all trades matching the history filters as NDJSON or CSV """
+    args = parse_args(crypto._export_parser, request.query_params)
+    # rows are fetched by a cursor and serialized one by one
+    trades = iterate_rows(request.app.state.database, serializers.trade_rows(crypto.history_query(args)))
+
+    headers = {'Content-Disposition': f'attachment; filename=history.{args.format}'}
+    if args.format == 'csv':
+        return StreamingResponse(export_csv(trades), media_type='text/csv', headers=headers)
+    return StreamingResponse(export_ndjson(trades), media_type='application/x-ndjson', headers=headers)
+
+
+@api_errors
+async def history_analytics(request):
+    """ Get trade count and amount sum, min and max by exchange, currency pair and time bucket """
+    args = parse_args(crypto._analytics_parser, request.query_params)
+
+    rows = await fetch_rows(request.app.state.database, crypto.analytics_query(args))
+    return json_response(crypto.analytics_result(rows))
+
+
+routes = [
+    Route('/exchanges', exchange_list, methods=['GET']),
+    Route('/exchanges', create_exchange, methods=['POST']),
+    Route('/exchanges/rates', exchange_rates, methods=['PUT']),
+    Route('/exchanges/cache', rate_cache_stats, methods=['GET']),
+    Route('/exchanges/{exchange_id:int}', exchange_deposit, methods=['POST']),
+    Route('/exchanges/{exchange_id:int}/currencie', exchange_currency_list, methods=['GET']),
+    Route('/exchanges/{exchange_id:int}/currencie', exchange_currencies, methods=['PUT']),
+    Route('/exchanges/{exchange_id:int}/trades', exchange_trade, methods=['POST']),
+    Route('/exchanges/{exchange_id:int}/trades/batch', exchange_trade_batch, methods=['POST']),
+    Route('/history', history, methods=['GET']),
+    Route('/history/export', history_export, methods=['GET']),
+    Route('/history/analytics', history_analytics, methods=['GET']),
+]
+
+
+def create_asgi_app(test_config=None):
+    """
+    Create the ASGI application serving the crypto API routes
+
+    The Flask application provides the configuration, logging and the schema,
+    its application context is kept for the lifetime of the ASGI application to build the ORM queries.
+
+    :param dict test_config: configuration overriding the environment one
+    """
+    flask_app = create_app(test_config)
+    database = Database(flask_app.config['ASYNC_DATABASE_URL'] or flask_app.config['SQLALCHEMY_DATABASE_URI'])
+    context = flask_app.app_context()
+
+    async def startup():
+        context.push()
+        await database.connect()
+
+    async def shutdown():
+        await database.disconnect()
+        context.pop()
+
+    app = Starlette(routes=[Mount(API, routes=routes)], on_startup=[startup], on_shutdown=[shutdown])
+    app.state.database = database
+    app.state.flask_app = flask_app
+    app.state.logger = flask_app.logger
+    return app
@@ -0,0 +1,105 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread safe in-process LRU cache, entries expire after the time to live
+    """
+    def __init__(self, size=1024, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return cached value or None when the key is missing or expired
+
+        :param key: cache key
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        """
+        Cache the value, the least recently used entry is evicted when the cache is full
+
+        :param key: cache key
+        :param value: cached value
+        """
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        """
+        Remove the entry of the key when it is cached
+
+        :param key: cache key
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def discard(self, predicate):
+        """
+        Remove all entries which match the predicate
+
+        :param predicate: function called with the key and the value
+        """
+        with self._lock:
+            for key in [key for key, (_, value) in self._entries.items() if predicate(key, value)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """ Return cache counters """
+        with self._lock:
+            return {"size": len(self._entries), "max_size": self.size, "ttl": self.ttl,
+                    "hits": self.hits, "misses": self.misses}
+
+
+class RateCache(LRUCache):
+    """
+    Cache of (exchange_id, shortcut) -> (currency_id, actual_rate) for the trades
+    """
+    def init_app(self, app):
+        self.size = app.config['RATE_CACHE_SIZE']
+        self.ttl = app.config['RATE_CACHE_TTL']
+        self.clear()
+
+    def invalidate_exchange(self, exchange_id):
+        """
+        Remove all currencies of the exchange from the cache
+
+        :param int exchange_id: Exchange id
+        """
+        self.discard(lambda key, _: key[0] == exchange_id)
+
+    def invalidate_currencies(self, currency_ids):
+        """
+        Remove the currencies from the cache
+
+        :param set currency_ids: Currency ids
+        """
+        self.discard(lambda _, currency: currency.id in currency_ids)
+
+
+rate_cache = RateCache()
@@ -0,0 +1,99 @@
+from datetime import datetime
+
+import click
+from flask import current_app as app
+from flask.cli import AppGroup, with_appcontext
+
+import app.db_model as db
+from app import archive
+
+rollup_cli = AppGroup('rollup', help='Hourly trade statistics rollups')
+ledger_cli = AppGroup('ledger', help='Ledger of the currency balances')
+idempotency_cli = AppGroup('idempotency', help='Stored responses of the Idempotency-Key requests')
+trades_cli = AppGroup('trades', help='Monthly partitions and the archive of the trades')
+money_cli = AppGroup('money', help='Fixed point money columns')
+
+
+@click.command('init-db')
+@with_appcontext
+def init_db_command():
+    """ Create the missing tables and indexes of the primary, run it before starting the workers """
+    db.db.create_all(bind=None)
+    click.echo('Database schema is created.')
+
+
+@rollup_cli.command('rebuild')
+def rebuild_rollups():
+    """ Regenerate rollups from trades, the rollups of the archived months are kept """
+    count = db.rebuild_rollups()
+    db.save_changes()
+    click.echo(f'Rebuilt {count} rollups.')
+
+
+@rollup_cli.command('check')
+def check_rollups():
+    """ Compare rollups with a full recompute from trades, except the archived months """
+    differences = db.check_rollups()
+    for key, rollup, expected in differences:
+        click.echo(f'Rollup {key}: stored {rollup}, recomputed {expected}')
+
+    if differences:
+        raise click.ClickException(f'{len(differences)} rollups differ from trades.')
+    click.echo('Rollups are consistent with trades.')
+
+
+@ledger_cli.command('snapshot')
+def snapshot_ledger():
+    """ Add the pending ledger entries into the currency totals, run it periodically in the ledger mode """
+    snapshot = db.snapshot_ledger()
+    db.save_changes()
+    click.echo(f'Snapshot {snapshot.id} compacted {snapshot.entries} ledger entries.')
+
+
+@idempotency_cli.command('purge')
+def purge_idempotency_keys():
+    """ Delete the keys older than IDEMPOTENCY_TTL, run it periodically (e.g. hourly by cron) """
+    count = db.purge_idempotency_keys(app.config['IDEMPOTENCY_TTL'])
+    db.save_changes()
+    click.echo(f'Purged {count} idempotency keys.')
+
+
+@trades_cli.command('partition')
+@click.option('--ahead', type=click.IntRange(min=0), default=3, show_default=True,
+              help='Months after the current one')
+@click.option('--since', type=click.DateTime(formats=['%Y-%m']), help='The first month, default is the current one')
+def partition_trades(ahead, since):
+    """ Create the partitions of the current and the next months, run it monthly (e.g. by cron) """
+    current = db.month_start(datetime.utcnow())
+    months = [db.month_start(since) if since else current]
+    while months[-1] < current:
+        months.append(db.next_month(months[-1]))
+    for _ in range(ahead):
+        months.append(db.next_month(months[-1]))
+    created = db.create_partitions(months)
+    db.save_changes()
+    click.echo(f'Created {created} trade partitions.')
+
+
+@trades_cli.command('archive')
+@click.option('--keep', type=click.IntRange(min=1), default=lambda: app.config['TRADE_HOT_MONTHS'],
+              help='Recent months kept in the trade table, the current one included [default: TRADE_HOT_MONTHS]')
+def archive_trades(keep):
+    """ Move the trades of the older months into the gzip NDJSON files of TRADE_ARCHIVE_DIR """
+    try:
+        archived = archive.archive_trades(keep)
+    except ValueError as error:
+        raise click.ClickException(str(error))
+    for month, rows in archived:
+        click.echo(f'Archived {rows} trades of {month:%Y-%m}.')
+    click.echo(f'Archived {len(archived)} months.')
+
+
+@money_cli.command('migrate')
+def migrate_money():
+    """ Convert the float balances, rates and amounts of an older database into the fixed point units """
+    if not db.migrate_money():
+        click.echo('Money columns are already in the units.')
+        return
+    db.save_changes()
+    click.echo('Money columns are migrated into the units.')
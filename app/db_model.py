@@ -1,11 +1,73 @@
 import datetime
 
 from flask import current_app as app
-from flask_marshmallow import Marshmallow
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import DDL, bindparam, event, func, inspect, literal, literal_column, or_, orm, select, text, \
+    type_coerce
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
 
-db = SQLAlchemy()
-ma = Marshmallow()
+from app.metrics import TimedQueuePool
+from app.money import DEFAULT_SCALE, RATE_SCALE, Units
+from app.query_budget import extend_budget
+from app.replicas import replica_engine
+
+POOL_SIZE_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout')  # options of the queue pool only
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session reading from the replica chosen for the read only endpoint, flushes always go to the primary
+    """
+    def get_bind(self, mapper=None, clause=None):
+        engine = None if self._flushing else replica_engine()
+        if engine is None:
+            return super().get_bind(mapper, clause)
+        return engine
+
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """
+    SQLAlchemy extension creating the engines with the instrumented queue pool and the sessions routing
+    the reads to the replicas
+    """
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def create_engine(self, sa_url, engine_opts):
+        options = dict(engine_opts)
+        if sa_url.drivername.startswith('sqlite'):
+            # SQLite uses the static pool in memory and the null pool with files, they are not sized
+            for option in POOL_SIZE_OPTIONS:
+                options.pop(option, None)
+        else:
+            options.setdefault('poolclass', TimedQueuePool)
+        return super().create_engine(sa_url, options)
+
+
+db = PooledSQLAlchemy()
+
+BUCKET_FORMATS = {  # SQLite strftime formats of the time buckets, ISO format like datetime.isoformat
+    'minute': '%Y-%m-%dT%H:%M:00',
+    'hour': '%Y-%m-%dT%H:00:00',
+    'day': '%Y-%m-%dT00:00:00'
+}
+ROLLUP_KEY = ('exchange_id', 'currency_in_id', 'currency_out_id', 'bucket')
+ROLLUP_UPSERT = ('INSERT INTO trade_rollup (exchange_id, currency_in_id, currency_out_id, bucket, '
+                 'count, volume, min_amount, max_amount) '
+                 'VALUES (:exchange_id, :currency_in_id, :currency_out_id, :bucket, '
+                 ':count, :volume, :min_amount, :max_amount) '
+                 'ON CONFLICT (exchange_id, currency_in_id, currency_out_id, bucket) DO UPDATE SET '
+                 'count = trade_rollup.count + excluded.count, volume = trade_rollup.volume + excluded.volume, '
+                 'min_amount = {least}(trade_rollup.min_amount, excluded.min_amount), '
+                 'max_amount = {greatest}(trade_rollup.max_amount, excluded.max_amount)')
+RATE_UPDATE = 'UPDATE currency SET actual_rate = :rate WHERE id = :currency_id AND crypto'  # executed for many rates
+# (table, column, decimal places) of the float money columns converted into the units by migrate_money
+MONEY_COLUMNS = (('currency', 'total', DEFAULT_SCALE), ('currency', 'actual_rate', RATE_SCALE),
+                 ('trade', 'amount', DEFAULT_SCALE), ('ledger_entry', 'amount', DEFAULT_SCALE),
+                 ('trade_rollup', 'volume', DEFAULT_SCALE), ('trade_rollup', 'min_amount', DEFAULT_SCALE),
+                 ('trade_rollup', 'max_amount', DEFAULT_SCALE))
+RATES_CHUNK_SIZE = 10000  # (id, rate) pairs in one UPDATE, Postgres allows up to 65535 parameters
 
 
 def todict(obj):
@@ -23,10 +85,12 @@ class Currency(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(30))
     shortcut = db.Column(db.String(3), nullable=False)
-    actual_rate = db.Column(db.Float, nullable=False)
-    total = db.Column(db.Float, nullable=False, default=0)
+    actual_rate = db.Column(Units, nullable=False)  # fixed point of the RATE_SCALE decimal places
+    total = db.Column(Units, nullable=False, default=0)  # minor units of the scale
     exchange_id = db.Column(db.Integer, db.ForeignKey('exchange.id'))
     crypto = db.Column(db.Boolean, nullable=False)
+    # decimal places of the amounts of the currency, its totals, trades and ledger entries are kept in the units
+    scale = db.Column(db.SmallInteger, nullable=False, default=DEFAULT_SCALE, server_default=str(DEFAULT_SCALE))
 
     __table_args__ = (db.UniqueConstraint('shortcut', 'exchange_id', name='unique_shortcut_exchange'),)
 
@@ -35,17 +99,76 @@ class Currency(db.Model):
         return f'<{self.__class__.__name__}({params})>'
 
 
+# currency search matches any part of the name or shortcut with trigram indexes on Postgres,
+# other databases match the prefix with a case insensitive index
+event.listen(Currency.__table__, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+for _column in ('name', 'shortcut'):
+    event.listen(Currency.__table__, 'after_create',
+                 DDL(f'CREATE INDEX ix_currency_{_column}_trgm ON currency USING gin ({_column} gin_trgm_ops)')
+                 .execute_if(dialect='postgresql'))
+    event.listen(Currency.__table__, 'after_create',
+                 DDL(f'CREATE INDEX ix_currency_{_column}_nocase ON currency ({_column} COLLATE NOCASE)')
+                 .execute_if(dialect='sqlite'))
+
+
+class PartitionedPrimaryKey(db.PrimaryKeyConstraint):
+    """
+    Primary key of the table partitioned on Postgres, the partition key is added to it there
+    """
+    def __init__(self, *columns, partition_key, **kwargs):
+        super().__init__(*columns, **kwargs)
+        self.partition_key = partition_key
+
+
+@compiles(PartitionedPrimaryKey, 'postgresql')
+def _partitioned_primary_key(constraint, compiler, **kwargs):
+    # unique constraints of the partitioned table must contain the partition key
+    columns = [compiler.preparer.quote(column.name) for column in constraint.columns]
+    return f'PRIMARY KEY ({", ".join(columns)}, {compiler.preparer.quote(constraint.partition_key)})'
+
+
 class Trade(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
-    amount = db.Column(db.Integer, nullable=False)
+    amount = db.Column(Units, nullable=False)  # minor units of the currency in
     currency_in_id = db.Column(db.Integer, db.ForeignKey('currency.id'), nullable=False)
     currency_out_id = db.Column(db.Integer, db.ForeignKey('currency.id'), nullable=False)
     exchange_id = db.Column(db.Integer, db.ForeignKey('exchange.id'), nullable=False)
-    date = db.Column(db.DateTime(), default=datetime.datetime.utcnow)
+    date = db.Column(db.DateTime(), nullable=False, default=datetime.datetime.utcnow)
     currency_in = db.relationship('Currency', lazy=False, foreign_keys='Trade.currency_in_id')
     currency_out = db.relationship('Currency', lazy=False, foreign_keys='Trade.currency_out_id')
 
+    # history is paginated by the (date, id) keyset, with or without the exchange filter,
+    # the search matches the trades by the ids of the found currencies on either side,
+    # Postgres partitions the table by the month of the date, the date filters read only their partitions
+    __table_args__ = (PartitionedPrimaryKey('id', partition_key='date'),
+                      db.Index('ix_trade_exchange_date_id', 'exchange_id', 'date', 'id'),
+                      db.Index('ix_trade_date_id', 'date', 'id'),
+                      db.Index('ix_trade_currency_in_id', 'currency_in_id', 'id'),
+                      db.Index('ix_trade_currency_out_id', 'currency_out_id', 'id'),
+                      {'postgresql_partition_by': 'RANGE (date)'})
+
+    def __repr__(self):
+        params = ', '.join(f'{k}={v}' for k, v in todict(self).items())
+        return f'<{self.__class__.__name__}({params})>'
+
+
+# trades of the months without their partition, `flask trades partition` creates the partitions ahead
+event.listen(Trade.__table__, 'after_create',
+             DDL('CREATE TABLE trade_default PARTITION OF trade DEFAULT').execute_if(dialect='postgresql'))
+
+
+class TradePartition(db.Model):
+    """
+    Month of the trades, a partition of the trade table on Postgres and a date range of it on the other databases,
+    the archived month is moved from the table into a gzip NDJSON file
+    """
+    month = db.Column(db.Date, primary_key=True)  # first day of the month
+    archived = db.Column(db.DateTime())  # empty while the trades are in the table
+    path = db.Column(db.String(255))
+    rows = db.Column(db.Integer, nullable=False, default=0)
+
     def __repr__(self):
         params = ', '.join(f'{k}={v}' for k, v in todict(self).items())
         return f'<{self.__class__.__name__}({params})>'
@@ -55,7 +178,9 @@ class Exchange(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(30), nullable=False, unique=True)
-    currency = db.relationship('Currency', backref='exchange', lazy=True)
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # bumped after every write
+    # currencies are loaded only explicitly (selectinload), a lazy load per exchange would be an N+1 query
+    currency = db.relationship('Currency', backref='exchange', lazy='raise')
     trades = db.relationship('Trade', backref='exchange', lazy=True)
 
     def __repr__(self):
@@ -63,24 +188,74 @@ class Exchange(db.Model):
         return f'<{self.__class__.__name__}({params})>'
 
 
-class CurrencySchema(ma.ModelSchema):
-    class Meta:
-        model = Currency
+class TradeRollup(db.Model):
+    """
+    Hourly trade statistics by exchange and currency pair, updated within the trade transaction
+    """
+    exchange_id = db.Column(db.Integer, db.ForeignKey('exchange.id'), primary_key=True)
+    currency_in_id = db.Column(db.Integer, db.ForeignKey('currency.id'), primary_key=True)
+    currency_out_id = db.Column(db.Integer, db.ForeignKey('currency.id'), primary_key=True)
+    bucket = db.Column(db.DateTime(), primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+    # amounts in the minor units of the currency in
+    volume = db.Column(Units, nullable=False)
+    min_amount = db.Column(Units, nullable=False)
+    max_amount = db.Column(Units, nullable=False)
+
+    __table_args__ = (db.Index('ix_trade_rollup_bucket', 'bucket'),)
+
+    def __repr__(self):
+        params = ', '.join(f'{k}={v}' for k, v in todict(self).items())
+        return f'<{self.__class__.__name__}({params})>'
+
+
+class LedgerSnapshot(db.Model):
+    """
+    Compaction of the pending ledger entries into the currency totals
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    created = db.Column(db.DateTime(), nullable=False, default=datetime.datetime.utcnow)
+    entries = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        params = ', '.join(f'{k}={v}' for k, v in todict(self).items())
+        return f'<{self.__class__.__name__}({params})>'
 
 
-class ExchangeSchema(ma.Schema):
-    class Meta:
-        fields = ('id', 'name', 'currency')
+class LedgerEntry(db.Model):
+    """
+    Change of the currency balance in the ledger mode, entries are only inserted and marked by the snapshot
+    which adds them into the currency total
+    """
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)
+    currency_id = db.Column(db.Integer, db.ForeignKey('currency.id'), nullable=False)
+    amount = db.Column(Units, nullable=False)  # minor units of the currency
+    created = db.Column(db.DateTime(), nullable=False, default=datetime.datetime.utcnow)
+    snapshot_id = db.Column(db.Integer, db.ForeignKey('ledger_snapshot.id'))  # empty until compacted
 
-    currency = ma.Nested(CurrencySchema, many=True)
+    # balances sum the pending entries only, the history of the currency is read by the date
+    __table_args__ = (db.Index('ix_ledger_entry_pending', 'currency_id', postgresql_where=text('snapshot_id IS NULL'),
+                               sqlite_where=text('snapshot_id IS NULL')),
+                      db.Index('ix_ledger_entry_currency_created', 'currency_id', 'created'))
+
+    def __repr__(self):
+        params = ', '.join(f'{k}={v}' for k, v in todict(self).items())
+        return f'<{self.__class__.__name__}({params})>'
 
 
-class TradeSchema(ma.ModelSchema):
-    class Meta:
-        model = Trade
+class IdempotencyKey(db.Model):
+    """
+    Stored response of the request with the Idempotency-Key header, the retried request gets it back
+    """
+    key = db.Column(db.String(255), primary_key=True)
+    route = db.Column(db.String(255), primary_key=True)  # method and path of the request
+    fingerprint = db.Column(db.String(64), nullable=False)  # SHA-256 of the request body
+    status = db.Column(db.SmallInteger)  # empty while the request is running
+    response = db.Column(db.LargeBinary)
+    created = db.Column(db.DateTime(), nullable=False, default=datetime.datetime.utcnow, index=True)
 
-    currency_in = ma.Nested(CurrencySchema)
-    currency_out = ma.Nested(CurrencySchema)
+    def __repr__(self):
+        return f'<{self.__class__.__name__}(key={self.key}, route={self.route}, status={self.status})>'
 
 
 def save_changes(instance=None):
@@ -89,7 +264,7 @@ def save_changes(instance=None):
 
     :param instance: DB object to push
     """
-    app.logger.info(f'Commit changes and add object({instance}) into DB')
+    app.logger.info('Commit changes and add object(%s) into DB', instance)
     if instance:
         db.session.add(instance)
     try:
@@ -99,15 +274,561 @@ def save_changes(instance=None):
         raise
 
 
+def flush_changes():
+    """
+    Send pending changes of DB session into DB without commit
+    """
+    app.logger.info('Flush changes into DB')
+    db.session.flush()
+
+
 def add_object(instance):
     """
     Add object into DB session
     :param instance: DB object
     """
-    app.logger.info(f'Add object: {instance} into DB session')
+    app.logger.info('Add object: %s into DB session', instance)
     db.session.add(instance)
 
 
+def search_currencies(text):
+    """
+    Return select of ids of currencies which name or shortcut matches the text
+
+    :param str text: search query
+    """
+    text = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    if db.engine.dialect.name == 'postgresql':
+        pattern = f'%{text}%'
+        match = Currency.name.ilike(pattern, escape='\\') | Currency.shortcut.ilike(pattern, escape='\\')
+    else:
+        pattern = f'{text}%'
+        match = Currency.name.like(pattern, escape='\\') | Currency.shortcut.like(pattern, escape='\\')
+
+    return db.session.query(Currency.id).filter(match).subquery()
+
+
+class ArraySubquery(FunctionElement):
+    """
+    ARRAY of the rows of the subquery, Postgres computes it once before the scan of the outer query
+    """
+    name = 'array_subquery'
+
+
+@compiles(ArraySubquery, 'postgresql')
+def _array_subquery(element, compiler, **kwargs):
+    subquery, = element.clauses  # the scalar subquery is rendered in its parentheses
+    return 'ARRAY' + compiler.process(subquery, **kwargs)
+
+
+def match_currencies(column, text):
+    """
+    Return filter of the trade currency column by the currencies matching the text
+
+    Postgres compares the column with the array of the found ids and scans the index of the column by them,
+    IN of the subquery is checked as a hashed subplan on every trade row, OR of two of them is not an index scan.
+
+    :param column: currency id column
+    :param str text: search query
+    """
+    currencies = search_currencies(text)
+    if db.engine.dialect.name == 'postgresql':
+        return column == func.any(ArraySubquery(select([currencies.c.id]).as_scalar()))
+    return column.in_(currencies)
+
+
+def time_bucket(column, bucket):
+    """
+    Return SQL expression truncating the date column to the time bucket
+
+    :param column: date column
+    :param str bucket: minute, hour or day
+    """
+    # the constant is rendered inline, the expression is repeated in GROUP BY with positional parameters
+    if db.engine.dialect.name == 'postgresql':
+        return func.date_trunc(literal_column(f"'{bucket}'"), column)
+    return func.strftime(literal_column(f"'{BUCKET_FORMATS[bucket]}'"), column)
+
+
+def ledger_mode():
+    """ Return True when the balances are kept by the ledger entries """
+    return app.config['LEDGER_MODE']
+
+
+def balance(currency=Currency):
+    """
+    Return SQL expression of the currency balance, the total and in the ledger mode the pending entries
+
+    :param currency: Currency class, its alias or the columns of the currency table
+    """
+    if not ledger_mode():
+        return currency.total
+    entries = LedgerEntry.__table__
+    pending = select([func.coalesce(func.sum(entries.c.amount), 0)]) \
+        .where((entries.c.currency_id == currency.id) & entries.c.snapshot_id.is_(None)).as_scalar()
+    # the sum of Postgres is numeric, read as the units of the total
+    return type_coerce(currency.total + pending, Units)
+
+
+def lock_statement(currency_id):
+    """
+    Return SELECT locking the currency row, SQLite locks the database by the write instead
+
+    :param int currency_id: Currency id
+    """
+    table = Currency.__table__
+    return select([table.c.id]).where(table.c.id == currency_id).with_for_update()
+
+
+def withdraw_statement(currency_id, amount):
+    """
+    Return UPDATE subtracting amount from the currency total, only when the total is enough,
+    in the ledger mode INSERT of the negative entry, only when the balance is enough
+
+    :param int currency_id: Currency id
+    :param int amount: units to subtract
+    """
+    table = Currency.__table__
+    if ledger_mode():
+        rows = select([table.c.id, literal(-amount), literal(datetime.datetime.utcnow())]) \
+            .where((table.c.id == currency_id) & (balance(table.c) >= amount))
+        return LedgerEntry.__table__.insert().from_select(['currency_id', 'amount', 'created'], rows)
+    return table.update().where((table.c.id == currency_id) & (table.c.total >= amount)) \
+        .values(total=table.c.total - amount)
+
+
+def deposit_statement(currency_id, amount):
+    """
+    Return UPDATE adding amount to the currency total, in the ledger mode INSERT of the entry,
+    only when the currency exists
+
+    :param int currency_id: Currency id
+    :param int amount: units to add
+    """
+    table = Currency.__table__
+    if ledger_mode():
+        rows = select([table.c.id, literal(amount), literal(datetime.datetime.utcnow())]) \
+            .where(table.c.id == currency_id)
+        return LedgerEntry.__table__.insert().from_select(['currency_id', 'amount', 'created'], rows)
+    return table.update().where(table.c.id == currency_id).values(total=table.c.total + amount)
+
+
+def bump_version_statement(exchange_id=None, currency_ids=None):
+    """
+    Return UPDATE incrementing the version of the exchange, of the exchanges of the currencies,
+    of all exchanges without the ids
+
+    :param int exchange_id: Exchange id
+    :param list currency_ids: ids of the changed currencies
+    """
+    table = Exchange.__table__
+    statement = table.update().values(version=table.c.version + 1)
+    if currency_ids is not None:
+        currencies = Currency.__table__
+        return statement.where(table.c.id.in_(select([currencies.c.exchange_id])
+                                              .where(currencies.c.id.in_(currency_ids))))
+    return statement if exchange_id is None else statement.where(table.c.id == exchange_id)
+
+
+def bump_version(exchange_id=None, currency_ids=None):
+    """
+    Increment the version of the changed exchange after the commit of the change, in its own short transaction,
+    the concurrent writes of the exchange do not wait for the lock of the exchange row in their transactions
+
+    The cached reads of the exchange are not served after it, a read between the commit and the bump
+    is served by the former version like a read just before the commit.
+
+    :param int exchange_id: Exchange id, all exchanges are changed without it and the currency ids
+    :param list currency_ids: ids of the changed currencies, their exchanges are changed
+    """
+    db.session.execute(bump_version_statement(exchange_id, currency_ids))
+    save_changes()
+
+
+def withdraw(currency_id, amount):
+    """
+    Subtract amount from the currency total in one atomic UPDATE,
+    the total is never lowered under zero
+
+    In the ledger mode the currency row is locked first, concurrent withdrawals read the balance one by one,
+    deposits do not wait for it
+
+    :param int currency_id: Currency id
+    :param int amount: units to subtract
+    :return: True when the total was updated, False when the total is not enough
+    """
+    app.logger.debug('Withdraw %s from currency(%s)', amount, currency_id)
+    if ledger_mode():
+        extend_budget(1)
+        db.session.execute(lock_statement(currency_id))
+    result = db.session.execute(withdraw_statement(currency_id, amount))
+    return result.rowcount == 1
+
+
+def deposit(currency_id, amount):
+    """
+    Add amount to the currency total in one atomic UPDATE, in the ledger mode by the inserted entry
+
+    :param int currency_id: Currency id
+    :param int amount: units to add
+    :return: True when the total was updated, False when the currency does not exist
+    """
+    app.logger.debug('Deposit %s to currency(%s)', amount, currency_id)
+    result = db.session.execute(deposit_statement(currency_id, amount))
+    return result.rowcount == 1
+
+
+def snapshot_ledger():
+    """
+    Add the pending ledger entries into the currency totals and mark them by a new snapshot, without commit
+
+    Entries committed meanwhile stay pending for the next snapshot, the balances do not change by it.
+
+    :return: the snapshot
+    """
+    app.logger.info('Snapshot the ledger entries')
+    snapshot = LedgerSnapshot()
+    db.session.add(snapshot)
+    db.session.flush()
+
+    entries = LedgerEntry.__table__
+    table = Currency.__table__
+    result = db.session.execute(entries.update().where(entries.c.snapshot_id.is_(None))
+                                .values(snapshot_id=snapshot.id))
+    snapshot.entries = result.rowcount
+
+    compacted = select([func.sum(entries.c.amount)]) \
+        .where((entries.c.snapshot_id == snapshot.id) & (entries.c.currency_id == table.c.id)).as_scalar()
+    currencies = select([entries.c.currency_id]).where(entries.c.snapshot_id == snapshot.id)
+    db.session.execute(table.update().where(table.c.id.in_(currencies)).values(total=table.c.total + compacted))
+    return snapshot
+
+
+def update_rates(rates):
+    """
+    Set actual rates of crypto-currencies in one statement
+
+    :param dict rates: fixed point actual rate by currency id
+    :return: number of updated currencies
+    """
+    app.logger.info('Update actual rate of %s currencies', len(rates))
+    if not rates:
+        return 0
+
+    if db.engine.dialect.name == 'postgresql':
+        updated = 0
+        items = list(rates.items())
+        for start in range(0, len(items), RATES_CHUNK_SIZE):
+            chunk = items[start:start + RATES_CHUNK_SIZE]
+            values = ', '.join(f'(:id{i}, :rate{i})' for i in range(len(chunk)))
+            params = {}
+            for i, (currency_id, rate) in enumerate(chunk):
+                params[f'id{i}'] = currency_id
+                params[f'rate{i}'] = rate
+            result = db.session.execute(text(f'UPDATE currency SET actual_rate = tick.rate '
+                                             f'FROM (VALUES {values}) AS tick(id, rate) '
+                                             f'WHERE currency.id = tick.id AND currency.crypto'), params)
+            updated += result.rowcount
+        return updated
+
+    result = db.session.execute(text(RATE_UPDATE), [{'currency_id': currency_id, 'rate': rate}
+                                                    for currency_id, rate in rates.items()])
+    return result.rowcount
+
+
+def aggregate_rollups(trades):
+    """
+    Return the hourly rollups of the trades
+
+    :param list trades: dicts with exchange_id, currency_in_id, currency_out_id, amount and date of the trades
+    :return: list of dicts with the ROLLUP_KEY and the statistics of the trades
+    """
+    rollups = {}
+    for trade in trades:
+        bucket = trade['date'].replace(minute=0, second=0, microsecond=0)
+        key = (trade['exchange_id'], trade['currency_in_id'], trade['currency_out_id'], bucket)
+        rollup = rollups.get(key)
+        if rollup:
+            rollup['count'] += 1
+            rollup['volume'] += trade['amount']
+            rollup['min_amount'] = min(rollup['min_amount'], trade['amount'])
+            rollup['max_amount'] = max(rollup['max_amount'], trade['amount'])
+        else:
+            rollups[key] = dict(zip(ROLLUP_KEY, key), count=1, volume=trade['amount'],
+                                min_amount=trade['amount'], max_amount=trade['amount'])
+
+    return list(rollups.values())
+
+
+def rollup_upsert(dialect_name):
+    """
+    Return statement adding one rollup into the stored one
+
+    :param str dialect_name: name of the DB dialect
+    """
+    if dialect_name == 'postgresql':
+        upsert = ROLLUP_UPSERT.format(least='LEAST', greatest='GREATEST')
+    else:
+        upsert = ROLLUP_UPSERT.format(least='MIN', greatest='MAX')
+    # bucket is bound with the column type, so it is stored in the same format as by the ORM
+    return text(upsert).bindparams(bindparam('bucket', type_=TradeRollup.bucket.type))
+
+
+def update_rollups(trades):
+    """
+    Add trades into the hourly rollups, in the transaction of the trades
+
+    :param list trades: dicts with exchange_id, currency_in_id, currency_out_id, amount and date of the trades
+    """
+    rollups = aggregate_rollups(trades)
+
+    app.logger.debug('Add %s trades into %s rollups', len(trades), len(rollups))
+    if rollups:
+        db.session.execute(rollup_upsert(db.engine.dialect.name), rollups)
+
+
+def archived_ranges():
+    """
+    Return (start, end) datetimes of the archived months, their trades are not in the trade table
+    """
+    return [month_range(partition.month)
+            for partition in TradePartition.query.filter(TradePartition.archived.isnot(None))]
+
+
+def in_ranges(column, ranges):
+    """
+    Return condition of the column within any of the date ranges
+
+    :param column: date column
+    :param list ranges: (start, end) datetimes, the end is excluded
+    """
+    return or_(*((column >= start) & (column < end) for start, end in ranges))
+
+
+def rollup_query(ranges=()):
+    """
+    Return query recomputing the hourly rollups from the trades
+
+    :param list ranges: (start, end) datetimes of the archived months excluded from the recompute
+    """
+    if db.engine.dialect.name == 'postgresql':
+        bucket = func.date_trunc('hour', Trade.date)
+    else:
+        # strftime result is parsed back by the column type, the format is the one of the stored dates
+        bucket = func.strftime('%Y-%m-%d %H:00:00.000000', Trade.date)
+    bucket = type_coerce(bucket, TradeRollup.bucket.type).label('bucket')
+
+    query = db.session.query(Trade.exchange_id, Trade.currency_in_id, Trade.currency_out_id, bucket,
+                             func.count(Trade.id).label('count'), func.sum(Trade.amount).label('volume'),
+                             func.min(Trade.amount).label('min_amount'), func.max(Trade.amount).label('max_amount'))
+    if ranges:
+        query = query.filter(~in_ranges(Trade.date, ranges))
+    return query.group_by(Trade.exchange_id, Trade.currency_in_id, Trade.currency_out_id, bucket)
+
+
+def rebuild_rollups():
+    """
+    Replace the rollups with the ones recomputed from trades, without commit
+
+    The rollups of the archived months are kept, their trades are not in the trade table anymore.
+
+    :return: number of rollups
+    """
+    app.logger.info('Rebuild trade rollups')
+    table = TradeRollup.__table__
+    ranges = archived_ranges()
+    delete = table.delete()
+    if ranges:
+        delete = delete.where(~in_ranges(table.c.bucket, ranges))
+    db.session.execute(delete)
+    query = rollup_query(ranges)
+    db.session.execute(table.insert().from_select([column['name'] for column in query.column_descriptions],
+                                                  query.statement))
+    return TradeRollup.query.count()
+
+
+def check_rollups(tolerance=1e-6):
+    """
+    Compare the rollups with the ones recomputed from trades, except the rollups of the archived months
+
+    :param float tolerance: allowed relative difference of the volumes
+    :return: list of (key, rollup, recomputed) of the rollups which differ
+    """
+    fields = ('count', 'volume', 'min_amount', 'max_amount')
+    ranges = archived_ranges()
+    rollups = TradeRollup.query
+    if ranges:
+        rollups = rollups.filter(~in_ranges(TradeRollup.bucket, ranges))
+    stored = {tuple(getattr(rollup, key) for key in ROLLUP_KEY): tuple(getattr(rollup, field) for field in fields)
+              for rollup in rollups}
+    recomputed = {tuple(row[:4]): tuple(row[4:]) for row in rollup_query(ranges)}
+
+    differences = []
+    for key in stored.keys() | recomputed.keys():
+        rollup, expected = stored.get(key), recomputed.get(key)
+        if rollup is None or expected is None or \
+                any(abs(a - b) > tolerance * max(abs(a), abs(b), 1) for a, b in zip(rollup, expected)):
+            differences.append((key, rollup, expected))
+
+    return differences
+
+
+def month_start(date):
+    """
+    Return the first day of the month of the date
+
+    :param date: date or datetime
+    """
+    return datetime.date(date.year, date.month, 1)
+
+
+def next_month(month):
+    """
+    Return the first day of the month after the month
+
+    :param datetime.date month: first day of the month
+    """
+    return datetime.date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def month_range(month):
+    """
+    Return (start, end) datetimes of the month, the end is the start of the next month
+
+    :param datetime.date month: first day of the month
+    """
+    midnight = datetime.time()
+    return datetime.datetime.combine(month, midnight), datetime.datetime.combine(next_month(month), midnight)
+
+
+def partition_name(month):
+    """
+    Return name of the Postgres partition of the trades of the month
+
+    :param datetime.date month: first day of the month
+    """
+    return f'trade_{month:%Y_%m}'
+
+
+def create_partitions(months):
+    """
+    Create the missing partitions of the trades of the months, without commit
+
+    Postgres gets a partition table per month, see create_partition. The other databases keep all trades
+    in one table, only the months are recorded.
+
+    :param list months: first days of the months
+    :return: number of the new months
+    """
+    existing = {partition.month for partition in TradePartition.query.filter(TradePartition.month.in_(months))}
+    created = [month for month in months if month not in existing]
+    app.logger.info('Create trade partitions of %s months', len(created))
+
+    for month in created:
+        if db.engine.dialect.name == 'postgresql':
+            create_partition(month)
+        db.session.add(TradePartition(month=month))
+    return len(created)
+
+
+def create_partition(month):
+    """
+    Create the Postgres partition of the trades of the month unless it exists, without commit
+
+    The trades of the month already in the default partition are moved into the new one. The default partition
+    is detached for the move and attached again, the trade table stays locked until the commit.
+
+    :param datetime.date month: first day of the month
+    """
+    name = partition_name(month)
+    if db.session.execute(text('SELECT to_regclass(:name)'), {'name': name}).scalar():
+        return
+
+    start, end = month_range(month)
+    bounds = {'start': start, 'end': end}
+    moved = db.session.execute(text('SELECT EXISTS (SELECT 1 FROM trade_default '
+                                    'WHERE date >= :start AND date < :end)'), bounds).scalar()
+    if moved:
+        app.logger.info('Move trades of %s from the default partition into %s', month, name)
+        db.session.execute(text('ALTER TABLE trade DETACH PARTITION trade_default'))
+    db.session.execute(text(f"CREATE TABLE {name} PARTITION OF trade "
+                            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{next_month(month).isoformat()}')"))
+    if moved:
+        columns = ', '.join(column.name for column in Trade.__table__.columns)
+        db.session.execute(text(f'INSERT INTO {name} ({columns}) SELECT {columns} FROM trade_default '
+                                f'WHERE date >= :start AND date < :end'), bounds)
+        db.session.execute(text('DELETE FROM trade_default WHERE date >= :start AND date < :end'), bounds)
+        db.session.execute(text('ALTER TABLE trade ATTACH PARTITION trade_default DEFAULT'))
+
+
+def drop_trades(month):
+    """
+    Remove the trades of the month from the trade table, without commit
+
+    Postgres detaches and drops the partition of the month, the other databases delete the date range.
+
+    :param datetime.date month: first day of the month
+    """
+    app.logger.info('Drop trades of %s', month)
+    if db.engine.dialect.name == 'postgresql':
+        name = partition_name(month)
+        if db.session.execute(text('SELECT to_regclass(:name)'), {'name': name}).scalar():
+            db.session.execute(text(f'ALTER TABLE trade DETACH PARTITION {name}'))
+            db.session.execute(text(f'DROP TABLE {name}'))
+    # trades of the month without the partition are in the default partition
+    table = Trade.__table__
+    start, end = month_range(month)
+    db.session.execute(table.delete().where((table.c.date >= start) & (table.c.date < end)))
+
+
+def migrate_money():
+    """
+    Convert the float money columns of the database created before the fixed point units into the units
+    of the default scale, without commit
+
+    Postgres changes the column types to BIGINT. SQLite keeps the declared types of the columns, the units
+    stored in them are exact up to 2**53.
+
+    :return: False when the database is already migrated
+    """
+    if 'scale' in {column['name'] for column in inspect(db.engine).get_columns('currency')}:
+        return False
+
+    app.logger.info('Migrate money columns into the units')
+    db.session.execute(text(f'ALTER TABLE currency ADD COLUMN scale SMALLINT NOT NULL DEFAULT {DEFAULT_SCALE}'))
+    for table, column, scale in MONEY_COLUMNS:
+        if db.engine.dialect.name == 'postgresql':
+            db.session.execute(text(f'ALTER TABLE {table} ALTER COLUMN {column} TYPE BIGINT '
+                                    f'USING CAST(ROUND(CAST({column} AS NUMERIC) * {10 ** scale}) AS BIGINT)'))
+        else:
+            db.session.execute(text(f'UPDATE {table} SET {column} = CAST(ROUND({column} * {10 ** scale}) AS INTEGER)'))
+    return True
+
+
+def purge_idempotency_keys(ttl):
+    """
+    Delete the idempotency keys older than the time to live, without commit
+
+    :param float ttl: time to live of the keys in seconds
+    :return: number of deleted keys
+    """
+    expired = datetime.datetime.utcnow() - datetime.timedelta(seconds=ttl)
+    app.logger.info('Purge idempotency keys created before %s', expired)
+    return IdempotencyKey.query.filter(IdempotencyKey.created < expired).delete(synchronize_session=False)
+
+
+def bulk_insert(model, mappings):
+    """
+    Add rows into DB session in one bulk insert, without ORM objects
+
+    :param class model: DB class
+    :param list mappings: list of dicts with the column values
+    """
+    app.logger.info('Bulk insert %s rows of %s into DB session', len(mappings), model.__name__)
+    if mappings:
+        db.session.bulk_insert_mappings(model, mappings)
+
+
 # feature
 def get_or_create(model, **kwargs):
     """
@@ -116,7 +837,7 @@ def get_or_create(model, **kwargs):
     :param class model: DB class
     :param kwargs: kwargs
     """
-    app.logger.info(f'Get of create object of {model} with arguments: {kwargs}')
+    app.logger.info('Get of create object of %s with arguments: %s', model, kwargs)
     instance = model.query.filter_by(**kwargs).first()
 
     if instance:
@@ -125,8 +846,3 @@ def get_or_create(model, **kwargs):
         instance = model(**kwargs)
         db.session.add(instance)
         return instance
-
-
-exchange_schema = ExchangeSchema()
-currencies_schema = CurrencySchema(many=True)
-trades_schema = TradeSchema(many=True)
@@ -6,3 +6,9 @@ class BackendError(Exception):
     def __init__(self, message):
         super().__init__(message)
         self.message = message
+
+
+class ConflictError(BackendError):
+    """
+    Conflict exception is raised when the request conflicts with a running request
+    """
@@ -1,10 +1,18 @@
 from flask import current_app as app
 from werkzeug.exceptions import NotFound
 
-from .exceptions import BackendError
+from .exceptions import BackendError, ConflictError
 from app.api1 import api1
 
 
+# the handler of the first matching exception class is used, subclasses go first
+@api1.errorhandler(ConflictError)
+def conflict_exception(error):
+    """ Return error message and 409 status code"""
+    app.logger.warning(error.message)
+    return {"message": error.message}, 409
+
+
 @api1.errorhandler(BackendError)
 def backend_exception(error):
     """ Return error message and 400 status code"""
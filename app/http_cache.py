@@ -0,0 +1,115 @@
+import functools
+
+from flask import Response, g, request
+
+import app.db_model as db
+from app import serializers
+from app.cache import LRUCache
+from app.query_budget import extend_budget
+from app.replicas import replica_router
+
+RESPONSE_TTL = 3600  # seconds, responses of the old versions are evicted by the newer ones before it
+
+
+class HttpCache:
+    """
+    Per worker cache of the exchange versions and of the read responses by the exchange version
+
+    The version is read from DB again after the time to live, writes of the other workers are served
+    after it at the latest, the writes of the worker are served at once. Versions are cached by the DB
+    they are read from, a replica may be behind the primary.
+    """
+    def __init__(self):
+        self.versions = LRUCache()
+        self.responses = LRUCache(ttl=RESPONSE_TTL)
+
+    def init_app(self, app):
+        self.versions.size = self.responses.size = app.config['HTTP_CACHE_SIZE']
+        self.versions.ttl = app.config['HTTP_CACHE_VERSION_TTL']
+        self.versions.clear()
+        self.responses.clear()
+
+    @staticmethod
+    def version_key(exchange_id):
+        """
+        Return key of the cached version of the exchange, by the DB serving the request
+
+        :param int exchange_id: Exchange id
+        """
+        return g.get('replica_bind'), exchange_id
+
+    def version(self, exchange_id):
+        """
+        Return version of the exchange or None when the exchange does not exist
+
+        :param int exchange_id: Exchange id
+        """
+        key = self.version_key(exchange_id)
+        version = self.versions.get(key)
+        if version is None:
+            extend_budget(1)
+            version = db.Exchange.query.with_entities(db.Exchange.version).filter_by(id=exchange_id).scalar()
+            if version is not None:
+                self.versions.set(key, version)
+        return version
+
+    def invalidate(self, exchange_id=None):
+        """
+        Forget the version of the exchange changed by the worker, of all exchanges without the id
+
+        :param int exchange_id: Exchange id
+        """
+        if exchange_id is None:
+            self.versions.clear()
+        else:
+            for bind in [None] + replica_router.binds:
+                self.versions.pop((bind, exchange_id))
+
+
+http_cache = HttpCache()
+
+
+def version_etag(exchange_id, version):
+    """
+    Return ETag of the exchange data of the version
+
+    :param int exchange_id: Exchange id
+    :param int version: version of the exchange
+    """
+    return f'{exchange_id}.{version}'
+
+
+def conditional(func):
+    """
+    Serve GET of the exchange data with the ETag of the exchange version, 304 Not Modified to the matching
+    If-None-Match and the cached response bytes while the version is not changed
+
+    The exchange id is the exchange_id argument of the view or of the query string, other requests are
+    served without the cache.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        exchange_id = kwargs.get('exchange_id', request.args.get('exchange_id', type=int))
+        version = None if exchange_id is None else http_cache.version(exchange_id)
+        if version is None:
+            return func(*args, **kwargs)
+
+        etag = version_etag(exchange_id, version)
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            key = (request.full_path, exchange_id, version)
+            cached = http_cache.responses.get(key)
+            if cached is None:
+                result = func(*args, **kwargs)
+                response = result if isinstance(result, Response) else serializers.json_response(*result)
+                if response.status_code == 200:
+                    http_cache.responses.set(key, response.get_data())
+            else:
+                response = Response(cached, mimetype='application/json')
+
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'  # clients revalidate every poll
+        return response
+
+    return wrapper
@@ -0,0 +1,137 @@
+import functools
+import hashlib
+from datetime import datetime, timedelta
+
+from flask import Response, current_app as app, request
+from sqlalchemy import exc
+
+import app.db_model as db
+from app import serializers
+from app.cache import LRUCache
+from app.errors.exceptions import BackendError, ConflictError
+from app.query_budget import extend_budget
+
+HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 255
+STORE_STATEMENTS = 4  # key lookup, its insert or reuse, the response update and the delete of an expired key
+
+
+class ResponseCache(LRUCache):
+    """
+    Cache of (key, route) -> (fingerprint, status, response) in front of the stored idempotency keys
+    """
+    def init_app(self, app):
+        self.size = app.config['IDEMPOTENCY_CACHE_SIZE']
+        self.ttl = app.config['IDEMPOTENCY_TTL']
+        self.clear()
+
+
+response_cache = ResponseCache()
+
+
+def check_key(key):
+    """
+    Validate the Idempotency-Key header value
+
+    :param str key: value of the header
+    """
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise BackendError(f'{HEADER} header must have 1 to {MAX_KEY_LENGTH} characters.')
+
+
+def request_fingerprint(body):
+    """
+    Return fingerprint of the request body, a retry with the same key must send the same body
+
+    :param bytes body: request body
+    """
+    return hashlib.sha256(body).hexdigest()
+
+
+def expired_before():
+    """
+    Return creation time of the oldest key in use, the older keys are expired
+    """
+    return datetime.utcnow() - timedelta(seconds=app.config['IDEMPOTENCY_TTL'])
+
+
+def stored_response(stored, fingerprint):
+    """
+    Return (status, body) of the response stored under the key for the retried request
+
+    :param tuple stored: (fingerprint, status, response) of the key
+    :param str fingerprint: fingerprint of the retried request
+    """
+    stored_fingerprint, status, body = stored
+    if stored_fingerprint != fingerprint:
+        raise BackendError(f'{HEADER} is already used by a different request.')
+    if status is None:
+        raise ConflictError(f'Request with the same {HEADER} is still in progress.')
+    return status, body
+
+
+def replay(stored, fingerprint):
+    """
+    Return the stored response of the key
+
+    :param tuple stored: (fingerprint, status, response) of the key
+    :param str fingerprint: fingerprint of the retried request
+    """
+    status, body = stored_response(stored, fingerprint)
+    response = Response(body, status=status, mimetype='application/json')
+    response.headers[REPLAYED_HEADER] = 'true'
+    return response
+
+
+def idempotent(func):
+    """
+    Store the response of the endpoint method under the Idempotency-Key header of the request,
+    the retried request with the same key and body gets the stored response without running the method
+
+    The key is inserted before the method and committed by it with its changes, a concurrent request
+    with the same key fails on the primary key. Error responses are not stored, nothing is committed by them.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(HEADER)
+        if key is None:
+            return func(*args, **kwargs)
+        check_key(key)
+
+        route = f'{request.method} {request.path}'
+        fingerprint = request_fingerprint(request.get_data())
+        stored = response_cache.get((key, route))
+        if stored:
+            return replay(stored, fingerprint)
+
+        extend_budget(STORE_STATEMENTS)
+        record = db.IdempotencyKey.query.get((key, route))
+        if record and record.created >= expired_before():
+            return replay((record.fingerprint, record.status, record.response), fingerprint)
+
+        if record:
+            # expired key is used again by a new request
+            db.db.session.delete(record)
+            db.flush_changes()
+        record = db.IdempotencyKey(key=key, route=route, fingerprint=fingerprint)
+        db.add_object(record)
+
+        try:
+            result = func(*args, **kwargs)
+        except exc.IntegrityError:
+            # the concurrent request with the same key committed first
+            db.db.session.rollback()
+            record = db.IdempotencyKey.query.get((key, route))
+            if record is None:
+                raise
+            return replay((record.fingerprint, record.status, record.response), fingerprint)
+
+        response = result if isinstance(result, Response) else serializers.json_response(*result)
+        record.status = response.status_code
+        record.response = response.get_data()
+        db.save_changes()
+        response_cache.set((key, route), (fingerprint, response.status_code, response.get_data()))
+        return response
+
+    return wrapper
@@ -0,0 +1,66 @@
+import atexit
+import logging
+import logging.config
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+_listener = None
+
+
+def configure_logging(log_config, use_queue=True):
+    """
+    Configure logging from the dict config, the handlers of the root logger are moved behind a queue
+    and run on the background thread of the queue listener, so requests do not wait on the log I/O
+
+    :param dict log_config: logging dict config
+    :param bool use_queue: run the handlers on the queue listener
+    """
+    # pending records are written by the old handlers before the dict config closes them
+    stop_listener()
+    logging.config.dictConfig(log_config)
+    if use_queue:
+        start_listener()
+
+
+def start_listener():
+    """
+    Replace handlers of the root logger with a queue handler and start the listener running them
+    """
+    global _listener
+    root = logging.getLogger()
+    handlers = [handler for handler in root.handlers if not isinstance(handler, QueueHandler)]
+    if _listener:
+        # restarted listener keeps the handlers, the records go through a new queue
+        handlers = list(_listener.handlers) + handlers
+        stop_listener()
+
+    records = queue.Queue(-1)
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(records))
+
+    _listener = QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_listener(restore=False):
+    """
+    Write the queued records and stop the listener thread
+
+    :param bool restore: move the handlers of the listener back to the root logger, the records are written
+        on the logging thread again
+    """
+    global _listener
+    if _listener:
+        _listener.stop()
+        if restore:
+            root = logging.getLogger()
+            for handler in root.handlers[:]:
+                if isinstance(handler, QueueHandler):
+                    root.removeHandler(handler)
+            for handler in _listener.handlers:
+                root.addHandler(handler)
+        _listener = None
+
+
+atexit.register(stop_listener)
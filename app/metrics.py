@@ -0,0 +1,249 @@
+import bisect
+import functools
+import re
+import threading
+import time
+
+from flask import Blueprint, Response, current_app as app, g, has_request_context, request
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool, QueuePool
+
+metrics = Blueprint('metrics', __name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # seconds
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+STATEMENT_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+"?(\w+)', re.IGNORECASE)
+
+
+class Histogram:
+    """
+    Thread safe histogram with labels, rendered in the Prometheus text format
+    """
+    def __init__(self, name, description, labels, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        """
+        Add the value into the histogram of the label values
+
+        :param float value: observed value
+        :param labels: values of the labels in the order of the histogram labels
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                # counts of the buckets without the cumulation, sum and count of the values
+                entry = self._values[labels] = [0] * len(self.buckets) + [0, 0]
+            if index < len(self.buckets):
+                entry[index] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        """ Return lines of the histogram in the Prometheus text format """
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            values = sorted((labels, list(entry)) for labels, entry in self._values.items())
+
+        for labels, entry in values:
+            names = ''.join(f'{name}="{value}",' for name, value in zip(self.labels, labels))
+            cumulative = 0
+            for bucket, count in zip(self.buckets, entry):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{names}le="{bucket}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{names}le="+Inf"}} {entry[-1]}')
+            lines.append(f'{self.name}_sum{{{names.rstrip(",")}}} {entry[-2]}')
+            lines.append(f'{self.name}_count{{{names.rstrip(",")}}} {entry[-1]}')
+        return lines
+
+
+class PoolMetrics:
+    """
+    Thread safe counters of the DB connection pools of the worker, fed by the pool events
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.connects = 0
+            self.checkouts = 0
+            self.checkins = 0
+            self.invalidations = 0
+            self.timeouts = 0
+            self.wait_count = 0
+            self.wait_sum = 0.0
+            self.wait_max = 0.0
+
+    def count(self, counter):
+        """
+        Increment the counter
+
+        :param str counter: name of the counter attribute
+        """
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def observe_wait(self, seconds):
+        """
+        Add the time of one checkout waiting for a connection
+
+        :param float seconds: wait time
+        """
+        with self._lock:
+            self.wait_count += 1
+            self.wait_sum += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def samples(self, pool=None):
+        """
+        Return list of (name, type, help, value) of the pool metrics
+
+        :param pool: pool of the application engine, its size and overflow are reported for the queue pools
+        """
+        with self._lock:
+            samples = [
+                ('db_pool_checked_out', 'gauge', 'Connections checked out of the pools',
+                 self.checkouts - self.checkins),
+                ('db_pool_connects_total', 'counter', 'New DB connections opened by the pools', self.connects),
+                ('db_pool_checkouts_total', 'counter', 'Connections checked out of the pools', self.checkouts),
+                ('db_pool_invalidations_total', 'counter', 'Connections invalidated by ping or errors',
+                 self.invalidations),
+                ('db_pool_timeouts_total', 'counter', 'Checkouts failed on exhausted pool', self.timeouts),
+                ('db_pool_checkout_wait_seconds_count', 'counter', 'Checkouts with measured wait', self.wait_count),
+                ('db_pool_checkout_wait_seconds_sum', 'counter', 'Total wait for a connection', self.wait_sum),
+                ('db_pool_checkout_wait_seconds_max', 'gauge', 'Longest wait for a connection', self.wait_max),
+            ]
+        if isinstance(pool, QueuePool):
+            samples += [
+                ('db_pool_size', 'gauge', 'Connections kept by the pool', pool.size()),
+                ('db_pool_checked_in', 'gauge', 'Idle connections in the pool', pool.checkedin()),
+                ('db_pool_overflow', 'gauge', 'Connections over the pool size, negative when not all are open',
+                 pool.overflow()),
+            ]
+        return samples
+
+
+class TimedQueuePool(QueuePool):
+    """
+    Queue pool measuring how long the checkout waits for a connection
+    """
+    def _do_get(self):
+        # every checkout of the pool gets its connection record here, opening a new connection when allowed
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            pool_metrics.count('timeouts')
+            raise
+        finally:
+            pool_metrics.observe_wait(time.perf_counter() - start)
+
+
+pool_metrics = PoolMetrics()
+
+for _event, _counter in (('connect', 'connects'), ('checkout', 'checkouts'), ('checkin', 'checkins'),
+                         ('invalidate', 'invalidations')):
+    event.listen(Pool, _event, lambda *args, counter=_counter: pool_metrics.count(counter))
+
+
+@functools.lru_cache(maxsize=1024)
+def statement_labels(statement):
+    """
+    Return (operation, table) labels of the SQL statement, the statements of the app are a few repeated ones
+
+    :param str statement: SQL statement
+    """
+    words = statement.split(None, 1)
+    table = STATEMENT_TABLE.search(statement)
+    return (words[0].upper() if words else ''), (table.group(1).lower() if table else '')
+
+
+class RequestMetrics:
+    """
+    Latency histograms of the routes and of the SQL statements, and the number of queries of the requests
+    """
+    def __init__(self):
+        self.request_duration = Histogram('http_request_duration_seconds', 'Latency of the requests by route',
+                                          ('method', 'route', 'status'))
+        self.request_queries = Histogram('http_request_queries', 'SQL statements executed by one request',
+                                         ('method', 'route'), QUERY_COUNT_BUCKETS)
+        self.statement_duration = Histogram('sql_statement_duration_seconds', 'Latency of the SQL statements',
+                                            ('operation', 'table'))
+
+    def init_app(self, app):
+        if not app.config['METRICS_ENABLED']:
+            return
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        if not event.contains(Engine, 'before_cursor_execute', self.before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', self.before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def clear(self):
+        for histogram in (self.request_duration, self.request_queries, self.statement_duration):
+            histogram.clear()
+
+    @staticmethod
+    def start_request():
+        g.metrics_start = time.perf_counter()
+        g.query_count = 0
+
+    def finish_request(self, response):
+        start = g.pop('metrics_start', None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            self.request_duration.observe(time.perf_counter() - start, request.method, route,
+                                          str(response.status_code))
+            self.request_queries.observe(g.pop('query_count', 0), request.method, route)
+        return response
+
+    @staticmethod
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # the start is kept by the execution context, a failed statement drops it with the context
+        context._metrics_start = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start = context._metrics_start
+        self.statement_duration.observe(time.perf_counter() - start, *statement_labels(statement))
+        if has_request_context() and 'query_count' in g:
+            g.query_count += 1
+
+
+request_metrics = RequestMetrics()
+
+
+def render(samples, histograms=()):
+    """
+    Return the samples and the histograms in the Prometheus text format
+
+    :param list samples: list of (name, type, help, value)
+    :param histograms: list of Histogram
+    """
+    lines = []
+    for name, kind, description, value in samples:
+        lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}', f'{name} {value}']
+    for histogram in histograms:
+        lines += histogram.render()
+    return '\n'.join(lines) + '\n'
+
+
+@metrics.route('/metrics')
+def metrics_view():
+    """ Metrics of the worker in the Prometheus text format """
+    pool = app.extensions['sqlalchemy'].db.engine.pool
+    histograms = (request_metrics.request_duration, request_metrics.request_queries,
+                  request_metrics.statement_duration)
+    return Response(render(pool_metrics.samples(pool), histograms), mimetype='text/plain; version=0.0.4')
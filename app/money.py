@@ -0,0 +1,97 @@
+"""
+Fixed point money: amounts and balances are integer minor units of the currency scale, rates have RATE_SCALE digits
+
+The API numbers are converted to the units on the input and back on the output, all arithmetic between them is
+integer arithmetic.
+"""
+from decimal import ROUND_HALF_EVEN, Decimal
+
+from sqlalchemy import types
+
+RATE_SCALE = 10  # decimal places of the rates
+DEFAULT_SCALE = 8  # decimal places of the amounts of a new currency
+MAX_SCALE = 18
+MAX_UNITS = 2 ** 63 - 1  # BIGINT
+POWERS = tuple(10 ** digits for digits in range(MAX_SCALE + 2 * RATE_SCALE + 1))
+
+
+class Units(types.TypeDecorator):
+    """
+    BIGINT of the minor units, the values are read as int also from the SUM of Postgres (numeric)
+    and from the SQLite columns of the floats before the migration
+    """
+    impl = types.BigInteger
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else int(value)
+
+
+def to_units(value, scale, field='amount'):
+    """
+    Return the API number as the integer minor units of the scale, the number must be exact in them
+
+    :param value: int or float from the request
+    :param int scale: decimal places of the units
+    :param str field: name of the request field used in the error message
+    """
+    units = Decimal(str(value)).scaleb(scale)
+    if units != units.to_integral_value():
+        raise ValueError(f'Value "{field}"({value}) has more than {scale} decimal places.')
+    if abs(units) > MAX_UNITS:
+        raise ValueError(f'Value "{field}"({value}) is out of range.')
+    return int(units)
+
+
+def from_units(units, scale):
+    """
+    Return the minor units as the API number, None for the unknown value
+
+    :param int units: minor units
+    :param int scale: decimal places of the units
+    """
+    if units is None or scale is None:
+        return None
+    # true division of the ints is rounded correctly to the nearest float
+    return units / POWERS[scale]
+
+
+def to_rate(value, field='actual_rate'):
+    """
+    Return the API rate as the fixed point integer, rounded half to even to the RATE_SCALE decimal places,
+    the rates are computed by the clients (e.g. 1/3), only the amounts must be exact
+
+    :param value: int or float from the request
+    :param str field: name of the request field used in the error message
+    """
+    rate = Decimal(str(value)).scaleb(RATE_SCALE).to_integral_value(ROUND_HALF_EVEN)
+    if value and not rate:
+        raise ValueError(f'Value "{field}"({value}) is smaller than {RATE_SCALE} decimal places.')
+    if abs(rate) > MAX_UNITS:
+        raise ValueError(f'Value "{field}"({value}) is out of range.')
+    return int(rate)
+
+
+def from_rate(rate):
+    """
+    Return the fixed point rate as the API number
+
+    :param int rate: fixed point rate
+    """
+    return from_units(rate, RATE_SCALE)
+
+
+def convert(amount, currency_in, currency_out):
+    """
+    Return units of the currency out for the traded units of the currency in, rounded down
+
+    The amount is multiplied by both rates, like the float formula amount*rate_in*rate_out, exactly.
+
+    :param int amount: units of the currency in
+    :param currency_in: row with actual_rate and scale of the currency in
+    :param currency_out: row with actual_rate and scale of the currency out
+    """
+    value = amount * currency_in.actual_rate * currency_out.actual_rate * POWERS[currency_out.scale] \
+        // POWERS[currency_in.scale + 2 * RATE_SCALE]
+    if value > MAX_UNITS:
+        raise ValueError('Trade value is out of range of the currency.')
+    return value
@@ -0,0 +1,106 @@
+import threading
+from collections import Counter
+
+from flask import current_app as app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+N_PLUS_ONE_REPEATS = 3  # the same SELECT executed this many times within one request is reported
+
+
+def query_budget(count):
+    """
+    Declare the maximum number of SQL statements of the endpoint method, checked by the query guard
+
+    :param int count: maximum number of statements executed by one request
+    """
+    def decorator(func):
+        func.query_budget = count
+        return func
+
+    return decorator
+
+
+def extend_budget(count):
+    """
+    Allow the current request more statements than the budget of its endpoint, for the statements
+    executed around the endpoint method
+
+    :param int count: number of the additional statements
+    """
+    if has_request_context():
+        g.query_budget_extra = g.get('query_budget_extra', 0) + count
+
+
+def view_method():
+    """
+    Return view function of the current request, the method of the resource class for the class based views
+    """
+    view = app.view_functions.get(request.endpoint)
+    view_class = getattr(view, 'view_class', None)
+    if view_class:
+        view = getattr(view_class, request.method.lower(), None)
+    return view
+
+
+def endpoint_budget():
+    """
+    Return query budget of the view method of the current request or None when it is not declared
+    """
+    return getattr(view_method(), 'query_budget', None)
+
+
+class QueryGuard:
+    """
+    Test mode guard recording the statements of every request, it reports requests over their query budget
+    and the SELECT statements repeated within one request (N+1 queries of lazy relationships)
+    """
+    def __init__(self):
+        self.violations = []
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        if not app.config['QUERY_GUARD']:
+            return
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        if not event.contains(Engine, 'before_cursor_execute', self.before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', self.before_cursor_execute)
+
+    def reset(self):
+        with self._lock:
+            self.violations = []
+
+    @staticmethod
+    def start_request():
+        g.query_statements = []
+
+    @staticmethod
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if has_request_context() and 'query_statements' in g:
+            g.query_statements.append(statement)
+
+    def finish_request(self, response):
+        statements = g.pop('query_statements', None)
+        if statements is None:
+            return response
+
+        route = f'{request.method} {request.url_rule.rule if request.url_rule else request.path}'
+        budget = endpoint_budget()
+        if budget is not None:
+            budget += g.pop('query_budget_extra', 0)
+        violations = []
+        if budget is not None and len(statements) > budget:
+            violations.append(f'{route} executed {len(statements)} statements over its budget of {budget}')
+        for statement, count in Counter(statements).items():
+            if count >= N_PLUS_ONE_REPEATS and statement.lstrip().upper().startswith('SELECT'):
+                violations.append(f'{route} repeated {count} times: {statement}')
+
+        for violation in violations:
+            app.logger.warning('Query guard: %s', violation)
+        with self._lock:
+            self.violations.extend(violations)
+        return response
+
+
+query_guard = QueryGuard()
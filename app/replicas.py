@@ -0,0 +1,120 @@
+import itertools
+import time
+from contextlib import contextmanager
+
+from flask import current_app as app, g, has_request_context, request
+from sqlalchemy import exc, text
+
+from app.query_budget import extend_budget, view_method
+
+PRIMARY_HEADER = 'X-Read-Primary'
+PRIMARY_VALUES = ('1', 'true')
+REPLICA_PREFIX = 'replica'  # bind keys of the replicas in SQLALCHEMY_BINDS
+LAG_STATEMENTS = {
+    # seconds since the last transaction replayed by the standby, the primary has no lag
+    'postgresql': 'SELECT CASE WHEN pg_is_in_recovery() '
+                  'THEN COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) ELSE 0 END'
+}
+
+
+def read_only(func):
+    """
+    Declare the endpoint method as a read without writes, it is served by a replica when there is one
+    """
+    func.read_only = True
+    return func
+
+
+class ReplicaRouter:
+    """
+    Per worker choice of the replica serving the read only endpoints, the other endpoints use the primary
+
+    The replica is used while it answers the lag check with the lag within REPLICA_MAX_LAG, the check is repeated
+    after REPLICA_CHECK_INTERVAL. Reads go to the primary without a healthy replica, with the X-Read-Primary header
+    of the request and within use_primary().
+    """
+    def __init__(self):
+        self.binds = []
+        self.max_lag = 0
+        self.check_interval = 0
+        self._checks = {}  # bind key -> (monotonic time of the check, healthy)
+        self._turn = itertools.count()
+
+    def init_app(self, app):
+        self.binds = sorted(key for key in app.config.get('SQLALCHEMY_BINDS') or {} if key.startswith(REPLICA_PREFIX))
+        self.max_lag = app.config['REPLICA_MAX_LAG']
+        self.check_interval = app.config['REPLICA_CHECK_INTERVAL']
+        self._checks = {}
+        if self.binds:
+            app.before_request(self.start_request)
+
+    def start_request(self):
+        if not getattr(view_method(), 'read_only', False):
+            return
+        if request.headers.get(PRIMARY_HEADER, '').lower() in PRIMARY_VALUES:
+            return
+        g.replica_bind = self.choose()
+
+    def choose(self):
+        """ Return bind key of the next healthy replica or None when the reads go to the primary """
+        for _ in self.binds:
+            bind = self.binds[next(self._turn) % len(self.binds)]
+            if self.healthy(bind):
+                return bind
+        return None
+
+    def healthy(self, bind):
+        """
+        Return whether the replica answers with the lag within the limit, by the check of the last interval
+
+        :param str bind: bind key of the replica
+        """
+        now = time.monotonic()
+        checked = self._checks.get(bind)
+        if checked and now - checked[0] < self.check_interval:
+            return checked[1]
+
+        lag = self.lag(bind)
+        healthy = lag is not None and lag <= self.max_lag
+        if not healthy and (not checked or checked[1]):
+            app.logger.warning('Replica %s is not used, its lag is %s seconds', bind, lag)
+        self._checks[bind] = (now, healthy)
+        return healthy
+
+    @staticmethod
+    def lag(bind):
+        """
+        Return replication lag of the replica in seconds or None when it does not answer
+
+        :param str bind: bind key of the replica
+        """
+        engine = app.extensions['sqlalchemy'].db.get_engine(app, bind=bind)
+        extend_budget(1)
+        try:
+            with engine.connect() as connection:
+                return float(connection.execute(text(LAG_STATEMENTS.get(engine.dialect.name, 'SELECT 0'))).scalar())
+        except exc.DBAPIError as error:
+            app.logger.warning('Replica %s lag check failed: %s', bind, error)
+            return None
+
+
+replica_router = ReplicaRouter()
+
+
+def replica_engine():
+    """ Return engine of the replica chosen for the current request or None for the primary """
+    bind = g.get('replica_bind') if has_request_context() else None
+    if bind is None:
+        return None
+    return app.extensions['sqlalchemy'].db.get_engine(app, bind=bind)
+
+
+@contextmanager
+def use_primary():
+    """ Send the reads of the block to the primary, e.g. the read of a just committed write """
+    bind = g.pop('replica_bind', None)
+    try:
+        yield
+    finally:
+        if bind is not None:
+            g.replica_bind = bind
@@ -0,0 +1,48 @@
+"""
+Marshmallow schemas of the models, the API responses are built by app.serializers
+
+The schemas are the reference of the serialized format, they are imported only by the tests and the benchmarks,
+so the marshmallow packages are not loaded on the startup of the workers. The fields are ordered, the unordered
+fields of a ModelSchema are serialized in a different order by every process.
+"""
+from flask_marshmallow import Marshmallow
+
+from app.db_model import Currency, Trade
+from app.money import from_rate, from_units
+
+ma = Marshmallow()
+
+
+class CurrencySchema(ma.ModelSchema):
+    class Meta:
+        model = Currency
+        fields = ('id', 'name', 'shortcut', 'actual_rate', 'total', 'crypto', 'exchange', 'scale')
+        ordered = True
+
+    actual_rate = ma.Function(lambda currency: from_rate(currency.actual_rate))
+    total = ma.Function(lambda currency: from_units(currency.total, currency.scale))
+
+
+class ExchangeSchema(ma.Schema):
+    class Meta:
+        fields = ('id', 'name', 'currency')
+        ordered = True
+
+    currency = ma.Nested(CurrencySchema, many=True)
+
+
+class TradeSchema(ma.ModelSchema):
+    class Meta:
+        model = Trade
+        fields = ('id', 'amount', 'date', 'exchange', 'currency_in', 'currency_out')
+        ordered = True
+
+    amount = ma.Function(lambda trade: from_units(trade.amount, trade.currency_in and trade.currency_in.scale))
+    currency_in = ma.Nested(CurrencySchema)
+    currency_out = ma.Nested(CurrencySchema)
+
+
+exchange_schema = ExchangeSchema()
+currencies_schema = CurrencySchema(many=True)
+trade_schema = TradeSchema()
+trades_schema = TradeSchema(many=True)
@@ -0,0 +1,169 @@
+import json
+
+from flask import Response
+from sqlalchemy.orm import aliased
+
+from app.db_model import Currency, Trade, balance
+from app.money import from_rate, from_units
+
+try:
+    import orjson
+except ImportError:  # optional, the standard json module is used without it
+    orjson = None
+
+CURRENCY_FIELDS = ('id', 'name', 'shortcut', 'actual_rate', 'total', 'crypto', 'exchange_id', 'scale')
+# serialized CURRENCY_FIELDS, in the order of the CurrencySchema fields
+CURRENCY_KEYS = ('id', 'name', 'shortcut', 'actual_rate', 'total', 'crypto', 'exchange', 'scale')
+SCALE_INDEX = CURRENCY_FIELDS.index('scale')
+
+
+def dumps(obj):
+    """
+    Encode the object into JSON bytes, with orjson when it is installed, for the NDJSON lines
+
+    :param obj: serializable object
+    """
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode()
+
+
+def loads(data):
+    """
+    Decode the JSON bytes, with orjson when it is installed
+
+    :param bytes data: encoded JSON
+    """
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def encode(obj):
+    """
+    Encode the object into JSON bytes of a response, byte for byte like the flask-restx responses
+
+    The json module is used with its default separators, orjson has no option for them.
+
+    :param obj: serializable object
+    """
+    return json.dumps(obj).encode() + b'\n'
+
+
+def json_response(obj, status=200):
+    """
+    Return JSON response with the encoded object, formatted like the flask-restx responses
+
+    :param obj: serializable object
+    :param int status: response status code
+    """
+    return Response(encode(obj), status=status, mimetype='application/json')
+
+
+def _bool(value):
+    return None if value is None else bool(value)
+
+
+def _datetime(value):
+    return None if value is None else value.isoformat()
+
+
+_CONVERTERS = {'actual_rate': from_rate, 'crypto': _bool}
+
+
+def _columns(entity, prefix=''):
+    return [(balance(entity) if field == 'total' else getattr(entity, field)).label(prefix + field)
+            for field in CURRENCY_FIELDS]
+
+
+def currency_rows(query):
+    """
+    Return the currency query selecting only the columns of the currency serializer
+
+    :param query: Currency query
+    """
+    return query.with_entities(*_columns(Currency))
+
+
+def currency_columns(keys):
+    """
+    Return columns of the serialized currency keys, for the projection of the currency query,
+    the scale of the total is selected after them
+
+    :param keys: keys of the CURRENCY_KEYS
+    """
+    columns = dict(zip(CURRENCY_KEYS, _columns(Currency)))
+    return [columns[key] for key in keys] + [Currency.scale]
+
+
+def projected_dict(row, keys, start=0):
+    """
+    Return the row of the projected columns serialized like currency_dict
+
+    :param row: row with the columns of the keys, followed by the scale with the total
+    :param keys: serialized keys of the columns
+    :param int start: index of the first projected column
+    """
+    result = {key: _CONVERTERS[key](value) if key in _CONVERTERS else value for key, value in zip(keys, row[start:])}
+    if 'total' in result:
+        result['total'] = from_units(result['total'], row[start + len(keys)])
+    return result
+
+
+def trade_rows(query):
+    """
+    Return the trade query selecting only the columns of the trade serializer,
+    both currencies are joined and labeled with in_ and out_ prefixes
+
+    :param query: Trade query without limit and offset
+    """
+    currency_in = aliased(Currency)
+    currency_out = aliased(Currency)
+
+    return query.with_entities(Trade.id, Trade.amount, Trade.date, Trade.exchange_id,
+                               *_columns(currency_in, 'in_'), *_columns(currency_out, 'out_')) \
+        .outerjoin(currency_in, Trade.currency_in_id == currency_in.id) \
+        .outerjoin(currency_out, Trade.currency_out_id == currency_out.id)
+
+
+def currency_dict(row, start=0):
+    """
+    Return the currency row serialized like CurrencySchema
+
+    :param row: row with the CURRENCY_FIELDS columns
+    :param int start: index of the first currency column
+    """
+    if row[start] is None:
+        return None
+    return {"id": row[start], "name": row[start + 1], "shortcut": row[start + 2],
+            "actual_rate": from_rate(row[start + 3]), "total": from_units(row[start + 4], row[start + 7]),
+            "crypto": None if row[start + 5] is None else bool(row[start + 5]), "exchange": row[start + 6],
+            "scale": row[start + 7]}
+
+
+def trade_dict(row):
+    """
+    Return the row of the trade_rows query serialized like TradeSchema
+    """
+    # amount is in the units of the currency in
+    return {"id": row[0], "amount": from_units(row[1], row[4 + SCALE_INDEX]), "date": _datetime(row[2]),
+            "exchange": row[3], "currency_in": currency_dict(row, 4),
+            "currency_out": currency_dict(row, 4 + len(CURRENCY_FIELDS))}
+
+
+def exchange_dict(row, currencies):
+    """
+    Return the exchange serialized like ExchangeSchema
+
+    :param row: row with the exchange id and name
+    :param currencies: rows of the currency_rows query
+    """
+    return {"id": row[0], "name": row[1], "currency": dump_currencies(currencies)}
+
+
+def dump_currencies(rows):
+    return [currency_dict(row) for row in rows]
+
+
+def dump_trades(rows):
+    return [trade_dict(row) for row in rows]
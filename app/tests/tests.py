@@ -1,10 +1,17 @@
+import csv
+import io
+import json
 import os
+import shutil
+import tempfile
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 
 
 class BackendTestCase(unittest.TestCase):
 
     db_path = 'sqlite:///'
+    test_config = None
 
     def setUp(self):
         # creates a test client
@@ -12,9 +19,17 @@ class BackendTestCase(unittest.TestCase):
         os.environ['DATABASE_URL'] = self.db_path
 
         from app import create_app
+        from app.query_budget import query_guard
 
-        app = create_app()
+        app = create_app(self.test_config)
         self.app = app.test_client()
+        query_guard.reset()
+
+    def tearDown(self):
+        from app.query_budget import query_guard
+
+        # every request of the tests stays within the query budget of its endpoint, without N+1 queries
+        self.assertListEqual(query_guard.violations, [])
 
     def test_app_env(self):
         self.assertTrue(self.app.application.config['TESTING'])
@@ -77,6 +92,684 @@ class BackendTestCase(unittest.TestCase):
         self.assertEqual(result.status_code, 200)
         self.assertEqual(len(result.json), 0)
 
+        for search, count in (('me', 1), ('boo', 1), ('TE', 1), ('foo', 0), ('%', 0)):
+            result = self.app.get(f'/api/v1/crypto/history?search={search}')
+
+            self.assertEqual(result.status_code, 200)
+            self.assertEqual(len(result.json), count)
+
+    def test_trade_batch(self):
+        data = {'name': 'batchexchange', 'currency_shortcut': 'BAT'}
+        exchange_id = self.app.post('/api/v1/crypto/exchanges', json=data).json['id']
+        self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}', json={'amount': 10})
+        data = [{'method': 'POST', 'currency': {'name': 'foo', 'shortcut': 'FOO', 'actual_rate': 2}}]
+        self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=data)
+
+        data = [{'amount': 4, 'currency_in': 'BAT', 'currency_out': 'FOO'},
+                {'amount': 4, 'currency_in': 'BAT', 'currency_out': 'BOO'},
+                {'amount': 4, 'currency_in': 'BAT', 'currency_out': 'FOO'},
+                {'amount': 4, 'currency_in': 'BAT', 'currency_out': 'FOO'}]
+        result = self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}/trades/batch', json=data)
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.json['executed'], 2)
+        self.assertEqual(result.json['failed'], 2)
+        self.assertEqual([item['status'] for item in result.json['results']], ['success', 'error', 'success', 'error'])
+
+        result = self.app.get(f'/api/v1/crypto/history?exchange_id={exchange_id}')
+
+        self.assertEqual(len(result.json), 2)
+        self.assertEqual(result.json[0]['currency_in']['total'], 2)
+        self.assertEqual(result.json[0]['currency_out']['total'], 16)
+
+        result = self.app.post('/api/v1/crypto/exchanges/33/trades/batch', json=data)
+
+        self.assertEqual(result.status_code, 400)
+
+    def test_rate_cache(self):
+        data = {'name': 'cacheexchange', 'currency_shortcut': 'CAC'}
+        exchange_id = self.app.post('/api/v1/crypto/exchanges', json=data).json['id']
+        self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}', json={'amount': 10})
+        data = [{'method': 'POST', 'currency': {'name': 'foo', 'shortcut': 'FOO', 'actual_rate': 2}}]
+        currency_id = self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=data).json[1]['id']
+        trade = {'amount': 1, 'currency_in': 'CAC', 'currency_out': 'FOO'}
+        stats = self.app.get('/api/v1/crypto/exchanges/cache').json
+
+        self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}/trades', json=trade)
+        self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}/trades', json=trade)
+        result = self.app.get('/api/v1/crypto/exchanges/cache')
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.json['misses'] - stats['misses'], 2)
+        self.assertEqual(result.json['hits'] - stats['hits'], 2)
+
+        # rate change invalidates the cached currencies of the exchange
+        data = [{'method': 'PUT', 'currency': {'id': currency_id, 'shortcut': 'FOO', 'actual_rate': 3}}]
+        self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=data)
+        self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}/trades', json=trade)
+        currencies = self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=[]).json
+
+        self.assertEqual(currencies[1]['total'], 7)
+
+        # the currency deleted behind the cache fails the trade, the withdrawal is rolled back
+        data = [{'method': 'POST', 'currency': {'name': 'bar', 'shortcut': 'BAR', 'actual_rate': 2}}]
+        bar_id = self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=data).json[2]['id']
+        trade = {'amount': 1, 'currency_in': 'CAC', 'currency_out': 'BAR'}
+        self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}/trades', json=dict(trade, amount=100))
+        with self.app.application.app_context():
+            import app.db_model as db
+            db.Currency.query.filter_by(id=bar_id).delete()
+            db.save_changes()
+        result = self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}/trades', json=trade)
+        stats = self.app.get('/api/v1/crypto/exchanges/cache').json
+        self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}/trades', json=trade)
+        currencies = self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=[]).json
+
+        self.assertEqual(result.status_code, 400)
+        self.assertEqual(result.json['message'], 'Shortcut: BAR does not exist for the exchange.')
+        self.assertEqual(self.app.get('/api/v1/crypto/exchanges/cache').json['misses'] - stats['misses'], 2)
+        self.assertEqual([currency['total'] for currency in currencies], [7, 7])
+
+        # so does the deleted currency in, its withdrawal matches no row
+        data = [{'method': 'POST', 'currency': {'name': 'qux', 'shortcut': 'QUX', 'actual_rate': 2}}]
+        qux_id = self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=data).json[2]['id']
+        trade = {'amount': 1, 'currency_in': 'QUX', 'currency_out': 'CAC'}
+        self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}/trades', json=trade)
+        with self.app.application.app_context():
+            db.Currency.query.filter_by(id=qux_id).delete()
+            db.save_changes()
+        stats = self.app.get('/api/v1/crypto/exchanges/cache').json
+        result = self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}/trades', json=trade)
+        self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}/trades', json=trade)
+        result_stats = self.app.get('/api/v1/crypto/exchanges/cache').json
+
+        self.assertEqual(result.status_code, 400)
+        self.assertEqual(result.json['message'], 'Shortcut: QUX does not exist for the exchange.')
+        # the failed trade hits both cached currencies, the next one misses them
+        self.assertEqual((result_stats['hits'] - stats['hits'], result_stats['misses'] - stats['misses']), (2, 2))
+
+    def test_currencies_change_set(self):
+        data = {'name': 'setexchange', 'currency_shortcut': 'SET'}
+        exchange_id = self.app.post('/api/v1/crypto/exchanges', json=data).json['id']
+        data = [{'method': 'POST', 'currency': {'name': 'foo', 'shortcut': 'FOO', 'actual_rate': 2}},
+                {'method': 'POST', 'currency': {'name': 'boo', 'shortcut': 'BOO', 'actual_rate': 2}}]
+        foo, boo = self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=data).json[1:]
+
+        # the deleted shortcut can be reused by the edited currency within the same change set
+        data = [{'method': 'PUT', 'currency': {'id': boo['id'], 'shortcut': 'FOO', 'actual_rate': 3}},
+                {'method': 'DELETE', 'currency': {'id': foo['id']}},
+                {'method': 'POST', 'currency': {'name': 'meh', 'shortcut': 'MEH', 'actual_rate': 4}}]
+        result = self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=data)
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual([(item['shortcut'], item['actual_rate']) for item in result.json],
+                         [('SET', 1), ('FOO', 3), ('MEH', 4)])
+
+        # nothing is saved when any item is invalid
+        data = [{'method': 'POST', 'currency': {'name': 'bar', 'shortcut': 'BAR', 'actual_rate': 4}},
+                {'method': 'PUT', 'currency': {'id': foo['id'], 'actual_rate': 3}}]
+        result = self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=data)
+
+        self.assertEqual(result.status_code, 400)
+        self.assertEqual(len(self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=[]).json), 3)
+
+        # the items keep their order: the edited currency can be deleted later, the deleted one cannot be edited
+        data = [{'method': 'PUT', 'currency': {'id': boo['id'], 'actual_rate': 5}},
+                {'method': 'DELETE', 'currency': {'id': boo['id']}}]
+        result = self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=data)
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual([item['shortcut'] for item in result.json], ['SET', 'MEH'])
+
+        meh_id = result.json[1]['id']
+        data = [{'method': 'DELETE', 'currency': {'id': meh_id}},
+                {'method': 'PUT', 'currency': {'id': meh_id, 'actual_rate': 5}}]
+        result = self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=data)
+
+        self.assertEqual(result.status_code, 400)
+        self.assertEqual(result.json['message'], f'Crypto-currency with id: {meh_id} does not exist.')
+
+    def test_rates_tick(self):
+        data = {'name': 'tickexchange', 'currency_shortcut': 'TIC'}
+        exchange_id = self.app.post('/api/v1/crypto/exchanges', json=data).json['id']
+        data = [{'method': 'POST', 'currency': {'name': 'foo', 'shortcut': 'FOO', 'actual_rate': 2}},
+                {'method': 'POST', 'currency': {'name': 'boo', 'shortcut': 'BOO', 'actual_rate': 2}}]
+        currencies = self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=data).json
+        ids = [currency['id'] for currency in currencies]
+
+        # the exchange currency keeps its rate
+        result = self.app.put('/api/v1/crypto/exchanges/rates', json={'ids': ids, 'rates': [5, 3, 4]})
+
+        self.assertEqual(result.status_code, 200)
+        self.assertDictEqual(result.json, {'updated': 2})
+        currencies = self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=[]).json
+        self.assertEqual([currency['actual_rate'] for currency in currencies], [1, 3, 4])
+
+        result = self.app.put('/api/v1/crypto/exchanges/rates', json={'ids': ids, 'rates': [1]})
+
+        self.assertEqual(result.status_code, 400)
+
+    def test_history_cursor(self):
+        data = {'name': 'cursorexchange', 'currency_shortcut': 'CUR'}
+        exchange_id = self.app.post('/api/v1/crypto/exchanges', json=data).json['id']
+        self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}', json={'amount': 10})
+        data = [{'method': 'POST', 'currency': {'name': 'foo', 'shortcut': 'FOO', 'actual_rate': 1}}]
+        self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=data)
+        data = [{'amount': 1, 'currency_in': 'CUR', 'currency_out': 'FOO'}] * 5
+        self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}/trades/batch', json=data)
+
+        trades = []
+        cursor = ''
+        while cursor is not None:
+            result = self.app.get(f'/api/v1/crypto/history?limit=2&cursor={cursor}')
+
+            self.assertEqual(result.status_code, 200)
+            self.assertLessEqual(len(result.json['trades']), 2)
+            trades += [trade['id'] for trade in result.json['trades']]
+            cursor = result.json['next_cursor']
+
+        self.assertEqual(trades, sorted(trades))
+        self.assertEqual(len(trades), 5)
+
+        result = self.app.get('/api/v1/crypto/history?cursor=foo')
+
+        self.assertEqual(result.status_code, 400)
+
+    def test_history_export(self):
+        data = {'name': 'exportexchange', 'currency_shortcut': 'EXP'}
+        exchange_id = self.app.post('/api/v1/crypto/exchanges', json=data).json['id']
+        self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}', json={'amount': 10})
+        data = [{'method': 'POST', 'currency': {'name': 'foo', 'shortcut': 'FOO', 'actual_rate': 1}}]
+        self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=data)
+        data = [{'amount': 1.5, 'currency_in': 'EXP', 'currency_out': 'FOO'}] * 3
+        self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}/trades/batch', json=data)
+
+        result = self.app.get(f'/api/v1/crypto/history/export?exchange_id={exchange_id}')
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.mimetype, 'application/x-ndjson')
+        lines = result.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(json.loads(lines[0]), self.app.get('/api/v1/crypto/history?limit=1').json[0])
+
+        result = self.app.get(f'/api/v1/crypto/history/export?format=csv&exchange_id={exchange_id}')
+
+        self.assertEqual(result.status_code, 200)
+        rows = list(csv.reader(io.StringIO(result.get_data(as_text=True))))
+        self.assertEqual(rows[0], ['id', 'date', 'exchange_id', 'amount', 'currency_in', 'currency_out'])
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[1][3:], ['1.5', 'EXP', 'FOO'])
+        self.assertEqual(float(rows[1][3]), json.loads(lines[0])['amount'])
+
+        result = self.app.get('/api/v1/crypto/history/export?format=xml')
+
+        self.assertEqual(result.status_code, 400)
+
+    def test_history_analytics(self):
+        data = {'name': 'statsexchange', 'currency_shortcut': 'STA'}
+        exchange_id = self.app.post('/api/v1/crypto/exchanges', json=data).json['id']
+        self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}', json={'amount': 100})
+        data = [{'method': 'POST', 'currency': {'shortcut': 'FOO', 'actual_rate': 1}},
+                {'method': 'POST', 'currency': {'shortcut': 'BOO', 'actual_rate': 1}}]
+        self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=data)
+        data = [{'amount': amount, 'currency_in': 'STA', 'currency_out': 'FOO'} for amount in (1, 2, 3)]
+        data.append({'amount': 4, 'currency_in': 'STA', 'currency_out': 'BOO'})
+        self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}/trades/batch', json=data)
+
+        result = self.app.get(f'/api/v1/crypto/history/analytics?bucket=minute&exchange_id={exchange_id}')
+
+        self.assertEqual(result.status_code, 200)
+        pairs = {}
+        for group in result.json:
+            pair = pairs.setdefault((group['currency_in'], group['currency_out']), [0, 0, None, None])
+            pair[0] += group['count']
+            pair[1] += group['volume']
+            pair[2] = min(group['min_amount'], pair[2] or group['min_amount'])
+            pair[3] = max(group['max_amount'], pair[3] or group['max_amount'])
+        self.assertDictEqual(pairs, {('STA', 'FOO'): [3, 6, 1, 3], ('STA', 'BOO'): [1, 4, 4, 4]})
+
+        result = self.app.get('/api/v1/crypto/history/analytics?bucket=week')
+
+        self.assertEqual(result.status_code, 400)
+
+    def test_rollups(self):
+        data = {'name': 'rollupexchange', 'currency_shortcut': 'ROL'}
+        exchange_id = self.app.post('/api/v1/crypto/exchanges', json=data).json['id']
+        self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}', json={'amount': 100})
+        data = [{'method': 'POST', 'currency': {'shortcut': 'FOO', 'actual_rate': 1}}]
+        self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=data)
+        data = [{'amount': amount, 'currency_in': 'ROL', 'currency_out': 'FOO'} for amount in (1, 2, 3)]
+        self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}/trades/batch', json=data)
+        self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}/trades',
+                      json={'amount': 5, 'currency_in': 'FOO', 'currency_out': 'ROL'})
+
+        url = f'/api/v1/crypto/history/analytics?bucket=day&exchange_id={exchange_id}'
+        trades = self.app.get(url + '&source=trades')
+        rollups = self.app.get(url + '&source=rollups')
+
+        self.assertEqual(rollups.status_code, 200)
+        self.assertEqual(rollups.json, trades.json)
+        self.assertEqual(self.app.get(url.replace('day', 'minute') + '&source=rollups').status_code, 400)
+
+        runner = self.app.application.test_cli_runner()
+        result = runner.invoke(args=['rollup', 'check'])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        with self.app.application.app_context():
+            import app.db_model as db
+            db.TradeRollup.query.filter_by(currency_in_id=1).delete()
+            db.save_changes()
+
+        result = runner.invoke(args=['rollup', 'check'])
+
+        self.assertEqual(result.exit_code, 1)
+
+        runner.invoke(args=['rollup', 'rebuild'])
+        result = runner.invoke(args=['rollup', 'check'])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(self.app.get(url + '&source=rollups').json, trades.json)
+
+    def test_serializers_golden(self):
+        from flask_restx.representations import output_json
+        from sqlalchemy.orm import selectinload
+        from app import schemas, serializers
+        import app.db_model as db
+
+        data = {'name': 'goldenexchange', 'currency_shortcut': 'GOL'}
+        exchange_id = self.app.post('/api/v1/crypto/exchanges', json=data).json['id']
+        self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}', json={'amount': 10.5})
+        data = [{'method': 'POST', 'currency': {'shortcut': 'FOO', 'actual_rate': 1.1}},
+                {'method': 'POST', 'currency': {'name': 'boo', 'shortcut': 'BOO', 'actual_rate': 3}}]
+        self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=data)
+        data = [{'amount': 4.2, 'currency_in': 'GOL', 'currency_out': 'FOO'},
+                {'amount': 1, 'currency_in': 'GOL', 'currency_out': 'BOO'}]
+        self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}/trades/batch', json=data)
+
+        history = self.app.get(f'/api/v1/crypto/history?exchange_id={exchange_id}').data
+        listing = self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=[]).data
+
+        # the bytes of the former flask-restx responses of the schemas, numbers keep the difference of 1 and 1.0
+        with self.app.application.app_context():
+            trades = db.Trade.query.order_by(db.Trade.id)
+            currencies = db.Currency.query.filter_by(exchange_id=exchange_id).order_by(db.Currency.id)
+            exchange = db.Exchange.query.options(selectinload(db.Exchange.currency)).get(exchange_id)
+
+            self.assertEqual(history, output_json(schemas.trades_schema.dump(trades.all()), 200).get_data())
+            self.assertEqual(listing, output_json(schemas.currencies_schema.dump(currencies.all()), 200).get_data())
+            self.assertEqual(serializers.encode(serializers.exchange_dict((exchange.id, exchange.name),
+                                                                          serializers.currency_rows(currencies))),
+                             output_json(schemas.exchange_schema.dump(exchange), 200).get_data())
+
+    def test_pool_metrics(self):
+        from sqlalchemy import create_engine, exc
+        from app.metrics import TimedQueuePool, pool_metrics
+
+        self.app.post('/api/v1/crypto/exchanges', json={'name': 'metricsexchange', 'currency_shortcut': 'MET'})
+        result = self.app.get('/metrics')
+
+        self.assertEqual(result.status_code, 200)
+        self.assertTrue(result.content_type.startswith('text/plain'))
+        samples = dict(line.split() for line in result.data.decode().splitlines() if not line.startswith('#'))
+        self.assertGreater(float(samples['db_pool_checkouts_total']), 0)
+        self.assertIn('db_pool_checkout_wait_seconds_sum', samples)
+
+        # exhausted pool fails the checkout after the timeout and it is counted
+        engine = create_engine('sqlite://', poolclass=TimedQueuePool, pool_size=1, max_overflow=0, pool_timeout=0.01)
+        timeouts = pool_metrics.timeouts
+        connection = engine.connect()
+        with self.assertRaises(exc.TimeoutError):
+            engine.connect()
+        connection.close()
+        self.assertEqual(pool_metrics.timeouts, timeouts + 1)
+        self.assertIn(('db_pool_size', 'gauge', 'Connections kept by the pool', 1), pool_metrics.samples(engine.pool))
+
+    def test_request_metrics(self):
+        from app.metrics import Histogram, request_metrics
+
+        request_metrics.clear()
+        self.app.post('/api/v1/crypto/exchanges', json={'name': 'metricsexchange', 'currency_shortcut': 'MET'})
+        self.app.get('/api/v1/crypto/history')
+        result = self.app.get('/metrics').data.decode()
+
+        self.assertIn('http_request_duration_seconds_count{method="POST",route="/api/v1/crypto/exchanges",'
+                      'status="201"} 1', result)
+        self.assertIn('http_request_queries_count{method="GET",route="/api/v1/crypto/history"} 1', result)
+        self.assertIn('sql_statement_duration_seconds_count{operation="INSERT",table="exchange"} 1', result)
+
+        histogram = Histogram('test_seconds', 'Test', ('route',), buckets=(1, 2))
+        for value in (0.5, 1, 1.5, 3):
+            histogram.observe(value, '/test')
+        self.assertListEqual(histogram.render()[2:], [
+            'test_seconds_bucket{route="/test",le="1"} 2', 'test_seconds_bucket{route="/test",le="2"} 3',
+            'test_seconds_bucket{route="/test",le="+Inf"} 4', 'test_seconds_sum{route="/test"} 6.0',
+            'test_seconds_count{route="/test"} 4'])
+
+    def test_query_guard(self):
+        from app.db_model import Currency
+        from app.query_budget import query_budget, query_guard
+
+        @query_budget(2)
+        def lazy_view():
+            for currency_id in (1, 2, 3):
+                Currency.query.get(currency_id)
+            return ''
+
+        self.app.application.add_url_rule('/lazy', 'lazy', lazy_view)
+        self.app.get('/lazy')
+
+        self.assertEqual(len(query_guard.violations), 2)
+        self.assertIn('GET /lazy executed 3 statements over its budget of 2', query_guard.violations)
+        query_guard.reset()
+
+    def test_queue_logging(self):
+        import logging
+        import threading
+        from logging.handlers import QueueHandler
+        from app import logs
+
+        self.assertTrue(all(isinstance(handler, QueueHandler) for handler in logging.getLogger().handlers))
+
+        threads = []
+
+        class Recorder(logging.Handler):
+            def emit(self, record):
+                threads.append((threading.current_thread(), record.getMessage()))
+
+        logs._listener.handlers += (Recorder(),)
+        self.app.application.logger.info('queued %s', 'record')
+        logs.stop_listener()
+
+        threads = [thread for thread, message in threads if message == 'queued record']
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+
+    def test_idempotency_key(self):
+        from app.commands import purge_idempotency_keys
+        from app.idempotency import response_cache
+
+        data = {'name': 'idemexchange', 'currency_shortcut': 'IDE'}
+        exchange_id = self.app.post('/api/v1/crypto/exchanges', json=data).json['id']
+        headers = {'Idempotency-Key': 'deposit-1'}
+        for _ in range(2):
+            result = self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}', json={'amount': 10}, headers=headers)
+
+            self.assertEqual(result.status_code, 200)
+            self.assertDictEqual(result.json, {'status': 'success'})
+        self.assertEqual(result.headers['Idempotent-Replayed'], 'true')
+
+        data = [{'method': 'POST', 'currency': {'name': 'foo', 'shortcut': 'FOO', 'actual_rate': 2}}]
+        self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=data)
+        trade = {'amount': 4, 'currency_in': 'IDE', 'currency_out': 'FOO'}
+        headers = {'Idempotency-Key': 'trade-1'}
+        first = self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}/trades', json=trade, headers=headers)
+        # the retry of another worker finds the key in DB
+        response_cache.clear()
+        retry = self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}/trades', json=trade, headers=headers)
+
+        self.assertEqual(retry.status_code, first.status_code)
+        self.assertEqual(retry.get_data(), first.get_data())
+        self.assertEqual(len(self.app.get(f'/api/v1/crypto/history?exchange_id={exchange_id}').json), 1)
+        totals = self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=[]).json
+        self.assertEqual([currency['total'] for currency in totals], [6, 8])
+
+        trade['amount'] = 5
+        result = self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}/trades', json=trade, headers=headers)
+
+        self.assertEqual(result.status_code, 400)
+
+        # expired keys are deleted and can be used again
+        self.app.application.config['IDEMPOTENCY_TTL'] = 0
+        result = self.app.application.test_cli_runner().invoke(purge_idempotency_keys)
+
+        self.assertIn('Purged 2 idempotency keys.', result.output)
+
+    def test_listing(self):
+        for name in ('lista', 'listb', 'listc'):
+            data = {'name': name, 'currency_shortcut': 'LIS'}
+            exchange_id = self.app.post('/api/v1/crypto/exchanges', json=data).json['id']
+            data = [{'method': 'POST', 'currency': {'name': 'foo', 'shortcut': 'FOO', 'actual_rate': 2}}]
+            self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=data)
+
+        result = self.app.get('/api/v1/crypto/exchanges?limit=2&fields=name')
+
+        self.assertEqual(result.status_code, 200)
+        self.assertListEqual(result.json['exchanges'], [{'name': 'lista'}, {'name': 'listb'}])
+
+        # currencies of all exchanges of the page are loaded by one query
+        result = self.app.get('/api/v1/crypto/exchanges?limit=2&include=currency')
+
+        self.assertEqual([len(exchange['currency']) for exchange in result.json['exchanges']], [2, 2])
+
+        cursor = result.json['next_cursor']
+        result = self.app.get(f'/api/v1/crypto/exchanges?limit=2&cursor={cursor}&include=currency')
+
+        self.assertEqual(len(result.json['exchanges']), 1)
+        self.assertIsNone(result.json['next_cursor'])
+        self.assertEqual(result.json['exchanges'][0]['name'], 'listc')
+        self.assertEqual([currency['shortcut'] for currency in result.json['exchanges'][0]['currency']],
+                         ['LIS', 'FOO'])
+
+        result = self.app.get(f'/api/v1/crypto/exchanges/{exchange_id}/currencie?fields=shortcut,total,crypto')
+
+        self.assertListEqual(result.json['currencies'], [{'shortcut': 'LIS', 'total': 0.0, 'crypto': False},
+                                                         {'shortcut': 'FOO', 'total': 0.0, 'crypto': True}])
+        self.assertEqual(self.app.get('/api/v1/crypto/exchanges?fields=name,owner').status_code, 400)
+        for limit in (0, -1, 1001):
+            result = self.app.get(f'/api/v1/crypto/exchanges?limit={limit}')
+            self.assertEqual(result.status_code, 400)
+            self.assertIn('Invalid limit', result.json['message'])
+        result = self.app.get(f'/api/v1/crypto/exchanges/{exchange_id}/currencie?limit=0')
+        self.assertEqual(result.status_code, 400)
+
+    def test_trade_archive(self):
+        from datetime import datetime
+        from app.commands import archive_trades, check_rollups, partition_trades, rebuild_rollups
+        from app.db_model import Trade, TradePartition, TradeRollup, db
+
+        archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive_dir)
+        self.app.application.config['TRADE_ARCHIVE_DIR'] = archive_dir
+
+        data = {'name': 'archiveexchange', 'currency_shortcut': 'ARC'}
+        exchange_id = self.app.post('/api/v1/crypto/exchanges', json=data).json['id']
+        data = [{'method': 'POST', 'currency': {'name': 'foo', 'shortcut': 'FOO', 'actual_rate': 2}}]
+        self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=data)
+        self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}', json={'amount': 10})
+        trade = {'amount': 1, 'currency_in': 'ARC', 'currency_out': 'FOO'}
+        self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}/trades', json=trade)
+        with self.app.application.app_context():
+            for date in (datetime(2020, 1, 15), datetime(2020, 1, 20), datetime(2020, 3, 1)):
+                db.session.add(Trade(amount=2, currency_in_id=1, currency_out_id=2, exchange_id=exchange_id, date=date))
+            db.session.commit()
+
+        runner = self.app.application.test_cli_runner()
+        runner.invoke(rebuild_rollups)
+        self.assertIn('Created 3 trade partitions.', runner.invoke(partition_trades, ['--ahead', '2']).output)
+        result = runner.invoke(archive_trades, ['--keep', '1'])
+
+        self.assertIn('Archived 2 trades of 2020-01.', result.output)
+        self.assertIn('Archived 2 months.', result.output)
+        self.assertEqual(sorted(os.listdir(archive_dir)), ['trade-2020-01.ndjson.gz', 'trade-2020-03.ndjson.gz'])
+        with self.app.application.app_context():
+            self.assertEqual(Trade.query.count(), 1)
+            self.assertEqual(TradePartition.query.filter(TradePartition.archived.isnot(None)).count(), 2)
+
+        # rollups of the archived months stay, they are not compared with the trade table nor rebuilt from it
+        self.assertEqual(runner.invoke(check_rollups).exit_code, 0)
+        self.assertIn('Rebuilt 4 rollups.', runner.invoke(rebuild_rollups).output)
+        self.assertEqual(runner.invoke(check_rollups).exit_code, 0)
+        with self.app.application.app_context():
+            self.assertEqual(TradeRollup.query.filter(TradeRollup.bucket < datetime(2020, 4, 1)).count(), 3)
+
+        history = '/api/v1/crypto/history'
+        self.assertEqual(len(self.app.get(history).json), 1)
+        result = self.app.get(f'{history}?archived=true')
+        self.assertEqual([trade['date'][:10] for trade in result.json],
+                         ['2020-01-15', '2020-01-20', '2020-03-01', datetime.utcnow().isoformat()[:10]])
+        self.assertEqual(result.json[0]['currency_in']['shortcut'], 'ARC')
+        self.assertEqual(len(self.app.get(f'{history}?archived=1&offset=2&limit=1').json), 1)
+        self.assertEqual(len(self.app.get(f'{history}?archived=1&offset=3').json), 1)
+        result = self.app.get(f'{history}?archived=1&date_from=2020-03-01T00:00:00Z&date_to=2020-12-31T00:00:00Z')
+        self.assertEqual(len(result.json), 1)
+
+        # cursor pages continue from the archive files into the table
+        ids, cursor = [], ''
+        while cursor is not None:
+            result = self.app.get(f'{history}?archived=1&limit=3&cursor={cursor}').json
+            ids.extend(trade['id'] for trade in result['trades'])
+            cursor = result['next_cursor']
+        self.assertEqual(len(ids), 4)
+        self.assertEqual(len(set(ids)), 4)
+
+    def test_conditional_get(self):
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+
+        data = {'name': 'etagexchange', 'currency_shortcut': 'ETA'}
+        exchange_id = self.app.post('/api/v1/crypto/exchanges', json=data).json['id']
+        data = [{'method': 'POST', 'currency': {'name': 'foo', 'shortcut': 'FOO', 'actual_rate': 2}}]
+        foo_id = self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=data).json[1]['id']
+        url = f'/api/v1/crypto/exchanges/{exchange_id}/currencie'
+        result = self.app.get(url)
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(len(result.json['currencies']), 2)
+        etag = result.headers['ETag']
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(Engine, 'before_cursor_execute', count)
+        try:
+            not_modified = self.app.get(url, headers={'If-None-Match': etag})
+            cached = self.app.get(url)
+        finally:
+            event.remove(Engine, 'before_cursor_execute', count)
+
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.get_data(), b'')
+        self.assertEqual(cached.get_data(), result.get_data())
+        self.assertListEqual(statements, [])
+
+        self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}', json={'amount': 10})
+        result = self.app.get(url, headers={'If-None-Match': etag})
+
+        self.assertEqual(result.status_code, 200)
+        self.assertNotEqual(result.headers['ETag'], etag)
+        self.assertEqual(result.json['currencies'][0]['total'], 10)
+
+        history = f'/api/v1/crypto/history?exchange_id={exchange_id}'
+        etag = self.app.get(history).headers['ETag']
+        self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}/trades',
+                      json={'amount': 1, 'currency_in': 'ETA', 'currency_out': 'FOO'})
+
+        self.assertEqual(len(self.app.get(history, headers={'If-None-Match': etag}).json), 1)
+        self.assertEqual(self.app.get('/api/v1/crypto/exchanges/33/currencie').status_code, 400)
+
+        # the rates change the versions of the exchanges of the updated currencies only
+        other_id = self.app.post('/api/v1/crypto/exchanges', json={'name': 'otherexchange',
+                                                                   'currency_shortcut': 'OTH'}).json['id']
+        other_url = f'/api/v1/crypto/exchanges/{other_id}/currencie'
+        etag, other_etag = self.app.get(url).headers['ETag'], self.app.get(other_url).headers['ETag']
+        self.app.put('/api/v1/crypto/exchanges/rates', json={'ids': [foo_id], 'rates': [3]})
+
+        self.assertEqual(self.app.get(url, headers={'If-None-Match': etag}).status_code, 200)
+        self.assertEqual(self.app.get(other_url, headers={'If-None-Match': other_etag}).status_code, 304)
+
+    def test_init_db(self):
+        from sqlalchemy import inspect
+        from app import create_app, init_worker
+        from app.commands import init_db_command
+        from app.db_model import db
+
+        db_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, db_dir)
+        app = create_app({'AUTO_CREATE_SCHEMA': False,
+                          'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(db_dir, 'init.db')})
+        with app.app_context():
+            self.assertNotIn('exchange', inspect(db.engine).get_table_names())
+
+            result = app.test_cli_runner().invoke(init_db_command)
+
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn('exchange', inspect(db.engine).get_table_names())
+
+        # the worker forked from the preloaded master starts its own log listener
+        init_worker(app)
+        data = {'name': 'forked', 'currency_shortcut': 'FRK'}
+        result = app.test_client().post('/api/v1/crypto/exchanges', json=data)
+        self.assertEqual(result.status_code, 201)
+
+    def test_fixed_point_money(self):
+        from app.money import to_rate
+
+        data = {'name': 'moneyexchange', 'currency_shortcut': 'MNY'}
+        exchange_id = self.app.post('/api/v1/crypto/exchanges', json=data).json['id']
+        data = [{'method': 'POST', 'currency': {'name': 'cent', 'shortcut': 'CNT', 'actual_rate': 1.5, 'scale': 2}}]
+        cnt_id = self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=data).json[1]['id']
+        for amount in (0.1, 0.2):
+            self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}', json={'amount': amount})
+
+        result = self.app.get(f'/api/v1/crypto/exchanges/{exchange_id}/currencie')
+        currencies = {currency['shortcut']: currency for currency in result.json['currencies']}
+        self.assertEqual(currencies['MNY']['total'], 0.3)
+        self.assertEqual((currencies['MNY']['scale'], currencies['CNT']['scale']), (8, 2))
+
+        trade = {'amount': 0.12345678, 'currency_in': 'MNY', 'currency_out': 'CNT'}
+        result = self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}/trades', json=trade)
+        self.assertEqual(result.status_code, 200)
+        # 0.12345678 * 1 * 1.5 is rounded down to the cents
+        result = self.app.get(f'/api/v1/crypto/exchanges/{exchange_id}/currencie')
+        currencies = {currency['shortcut']: currency for currency in result.json['currencies']}
+        self.assertEqual((currencies['MNY']['total'], currencies['CNT']['total']), (0.17654322, 0.18))
+        self.assertEqual(self.app.get('/api/v1/crypto/history').json[0]['amount'], 0.12345678)
+
+        trade['amount'] = 0.123456789
+        result = self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}/trades', json=trade)
+        self.assertEqual(result.status_code, 400)
+        data = [{'method': 'PUT', 'currency': {'shortcut': 'CNT', 'scale': 4}}]
+        self.assertEqual(self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=data).status_code, 400)
+
+        # the rates are rounded half to even to the RATE_SCALE decimal places
+        result = self.app.put('/api/v1/crypto/exchanges/rates', json={'ids': [cnt_id], 'rates': [1 / 3]})
+        self.assertEqual(result.status_code, 200)
+        data = [{'method': 'POST', 'currency': {'name': 'third', 'shortcut': 'TRD', 'actual_rate': 2 / 3}}]
+        result = self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=data)
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual([currency['actual_rate'] for currency in result.json], [1, 0.3333333333, 0.6666666667])
+        self.assertEqual((to_rate(0.00000000025), to_rate(0.00000000035)), (2, 4))
+        self.assertEqual(self.app.put('/api/v1/crypto/exchanges/rates',
+                                      json={'ids': [cnt_id], 'rates': [0.00000000001]}).status_code, 400)
+
+    def test_migrate_money(self):
+        from sqlalchemy import text
+        from app import create_app
+        from app.commands import init_db_command, migrate_money
+        from app.db_model import Currency, db
+
+        db_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, db_dir)
+        app = create_app({'AUTO_CREATE_SCHEMA': False,
+                          'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(db_dir, 'money.db')})
+        with app.app_context():
+            # currency table of the float columns before the fixed point units
+            db.session.execute(text('CREATE TABLE currency (id INTEGER PRIMARY KEY, name VARCHAR(30), '
+                                    'shortcut VARCHAR(3) NOT NULL, actual_rate FLOAT NOT NULL, total FLOAT NOT NULL, '
+                                    'exchange_id INTEGER, crypto BOOLEAN NOT NULL)'))
+            db.session.execute(text("INSERT INTO currency VALUES (1, 'old', 'OLD', 0.25, 12.5, NULL, 1)"))
+            db.session.commit()
+            runner = app.test_cli_runner()
+            runner.invoke(init_db_command)
+
+            self.assertIn('Money columns are migrated into the units.', runner.invoke(migrate_money).output)
+            self.assertIn('Money columns are already in the units.', runner.invoke(migrate_money).output)
+            currency = Currency.query.get(1)
+            self.assertEqual((currency.actual_rate, currency.total, currency.scale), (2500000000, 1250000000, 8))
+
     def test_failure(self):
         from app.errors.exceptions import BackendError
         data = {'name': 'testexchange', 'currency_shortcut': 'TT', 'currency_name': 'test'}
@@ -91,10 +784,302 @@ class BackendTestCase(unittest.TestCase):
         self.assertEqual(result.status_code, 400)
         self.assertRaises(BackendError)
 
-        # unimplemented method GET
-        result = self.app.get('/api/v1/crypto/exchanges', json=data)
+        # unimplemented method DELETE
+        result = self.app.delete('/api/v1/crypto/exchanges', json=data)
+
+        self.assertEqual(result.status_code, 400)
+
+
+class LedgerTestCase(BackendTestCase):
+    """
+    The API keeps the balances by the ledger entries
+    """
+    test_config = {'LEDGER_MODE': True}
+
+    @unittest.skip('schemas read the currency totals without the pending ledger entries')
+    def test_serializers_golden(self):
+        pass
+
+    def test_ledger_snapshot(self):
+        from app.commands import snapshot_ledger
+        from app.db_model import LedgerEntry
+        from app.money import DEFAULT_SCALE
+
+        data = {'name': 'ledgerexchange', 'currency_shortcut': 'LED'}
+        exchange_id = self.app.post('/api/v1/crypto/exchanges', json=data).json['id']
+        data = [{'method': 'POST', 'currency': {'name': 'foo', 'shortcut': 'FOO', 'actual_rate': 2}}]
+        self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=data)
+        self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}', json={'amount': 10})
+        trade = {'amount': 4, 'currency_in': 'LED', 'currency_out': 'FOO'}
+        self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}/trades', json=trade)
+        result = self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}/trades', json=dict(trade, amount=7))
+
+        self.assertEqual(result.status_code, 400)
+        self.assertIn('actual:6.0', result.json['message'])
+
+        result = self.app.application.test_cli_runner().invoke(snapshot_ledger)
+
+        self.assertIn('compacted 3 ledger entries', result.output)
+        self.app.post(f'/api/v1/crypto/exchanges/{exchange_id}', json={'amount': 1})
+        totals = self.app.put(f'/api/v1/crypto/exchanges/{exchange_id}/currencie', json=[]).json
+        self.assertEqual([currency['total'] for currency in totals], [7, 8])
+
+        with self.app.application.app_context():
+            entries = LedgerEntry.query.order_by(LedgerEntry.id).all()
+            # the entries are in the minor units of the default scale
+            self.assertEqual([entry.amount / 10 ** DEFAULT_SCALE for entry in entries], [10, -4, 8, 1])
+            self.assertEqual([entry.snapshot_id for entry in entries], [1, 1, 1, None])
+
+
+class BalanceStressTestCase(unittest.TestCase):
+    """
+    Concurrent deposits and trades on the same currencies must not lose updates
+    """
+    workers = 8
+    operations = 20
+    ledger_mode = False
+
+    def setUp(self):
+        os.environ['FLASK_ENV'] = 'test'
+        self.db_dir = tempfile.mkdtemp()
+        db_path = 'sqlite:///' + os.path.join(self.db_dir, 'stress.db')
+
+        from app import create_app
+
+        app = create_app({'SQLALCHEMY_DATABASE_URI': db_path, 'LEDGER_MODE': self.ledger_mode})
+        self.app = app.test_client()
+
+        data = {'name': 'stressexchange', 'currency_shortcut': 'STR'}
+        self.exchange_id = self.app.post('/api/v1/crypto/exchanges', json=data).json['id']
+        data = [{'method': 'POST', 'currency': {'name': 'foo', 'shortcut': 'FOO', 'actual_rate': 1}}]
+        self.app.put(f'/api/v1/crypto/exchanges/{self.exchange_id}/currencie', json=data)
+
+    def tearDown(self):
+        shutil.rmtree(self.db_dir)
+
+    def run_concurrently(self, requests):
+        """ Run every request on the worker threads and return the status codes """
+        def worker(request):
+            url, data = request
+            return self.app.application.test_client().post(url, json=data).status_code
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(worker, requests))
+
+    def totals(self):
+        currencies = self.app.put(f'/api/v1/crypto/exchanges/{self.exchange_id}/currencie', json=[]).json
+        return {currency['shortcut']: currency['total'] for currency in currencies}
+
+    def test_concurrent_deposits(self):
+        url = f'/api/v1/crypto/exchanges/{self.exchange_id}'
+        statuses = self.run_concurrently([(url, {'amount': 1})] * self.workers * self.operations)
+
+        self.assertEqual(statuses, [200] * self.workers * self.operations)
+        self.assertEqual(self.totals()['STR'], self.workers * self.operations)
+
+    def test_concurrent_trades(self):
+        deposit = self.workers * self.operations // 2
+        self.app.post(f'/api/v1/crypto/exchanges/{self.exchange_id}', json={'amount': deposit})
+
+        url = f'/api/v1/crypto/exchanges/{self.exchange_id}/trades'
+        buy = (url, {'amount': 1, 'currency_in': 'STR', 'currency_out': 'FOO'})
+        sell = (url, {'amount': 1, 'currency_in': 'FOO', 'currency_out': 'STR'})
+        requests = [buy, buy, sell] * (self.workers * self.operations // 3)
+        statuses = self.run_concurrently(requests)
+
+        bought = sum(1 for request, status in zip(requests, statuses) if request is buy and status == 200)
+        sold = sum(1 for request, status in zip(requests, statuses) if request is sell and status == 200)
+        totals = self.totals()
+
+        self.assertEqual(totals['STR'] + totals['FOO'], deposit)
+        self.assertEqual(totals['FOO'], bought - sold)
+        self.assertGreaterEqual(totals['STR'], 0)
+        self.assertGreaterEqual(totals['FOO'], 0)
+
+
+class LedgerStressTestCase(BalanceStressTestCase):
+    """
+    Concurrent withdrawals of the ledger entries must not lower the balances under zero
+    """
+    ledger_mode = True
+
+
+class ReplicaTestCase(unittest.TestCase):
+    """
+    Read only endpoints are served by the replica, writes and the forced reads by the primary
+    """
+
+    def setUp(self):
+        os.environ['FLASK_ENV'] = 'test'
+        self.db_dir = tempfile.mkdtemp()
+        self.primary = os.path.join(self.db_dir, 'primary.db')
+        self.replica = os.path.join(self.db_dir, 'replica.db')
+
+        from app.query_budget import query_guard
+
+        query_guard.reset()
+
+    def tearDown(self):
+        from app.query_budget import query_guard
+
+        self.assertListEqual(query_guard.violations, [])
+        shutil.rmtree(self.db_dir)
+
+    def client(self, replica, **config):
+        from app import create_app
+
+        app = create_app(dict(config, SQLALCHEMY_DATABASE_URI='sqlite:///' + self.primary,
+                              SQLALCHEMY_BINDS={'replica0': 'sqlite:///' + replica}))
+        return app.test_client()
+
+    def test_replica_reads(self):
+        client = self.client(self.replica)
+        data = {'name': 'replicaexchange', 'currency_shortcut': 'REP'}
+        exchange_id = client.post('/api/v1/crypto/exchanges', json=data).json['id']
+        client.post(f'/api/v1/crypto/exchanges/{exchange_id}', json={'amount': 10})
+
+        # the replica gets the state of the primary by the replication, the later writes are not replayed yet
+        shutil.copy(self.primary, self.replica)
+        result = client.post(f'/api/v1/crypto/exchanges/{exchange_id}', json={'amount': 5})
+        self.assertEqual(result.status_code, 200)
+
+        currencies = f'/api/v1/crypto/exchanges/{exchange_id}/currencie'
+        self.assertEqual(client.get(currencies).json['currencies'][0]['total'], 10)
+        result = client.get(currencies, headers={'X-Read-Primary': '1'})
+        self.assertEqual(result.json['currencies'][0]['total'], 15)
 
+        # writes of the not replicated exchange go to the primary
+        data = [{'method': 'POST', 'currency': {'name': 'foo', 'shortcut': 'FOO', 'actual_rate': 1}}]
+        self.assertEqual(client.put(currencies, json=data).status_code, 200)
+        trade = {'amount': 1, 'currency_in': 'REP', 'currency_out': 'FOO'}
+        self.assertEqual(client.post(f'/api/v1/crypto/exchanges/{exchange_id}/trades', json=trade).status_code, 200)
+        self.assertEqual(client.get('/api/v1/crypto/history').json, [])
+        self.assertEqual(len(client.get('/api/v1/crypto/history', headers={'X-Read-Primary': 'true'}).json), 1)
+
+    def test_replica_fallback(self):
+        client = self.client(self.replica, REPLICA_MAX_LAG=-1)
+        client.post('/api/v1/crypto/exchanges', json={'name': 'lagging', 'currency_shortcut': 'LAG'})
+
+        # the lagging replica is not used, its reads go to the primary
+        self.assertEqual(len(client.get('/api/v1/crypto/exchanges').json['exchanges']), 1)
+
+        client = self.client(os.path.join(self.db_dir, 'missing', 'replica.db'))
+        result = client.get('/api/v1/crypto/exchanges')
+        self.assertEqual([exchange['name'] for exchange in result.json['exchanges']], ['lagging'])
+
+
+class AsgiTestCase(unittest.TestCase):
+    """
+    The async serving mode applies the same validation and business rules as the sync API
+    """
+
+    def setUp(self):
+        try:
+            from starlette.testclient import TestClient
+            from app.asgi import create_asgi_app
+        except ImportError as error:
+            self.skipTest(f'async requirements are not installed: {error}')
+
+        os.environ['FLASK_ENV'] = 'test'
+        self.db_dir = tempfile.mkdtemp()
+        db_path = 'sqlite:///' + os.path.join(self.db_dir, 'asgi.db')
+        self.client = TestClient(create_asgi_app({'SQLALCHEMY_DATABASE_URI': db_path}))
+        self.client.__enter__()
+
+    def tearDown(self):
+        self.client.__exit__(None, None, None)
+        shutil.rmtree(self.db_dir)
+
+    def test_async_api(self):
+        api = '/api/v1/crypto'
+        result = self.client.post(f'{api}/exchanges', json={'name': 'asyncexchange', 'currency_shortcut': 'ASY'})
+        self.assertEqual(result.status_code, 201)
+        exchange_id = result.json()['id']
+
+        result = self.client.post(f'{api}/exchanges', json={'name': 'asyncexchange', 'currency_shortcut': 'AS'})
+        self.assertEqual(result.status_code, 400)
+        result = self.client.post(f'{api}/exchanges', json={'name': 'asyncexchange'})
+        self.assertEqual(result.status_code, 400)
+        self.assertIn('currency_shortcut', result.json()['errors'])
+
+        self.assertEqual(self.client.post(f'{api}/exchanges/{exchange_id}', json={'amount': 100}).status_code, 200)
+        self.assertEqual(self.client.post(f'{api}/exchanges/33', json={'amount': 100}).status_code, 400)
+
+        data = [{'method': 'POST', 'currency': {'name': 'foo', 'shortcut': 'FOO', 'actual_rate': 2}}]
+        result = self.client.put(f'{api}/exchanges/{exchange_id}/currencie', json=data)
+        self.assertEqual([currency['shortcut'] for currency in result.json()], ['ASY', 'FOO'])
+
+        trade = {'amount': 10, 'currency_in': 'ASY', 'currency_out': 'FOO'}
+        self.assertEqual(self.client.post(f'{api}/exchanges/{exchange_id}/trades', json=trade).status_code, 200)
+        result = self.client.post(f'{api}/exchanges/{exchange_id}/trades', json=dict(trade, amount=1000))
+        self.assertEqual(result.status_code, 400)
+
+        result = self.client.post(f'{api}/exchanges/{exchange_id}/trades/batch', json=[trade, dict(trade, amount=1000)])
+        self.assertEqual((result.json()['executed'], result.json()['failed']), (1, 1))
+
+        result = self.client.put(f'{api}/exchanges/{exchange_id}/currencie', json=[])
+        totals = {currency['shortcut']: currency['total'] for currency in result.json()}
+        self.assertDictEqual(totals, {'ASY': 80, 'FOO': 40})
+
+        page = self.client.get(f'{api}/history', params={'cursor': '', 'limit': 1, 'search': 'fo'}).json()
+        self.assertEqual(len(page['trades']), 1)
+        page = self.client.get(f'{api}/history', params={'cursor': page['next_cursor'], 'limit': 1}).json()
+        self.assertEqual(len(page['trades']), 1)
+
+        result = self.client.get(f'{api}/history/analytics', params={'source': 'rollups'}).json()
+        self.assertEqual([(row['count'], row['volume']) for row in result], [(2, 20)])
+        self.assertEqual(self.client.get(f'{api}/history/analytics', params={'bucket': 'week'}).status_code, 400)
+
+    def test_async_routes(self):
+        from app.idempotency import response_cache
+
+        api = '/api/v1/crypto'
+        exchange_id = self.client.post(f'{api}/exchanges', json={'name': 'asyncroutes', 'currency_shortcut': 'ASR'}) \
+            .json()['id']
+        self.client.post(f'{api}/exchanges/{exchange_id}', json={'amount': 100})
+        data = [{'method': 'POST', 'currency': {'name': 'foo', 'shortcut': 'FOO', 'actual_rate': 2}}]
+        foo_id = self.client.put(f'{api}/exchanges/{exchange_id}/currencie', json=data).json()[1]['id']
+
+        # a retried trade with the same key is not executed again
+        trade = {'amount': 10, 'currency_in': 'ASR', 'currency_out': 'FOO'}
+        headers = {'Idempotency-Key': 'async-trade-1'}
+        first = self.client.post(f'{api}/exchanges/{exchange_id}/trades', json=trade, headers=headers)
+        response_cache.clear()  # the retry reads the stored key
+        retried = self.client.post(f'{api}/exchanges/{exchange_id}/trades', json=trade, headers=headers)
+        self.assertEqual((retried.status_code, retried.content), (first.status_code, first.content))
+        self.assertEqual(retried.headers['Idempotent-Replayed'], 'true')
+        result = self.client.post(f'{api}/exchanges/{exchange_id}/trades', json=dict(trade, amount=1), headers=headers)
         self.assertEqual(result.status_code, 400)
+        self.assertEqual(len(self.client.get(f'{api}/history').json()), 1)
+
+        result = self.client.put(f'{api}/exchanges/rates', json={'ids': [foo_id], 'rates': [3]})
+        self.assertEqual(result.json(), {'updated': 1})
+        self.assertEqual(self.client.put(f'{api}/exchanges/rates', json={'ids': [foo_id], 'rates': []}).status_code,
+                         400)
+        self.assertIn('max_size', self.client.get(f'{api}/exchanges/cache').json())
+
+        result = self.client.get(f'{api}/exchanges', params={'include': 'currency', 'fields': 'name'}).json()
+        self.assertEqual(result['exchanges'][0]['name'], 'asyncroutes')
+        self.assertEqual([currency['actual_rate'] for currency in result['exchanges'][0]['currency']], [1, 3])
+        self.assertEqual(self.client.get(f'{api}/exchanges', params={'limit': 0}).status_code, 400)
+
+        # the exchange data is revalidated by the ETag of its version
+        result = self.client.get(f'{api}/exchanges/{exchange_id}/currencie', params={'fields': 'shortcut,total'})
+        self.assertEqual([currency['total'] for currency in result.json()['currencies']], [90, 20])
+        etag = result.headers['ETag']
+        result = self.client.get(f'{api}/exchanges/{exchange_id}/currencie', params={'fields': 'shortcut,total'},
+                                 headers={'If-None-Match': etag})
+        self.assertEqual(result.status_code, 304)
+        self.client.post(f'{api}/exchanges/{exchange_id}', json={'amount': 1})
+        result = self.client.get(f'{api}/exchanges/{exchange_id}/currencie', headers={'If-None-Match': etag})
+        self.assertEqual(result.status_code, 200)
+
+        lines = self.client.get(f'{api}/history/export', params={'exchange_id': exchange_id}).text.splitlines()
+        self.assertEqual(json.loads(lines[0]), self.client.get(f'{api}/history').json()[0])
+        rows = list(csv.reader(io.StringIO(self.client.get(f'{api}/history/export', params={'format': 'csv'}).text)))
+        self.assertEqual([row[3:] for row in rows], [['amount', 'currency_in', 'currency_out'], ['10.0', 'ASR', 'FOO']])
+
+        self.assertEqual(len(self.client.get(f'{api}/history', params={'archived': 'true'}).json()), 1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,132 @@
+import logging
+import os
+import tempfile
+import time
+
+API = '/api/v1/crypto'
+
+
+def create_client(db_url=None):
+    """
+    Create the application and its test client on a fresh database
+
+    :param str db_url: database URL, default is a temporary SQLite file
+    :return: Flask test client
+    """
+    if not db_url:
+        db_url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ.setdefault('FLASK_ENV', 'test')
+    os.environ['DATABASE_URL'] = db_url
+
+    from app import create_app
+
+    app = create_app({'AUTO_CREATE_SCHEMA': True})
+    logging.disable(logging.INFO)  # benchmark the service, not the log handlers
+    return app.test_client()
+
+
+def check(response):
+    """
+    Return the response of the setup request, stop the benchmark when it failed
+    """
+    if not 200 <= response.status_code < 300:
+        raise SystemExit(f'Setup request failed with {response.status_code}: {response.get_data(as_text=True)}')
+    return response
+
+
+def failed(statuses):
+    """ Return number of the non-2xx status codes """
+    return sum(not 200 <= status < 300 for status in statuses)
+
+
+def exit_on_errors(errors):
+    """ Exit with non-zero status when any measured request failed, the numbers of such run are not valid """
+    if errors:
+        raise SystemExit(f'{errors} requests failed')
+
+
+def create_exchange(client, name='benchexchange', shortcuts=('FOO', 'BOO'), deposit=1e9):
+    """
+    Create exchange with crypto-currencies and deposit into its currency,
+    the deposit in the minor units of the default scale must fit into BIGINT
+
+    :return: exchange id
+    """
+    result = check(client.post(f'{API}/exchanges', json={'name': name, 'currency_shortcut': 'BEN'}))
+    exchange_id = result.json['id']
+    check(client.post(f'{API}/exchanges/{exchange_id}', json={'amount': deposit}))
+    data = [{'method': 'POST', 'currency': {'shortcut': shortcut, 'actual_rate': 1}} for shortcut in shortcuts]
+    check(client.put(f'{API}/exchanges/{exchange_id}/currencie', json=data))
+    return exchange_id
+
+
+def timed(func, *args, **kwargs):
+    """
+    Run the function and return its result with the elapsed time in seconds
+    """
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def report(name, count, elapsed, errors=0):
+    print(f'{name:<30} {count:>8} items {elapsed:>9.3f} s {count / elapsed:>12.1f} items/s {errors:>6} errors')
+
+
+def seed(app, exchanges=1, currencies=100, trades=1000, batch=10000, prefix='seed'):
+    """
+    Insert exchanges with their currencies and random trades directly into DB
+
+    :param app: Flask application
+    :param int exchanges: number of exchanges
+    :param int currencies: number of crypto-currencies per exchange
+    :param int trades: number of trades per exchange
+    :param str prefix: alphabetic prefix of the exchange names, unique within the seeds of one database
+    :return: list of exchange ids
+    """
+    import datetime
+    import random
+    import string
+
+    import app.db_model as db
+    from app.money import DEFAULT_SCALE, to_rate, to_units
+
+    def name(number):
+        letters = ''
+        for _ in range(4):
+            number, index = divmod(number, 26)
+            letters += string.ascii_lowercase[index]
+        return letters
+
+    exchange_ids = []
+    start = datetime.datetime.utcnow() - datetime.timedelta(days=30)
+    with app.app_context():
+        for number in range(exchanges):
+            exchange = db.Exchange(name=prefix + name(number))
+            db.save_changes(exchange)
+            exchange_ids.append(exchange.id)
+
+            total = to_units(1e9, DEFAULT_SCALE)
+            rows = [{'name': 'base', 'shortcut': 'BAS', 'actual_rate': to_rate(1), 'total': total, 'crypto': False,
+                     'exchange_id': exchange.id}]
+            rows += [{'name': name(i) + 'coin', 'shortcut': name(i)[:3].upper(),
+                      'actual_rate': to_rate(round(random.uniform(0.1, 10), 4)), 'total': total, 'crypto': True,
+                      'exchange_id': exchange.id} for i in range(1, currencies + 1)]
+            # shortcuts are unique within the exchange, so later duplicates are dropped
+            rows = list({row['shortcut']: row for row in reversed(rows)}.values())
+            db.db.session.execute(db.Currency.__table__.insert(), rows)
+            ids = [row.id for row in db.Currency.query.with_entities(db.Currency.id).filter_by(exchange_id=exchange.id)]
+
+            for offset in range(0, trades, batch):
+                rows = []
+                for i in range(offset, min(offset + batch, trades)):
+                    currency_in, currency_out = random.sample(ids, 2)
+                    rows.append({'exchange_id': exchange.id, 'amount': to_units(random.randint(1, 100), DEFAULT_SCALE),
+                                 'currency_in_id': currency_in, 'currency_out_id': currency_out,
+                                 'date': start + datetime.timedelta(seconds=i * 2592000 // max(trades, 1))})
+                db.db.session.execute(db.Trade.__table__.insert(), rows)
+            db.save_changes()
+        db.rebuild_rollups()
+        db.save_changes()
+
+    return exchange_ids
@@ -0,0 +1,79 @@
+"""
+Set-based ExchangeCurrencies.put against the former item by item handler
+
+    $ python -m benchmarks.currencies_put --items 10 100 1000
+"""
+import argparse
+import itertools
+import string
+
+from benchmarks.common import create_client, timed
+
+
+def legacy_put(db, exchange_id, data):
+    """ Former handler, one statement per item and the currencies re-read at the end """
+    from app.money import to_rate
+    from app.schemas import currencies_schema
+
+    db.Exchange.query.get(exchange_id)
+    for item in data:
+        method = item.get('method')
+        if method == 'POST':
+            currency = item['currency']
+            db.add_object(db.Currency(name=currency.get('name'), shortcut=currency['shortcut'].upper(),
+                                      actual_rate=to_rate(currency['actual_rate']), exchange_id=exchange_id,
+                                      crypto=True))
+        elif method == 'PUT':
+            currency = db.Currency.query.filter_by(id=item['currency']['id'], exchange_id=exchange_id,
+                                                   crypto=True).first()
+            currency.actual_rate = to_rate(item['currency']['actual_rate'])
+        elif method == 'DELETE':
+            db.Currency.query.filter_by(id=item['currency']['id'], exchange_id=exchange_id).delete()
+    db.save_changes()
+    return currencies_schema.dump(db.Currency.query.filter_by(exchange_id=exchange_id).all())
+
+
+def set_based_put(app, exchange_id, data):
+    from app.api1.crypto import ExchangeCurrencies
+
+    with app.test_request_context(json=data):
+        return ExchangeCurrencies().put(exchange_id)
+
+
+def change_set(db, exchange_id, items, shortcuts):
+    """ Half of the items create currencies, a quarter edits and a quarter deletes existing ones """
+    existing = [row.id for row in db.Currency.query.with_entities(db.Currency.id)
+                .filter_by(exchange_id=exchange_id, crypto=True)]
+    data = [{'method': 'POST', 'currency': {'shortcut': next(shortcuts), 'actual_rate': 1.5}}
+            for _ in range(items - items // 2)]
+    data += [{'method': 'PUT', 'currency': {'id': cur_id, 'actual_rate': 2.5}} for cur_id in existing[:items // 4]]
+    data += [{'method': 'DELETE', 'currency': {'id': cur_id}} for cur_id in existing[items // 4:items // 2]]
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--items', type=int, nargs='+', default=[10, 100, 1000], help='Items in the change set')
+    parser.add_argument('--db', help='Database URL, default is a temporary SQLite file')
+    args = parser.parse_args()
+
+    app = create_client(args.db).application
+    shortcuts = (''.join(letters) for letters in itertools.product(string.ascii_uppercase, repeat=3))
+
+    import app.db_model as db
+
+    with app.app_context():
+        for items in args.items:
+            for name, handler in (('legacy', lambda *a: legacy_put(db, *a)),
+                                  ('set-based', lambda *a: set_based_put(app, *a))):
+                exchange = db.Exchange(name=name.replace('-', '') + string.ascii_lowercase[len(str(items))])
+                db.save_changes(exchange)
+                for _ in range(2):
+                    # the first change set fills the exchange, the second is measured
+                    data = change_set(db, exchange.id, items, shortcuts)
+                    _, elapsed = timed(handler, exchange.id, data)
+                print(f'{name:<10} {items:>6} items {elapsed * 1000:>10.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+Peak memory of the history page against the streaming history export
+
+    $ python -m benchmarks.history_export --trades 20000
+"""
+import argparse
+import tracemalloc
+
+from benchmarks.common import API, check, create_client, create_exchange, timed
+
+
+def seed(client, exchange_id, trades, size=1000):
+    for start in range(0, trades, size):
+        data = [{'amount': 1, 'currency_in': 'BEN', 'currency_out': 'FOO'}] * min(size, trades - start)
+        response = check(client.post(f'{API}/exchanges/{exchange_id}/trades/batch', json=data))
+        if response.json['failed']:
+            raise SystemExit(f'{response.json["failed"]} seeded trades failed: {response.json["results"][0]}')
+
+
+def history(client):
+    return len(check(client.get(f'{API}/history')).data)
+
+
+def export(client, export_format):
+    response = check(client.get(f'{API}/history/export?format={export_format}'))
+    return sum(len(chunk) for chunk in response.response)
+
+
+def measure(name, func, *args):
+    tracemalloc.start()
+    size, elapsed = timed(func, *args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{name:<20} {size / 2**20:>8.1f} MiB sent {elapsed:>8.2f} s {peak / 2**20:>8.1f} MiB peak')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--trades', type=int, default=20000, help='Number of trades in the history')
+    parser.add_argument('--db', help='Database URL, default is a temporary SQLite file')
+    args = parser.parse_args()
+
+    client = create_client(args.db)
+    seed(client, create_exchange(client), args.trades)
+
+    measure('history', history, client)
+    measure('export ndjson', export, client, 'ndjson')
+    measure('export csv', export, client, 'csv')
+
+
+if __name__ == '__main__':
+    main()
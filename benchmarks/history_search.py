@@ -0,0 +1,50 @@
+"""
+History search with the single indexed query against the former two-query search,
+both match the currencies by the same rules of db.search_currencies
+
+    $ python -m benchmarks.history_search --currencies 10000 --trades 1000000
+"""
+import argparse
+
+from benchmarks.common import create_client, seed, timed
+
+
+def two_queries(db, text, limit):
+    """ Currency ids loaded first and sent back in the trade query """
+    currencies = [row.id for row in db.db.session.query(db.search_currencies(text)).all()]
+    query = db.Trade.query.filter(db.Trade.currency_in_id.in_(currencies) | db.Trade.currency_out_id.in_(currencies))
+    return query.limit(limit).all()
+
+
+def one_query(db, text, limit):
+    query = db.Trade.query.filter(db.match_currencies(db.Trade.currency_in_id, text) |
+                                  db.match_currencies(db.Trade.currency_out_id, text))
+    return query.limit(limit).all()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--currencies', type=int, default=10000, help='Number of currencies')
+    parser.add_argument('--trades', type=int, default=1000000, help='Number of trades')
+    parser.add_argument('--limit', type=int, default=100, help='History page size')
+    parser.add_argument('--queries', nargs='+', default=['aa', 'kc', 'zzz', 'ab'], help='Search queries')
+    parser.add_argument('--db', help='Database URL, default is a temporary SQLite file')
+    args = parser.parse_args()
+
+    app = create_client(args.db).application
+    seed(app, currencies=args.currencies, trades=args.trades)
+
+    import app.db_model as db
+
+    with app.app_context():
+        for text in args.queries:
+            old, old_elapsed = timed(two_queries, db, text, args.limit)
+            new, new_elapsed = timed(one_query, db, text, args.limit)
+            if len(old) != len(new):
+                raise SystemExit(f'Searches of {text!r} differ, {len(old)} and {len(new)} trades')
+            print(f'{text!r:<8} two queries {len(old):>5} trades {old_elapsed * 1000:>9.1f} ms'
+                  f'   one query {len(new):>5} trades {new_elapsed * 1000:>9.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+"""
+Requests/sec and latency of the sync (gunicorn) and the async (uvicorn) deployment under concurrent clients
+
+Both servers are started on a copy of the same seeded database, every client keeps sending requests
+on its own connection, reconnecting when the server closes it (gunicorn sync workers do not keep alive).
+
+    $ pip install -r requirements-async.txt
+    $ python -m benchmarks.load_test --clients 100 --requests 20 --scenario mixed
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.common import API, create_client, create_exchange, exit_on_errors, seed
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HOST = '0.0.0.0:5000'  # SERVER_NAME of the production config, Flask routes only requests of this host
+
+
+def server_command(server, port, workers):
+    if server == 'sync':
+        return [sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{port}',
+                '--workers', str(workers), 'wsgi:app']
+    return [sys.executable, '-m', 'uvicorn', '--host', '127.0.0.1', '--port', str(port), '--workers', str(workers),
+            '--no-access-log', 'asgi:app']
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'Server did not start on port {port}')
+
+
+def scenario_requests(scenario, exchange_id, count):
+    """
+    Return list of (method, path, body) of one client
+    """
+    trade = json.dumps({'amount': 1, 'currency_in': 'BEN', 'currency_out': 'FOO'}).encode()
+    trade_request = ('POST', f'{API}/exchanges/{exchange_id}/trades', trade)
+    history_request = ('GET', f'{API}/history?cursor=&limit=100&exchange_id={exchange_id}', b'')
+    if scenario == 'trades':
+        return [trade_request] * count
+    if scenario == 'history':
+        return [history_request] * count
+    return [(trade_request, history_request)[i % 2] for i in range(count)]
+
+
+async def send(connection, port, method, path, body):
+    """
+    Send one HTTP/1.1 request and read the response
+
+    :return: connection to reuse or None when the server closed it, and the status code
+    """
+    if connection is None:
+        connection = await asyncio.open_connection('127.0.0.1', port)
+    reader, writer = connection
+    writer.write(f'{method} {path} HTTP/1.1\r\nHost: {HOST}\r\nContent-Type: application/json\r\n'
+                 f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+    await writer.drain()
+
+    status_line = await reader.readline()
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode().partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if headers.get('transfer-encoding', '').lower() == 'chunked':  # streamed responses
+        size = int(await reader.readline(), 16)
+        while size:
+            await reader.readexactly(size + 2)
+            size = int(await reader.readline(), 16)
+        await reader.readline()
+    else:
+        await reader.readexactly(int(headers.get('content-length', 0)))
+
+    if headers.get('connection', '').lower() == 'close':
+        writer.close()
+        connection = None
+    return connection, int(status_line.split()[1])
+
+
+async def run_client(port, requests, latencies, errors):
+    connection = None
+    for method, path, body in requests:
+        start = time.perf_counter()
+        try:
+            connection, status = await send(connection, port, method, path, body)
+        except (OSError, asyncio.IncompleteReadError, IndexError, ValueError):
+            connection, status = None, 0
+        latencies.append(time.perf_counter() - start)
+        if not 200 <= status < 300:
+            errors.append(status)
+    if connection:
+        connection[1].close()
+
+
+async def load(port, clients, requests):
+    latencies = []
+    errors = []
+    start = time.perf_counter()
+    await asyncio.gather(*(run_client(port, requests, latencies, errors) for _ in range(clients)))
+    return latencies, errors, time.perf_counter() - start
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(server, db_file, args, exchange_id):
+    """ Run the load on the server and return number of the failed requests """
+    port = free_port()
+    env = dict(os.environ, FLASK_ENV='prod', DATABASE_URL=f'sqlite:///{db_file}')
+    if args.db:
+        env['DATABASE_URL'] = args.db
+    process = subprocess.Popen(server_command(server, port, args.workers), cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        requests = scenario_requests(args.scenario, exchange_id, args.requests)
+        latencies, errors, elapsed = asyncio.get_event_loop().run_until_complete(load(port, args.clients, requests))
+    finally:
+        process.terminate()
+        process.wait()
+
+    print(f'{server:<6} {len(latencies):>8} requests {len(errors):>6} errors {len(latencies) / elapsed:>9.1f} req/s '
+          f'p50 {percentile(latencies, 0.5) * 1000:>8.1f} ms p99 {percentile(latencies, 0.99) * 1000:>8.1f} ms')
+    return len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', type=int, default=100, help='Concurrent clients')
+    parser.add_argument('--requests', type=int, default=20, help='Requests of every client')
+    parser.add_argument('--scenario', choices=('trades', 'history', 'mixed'), default='mixed')
+    parser.add_argument('--workers', type=int, default=4, help='Worker processes of both servers')
+    parser.add_argument('--servers', nargs='+', choices=('sync', 'async'), default=['sync', 'async'])
+    parser.add_argument('--trades', type=int, default=10000, help='Seeded trades in the history')
+    parser.add_argument('--db', help='Database URL shared by both servers, default is a copy of a SQLite file')
+    args = parser.parse_args()
+
+    db_dir = tempfile.mkdtemp()
+    seed_file = os.path.join(db_dir, 'seed.db')
+    app_client = create_client(args.db or f'sqlite:///{seed_file}')
+    exchange_id = create_exchange(app_client, name='load')
+    seed(app_client.application, trades=args.trades)
+
+    errors = 0
+    try:
+        for server in args.servers:
+            db_file = os.path.join(db_dir, f'{server}.db')
+            if not args.db:
+                shutil.copy(seed_file, db_file)
+            errors += run(server, db_file, args, exchange_id)
+    finally:
+        shutil.rmtree(db_dir)
+    exit_on_errors(errors)
+
+
+if __name__ == '__main__':
+    main()
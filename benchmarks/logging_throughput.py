@@ -0,0 +1,73 @@
+"""
+Trade throughput with the log handlers on the request thread and on the queue listener thread
+
+The log records are written by the handlers of the environment log config, run it with the stderr dropped.
+A handler blocking for the given milliseconds per record stands for a slow disk or a full stdout pipe:
+
+    $ FLASK_ENV=prod python -m benchmarks.logging_throughput --trades 2000 --handler-delay 0.2 2>/dev/null
+"""
+import argparse
+import copy
+import logging
+import os
+import tempfile
+import time
+
+from benchmarks.common import API, create_exchange, exit_on_errors, failed, report, timed
+
+
+class SlowHandler(logging.Handler):
+    def __init__(self, delay):
+        super().__init__()
+        self.delay = delay
+
+    def emit(self, record):
+        self.format(record)
+        time.sleep(self.delay)
+
+
+def trades(client, exchange_id, count):
+    """ Return number of the failed trades """
+    trade = {'amount': 1, 'currency_in': 'BEN', 'currency_out': 'FOO'}
+    return failed([client.post(f'{API}/exchanges/{exchange_id}/trades', json=trade).status_code
+                   for _ in range(count)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--trades', type=int, default=2000, help='Number of trades per run')
+    parser.add_argument('--handler-delay', type=float, default=0, help='Milliseconds of the I/O of one record')
+    args = parser.parse_args()
+
+    db_dir = tempfile.mkdtemp()
+    os.environ.setdefault('FLASK_ENV', 'prod')
+    os.environ.setdefault('DATABASE_URL', f'sqlite:///{db_dir}/default.db')
+
+    from app import create_app
+    from app.logs import stop_listener
+    from config import config_by_env
+
+    log_config = copy.deepcopy(config_by_env.LOG_CONFIG)
+    if args.handler_delay:
+        log_config['handlers']['slow'] = {'()': SlowHandler, 'delay': args.handler_delay / 1000}
+        log_config['loggers']['']['handlers'].append('slow')
+
+    errors = 0
+    for use_queue in (True, False):
+        name = 'queue' if use_queue else 'sync'
+        app = create_app({'LOG_QUEUE': use_queue, 'LOG_CONFIG': log_config, 'AUTO_CREATE_SCHEMA': True,
+                          'SQLALCHEMY_DATABASE_URI': f'sqlite:///{db_dir}/{name}.db'})
+        client = app.test_client()
+        exchange_id = create_exchange(client, name=name)
+
+        run_errors, elapsed = timed(trades, client, exchange_id, args.trades)
+        report(f'{name} log handlers', args.trades, elapsed, run_errors)
+        errors += run_errors
+        if use_queue:
+            _, elapsed = timed(stop_listener)
+            report('queue drained after the run', args.trades, elapsed)
+    exit_on_errors(errors)
+
+
+if __name__ == '__main__':
+    main()
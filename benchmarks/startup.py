@@ -0,0 +1,63 @@
+"""
+Startup time of one worker: import of the app package and create_app, with and without the schema creation
+
+Every run is a new interpreter, like a booted worker without the preload:
+
+    $ python -m benchmarks.startup --runs 10
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from benchmarks.load_test import ROOT
+
+STARTUP = """
+import json, time
+start = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+create_app()
+created = time.perf_counter()
+print(json.dumps({"import": imported - start, "create_app": created - imported}))
+"""
+
+
+def startup(env):
+    """
+    Return dict of the import and create_app seconds measured in a new interpreter
+
+    :param dict env: environment of the interpreter
+    """
+    output = subprocess.run([sys.executable, '-c', STARTUP], cwd=ROOT, env=env, check=True,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+    return json.loads(output.decode().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10, help='Interpreters started per mode')
+    parser.add_argument('--db', help='Database URL, default is a temporary SQLite file')
+    args = parser.parse_args()
+
+    db_dir = tempfile.mkdtemp()
+    try:
+        env = dict(os.environ, FLASK_ENV='prod', PYTHONPATH=ROOT,
+                   DATABASE_URL=args.db or f'sqlite:///{os.path.join(db_dir, "startup.db")}')
+        for create_schema in ('1', '0'):
+            runs = [startup(dict(env, AUTO_CREATE_SCHEMA=create_schema)) for _ in range(args.runs)]
+            imported = statistics.median(run['import'] for run in runs) * 1000
+            created = statistics.median(run['create_app'] for run in runs) * 1000
+            mode = 'with create_all' if create_schema == '1' else 'without create_all'
+            print(f'{mode:<19} import {imported:>7.1f} ms create_app {created:>7.1f} ms '
+                  f'total {imported + created:>7.1f} ms (median of {args.runs})')
+    finally:
+        shutil.rmtree(db_dir)
+
+
+if __name__ == '__main__':
+    main()
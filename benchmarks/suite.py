@@ -0,0 +1,251 @@
+"""
+Benchmark of every API endpoint on a seeded dataset, through the Flask test client and a gunicorn process
+
+Throughput, latency percentiles and SQL statements per request (test client only) are written into a JSON
+baseline, the compare mode fails when an endpoint is slower or executes more statements than the baseline:
+
+    $ python -m benchmarks.suite --exchanges 2 --currencies 100 --trades 100000 --output baseline.json
+    $ python -m benchmarks.suite --exchanges 2 --currencies 100 --trades 100000 --compare baseline.json
+
+The dataset is seeded into a temporary SQLite file, or into the database of --db (e.g. Postgres). The names of
+the seeded and created exchanges start with the letters of the run time, so the runs can share one database.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.common import API, create_client, seed
+from benchmarks.load_test import ROOT, free_port, percentile, run_client, wait_for_port
+
+
+def letters(number, length=6):
+    """ Return alphabetic name of the number, exchange and currency names must be alphabetic """
+    name = ''
+    for _ in range(length):
+        number, index = divmod(number, 26)
+        name += chr(ord('a') + index)
+    return name
+
+
+def dataset(app, exchange_id):
+    """
+    Return (base shortcut, crypto shortcuts, crypto ids) of the seeded exchange
+    """
+    import app.db_model as db
+
+    with app.app_context():
+        currencies = db.Currency.query.filter_by(exchange_id=exchange_id).order_by(db.Currency.id).all()
+        base = next(currency.shortcut for currency in currencies if not currency.crypto)
+        crypto = [currency for currency in currencies if currency.crypto]
+        return base, [currency.shortcut for currency in crypto], [currency.id for currency in crypto]
+
+
+def endpoint_requests(run, exchange_id, base, shortcuts, ids, count):
+    """
+    Return requests of every endpoint, dict of endpoint name -> list of (method, path, JSON body bytes)
+
+    :param str run: alphabetic name of the run, the created exchanges are unique within the runs on one database
+    """
+    def body(obj):
+        return json.dumps(obj).encode()
+
+    exchange = f'{API}/exchanges/{exchange_id}'
+    trade = {'amount': 1, 'currency_in': base, 'currency_out': shortcuts[0]}
+    return {
+        'POST /exchanges': [('POST', f'{API}/exchanges',
+                             body({'name': run + letters(i), 'currency_shortcut': 'BEN'})) for i in range(count)],
+        'PUT /exchanges/rates': [('PUT', f'{API}/exchanges/rates',
+                                  body({'ids': ids[:10], 'rates': [1 + i / count] * len(ids[:10])}))
+                                 for i in range(count)],
+        'GET /exchanges?include': [('GET', f'{API}/exchanges?include=currency', b'')] * count,
+        'GET /exchanges/cache': [('GET', f'{API}/exchanges/cache', b'')] * count,
+        'POST /exchanges/<id>': [('POST', exchange, body({'amount': 1}))] * count,
+        'PUT /exchanges/<id>/currencie': [('PUT', f'{exchange}/currencie',
+                                           body([{'method': 'PUT', 'currency': {'id': ids[i % len(ids)],
+                                                                                'actual_rate': 1 + i / count}}]))
+                                          for i in range(count)],
+        'GET /exchanges/<id>/currencie': [('GET', f'{exchange}/currencie', b'')] * count,
+        'POST /exchanges/<id>/trades': [('POST', f'{exchange}/trades', body(trade))] * count,
+        'POST /exchanges/<id>/trades/batch': [('POST', f'{exchange}/trades/batch', body([trade] * 10))] * count,
+        'GET /history': [('GET', f'{API}/history?cursor=&limit=100&exchange_id={exchange_id}', b'')] * count,
+        'GET /history?search': [('GET', f'{API}/history?cursor=&limit=100&search={shortcuts[-1][:2]}', b'')] * count,
+        'GET /history/export': [('GET', f'{API}/history/export?exchange_id={exchange_id}&format=csv', b'')]
+        * max(1, count // 10),
+        'GET /history/analytics': [('GET', f'{API}/history/analytics?bucket=day&exchange_id={exchange_id}', b'')]
+        * count,
+    }
+
+
+def summary(latencies, errors, elapsed, queries=None):
+    result = {"requests": len(latencies), "errors": errors, "rps": round(len(latencies) / elapsed, 1),
+              "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+              "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+              "p99_ms": round(percentile(latencies, 0.99) * 1000, 2)}
+    if queries is not None:
+        result['queries'] = round(queries / len(latencies), 2)
+    return result
+
+
+def run_test_client(client, requests):
+    """
+    Run the requests of every endpoint one by one through the Flask test client
+    """
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    statements = [0]
+
+    def count(*args):
+        statements[0] += 1
+
+    event.listen(Engine, 'before_cursor_execute', count)
+    results = {}
+    try:
+        for name, endpoint_requests_ in requests.items():
+            latencies = []
+            errors = 0
+            statements[0] = 0
+            start = time.perf_counter()
+            for method, path, body in endpoint_requests_:
+                request_start = time.perf_counter()
+                response = client.open(path, method=method, data=body, content_type='application/json')
+                response.get_data()  # streamed responses are consumed
+                latencies.append(time.perf_counter() - request_start)
+                errors += response.status_code >= 400
+            results[name] = summary(latencies, errors, time.perf_counter() - start, statements[0])
+    finally:
+        event.remove(Engine, 'before_cursor_execute', count)
+    return results
+
+
+async def concurrent(port, shares):
+    latencies = []
+    errors = []
+    start = time.perf_counter()
+    await asyncio.gather(*(run_client(port, share, latencies, errors) for share in shares if share))
+    return latencies, errors, time.perf_counter() - start
+
+
+def run_gunicorn(db_url, requests, workers, clients):
+    """
+    Run the requests of every endpoint through a gunicorn process by the concurrent clients
+    """
+    port = free_port()
+    env = dict(os.environ, FLASK_ENV='prod', DATABASE_URL=db_url)
+    process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py',
+                                '--bind', f'127.0.0.1:{port}', '--workers', str(workers), 'wsgi:app'],
+                               cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    results = {}
+    try:
+        wait_for_port(port)
+        loop = asyncio.get_event_loop()
+        for name, endpoint_requests_ in requests.items():
+            # every client sends its share of the requests of the endpoint
+            shares = [endpoint_requests_[i::clients] for i in range(clients)]
+            latencies, errors, elapsed = loop.run_until_complete(concurrent(port, shares))
+            results[name] = summary(latencies, len(errors), elapsed)
+    finally:
+        process.terminate()
+        process.wait()
+    return results
+
+
+def compare(baseline, results, threshold):
+    """
+    Return regressions of the results against the baseline
+
+    :param dict baseline: results of the baseline run
+    :param dict results: results of this run
+    :param float threshold: allowed relative regression of the throughput and the p99 latency
+    """
+    regressions = []
+    for mode, endpoints in baseline.items():
+        for name, base in endpoints.items():
+            result = results.get(mode, {}).get(name)
+            if result is None:
+                continue
+            if result['rps'] < base['rps'] * (1 - threshold):
+                regressions.append(f'{mode} {name}: {result["rps"]} req/s, baseline {base["rps"]} req/s')
+            if result['p99_ms'] > base['p99_ms'] * (1 + threshold):
+                regressions.append(f'{mode} {name}: p99 {result["p99_ms"]} ms, baseline {base["p99_ms"]} ms')
+            if result.get('queries', 0) > base.get('queries', 0):
+                regressions.append(f'{mode} {name}: {result["queries"]} queries, baseline {base["queries"]}')
+            if result['errors'] > base['errors']:
+                regressions.append(f'{mode} {name}: {result["errors"]} errors, baseline {base["errors"]}')
+    return regressions
+
+
+def print_results(results):
+    for mode, endpoints in results.items():
+        for name, result in endpoints.items():
+            print(f'{mode:<9} {name:<35} {result["rps"]:>9.1f} req/s p50 {result["p50_ms"]:>8.2f} ms '
+                  f'p99 {result["p99_ms"]:>8.2f} ms {result.get("queries", ""):>6} queries {result["errors"]} errors')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--exchanges', type=int, default=1, help='Seeded exchanges')
+    parser.add_argument('--currencies', type=int, default=100, help='Seeded crypto-currencies per exchange')
+    parser.add_argument('--trades', type=int, default=10000, help='Seeded trades per exchange')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per endpoint')
+    parser.add_argument('--modes', nargs='+', choices=('client', 'gunicorn'), default=['client', 'gunicorn'])
+    parser.add_argument('--workers', type=int, default=2, help='Gunicorn workers')
+    parser.add_argument('--clients', type=int, default=10, help='Concurrent clients of gunicorn')
+    parser.add_argument('--db', help='Database URL, default is a temporary SQLite file')
+    parser.add_argument('--output', help='Write the results into the JSON baseline file')
+    parser.add_argument('--compare', help='Compare the results with the JSON baseline file')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Allowed relative regression')
+    args = parser.parse_args()
+
+    db_dir = tempfile.mkdtemp()
+    seed_file = os.path.join(db_dir, 'seed.db')
+    db_url = args.db or f'sqlite:///{seed_file}'
+    run = letters(int(time.time() * 10), length=7)
+    client = create_client(db_url)
+    exchange_ids = seed(client.application, exchanges=args.exchanges, currencies=args.currencies,
+                        trades=args.trades, prefix='seed' + run)
+    base, shortcuts, ids = dataset(client.application, exchange_ids[0])
+
+    results = {}
+    try:
+        for mode in args.modes:
+            requests = endpoint_requests(run + mode, exchange_ids[0], base, shortcuts, ids, args.requests)
+            if mode == 'client':
+                results[mode] = run_test_client(client, requests)
+            else:
+                if not args.db:  # every mode starts on the same seeded data
+                    db_url = f'sqlite:///{os.path.join(db_dir, mode + ".db")}'
+                    shutil.copy(seed_file, db_url[len('sqlite:///'):])
+                results[mode] = run_gunicorn(db_url, requests, args.workers, args.clients)
+    finally:
+        shutil.rmtree(db_dir)
+
+    print_results(results)
+    report = {"dataset": {"exchanges": args.exchanges, "currencies": args.currencies, "trades": args.trades,
+                          "requests": args.requests, "db": db_url.split(':', 1)[0]},
+              "python": platform.python_version(), "results": results}
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            baseline = json.load(baseline)
+        if baseline['dataset'] != report['dataset']:
+            print(f'Dataset differs from the baseline: {baseline["dataset"]}', file=sys.stderr)
+        regressions = compare(baseline['results'], results, args.threshold)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""
+Throughput of the single-trade path against the batch trade endpoint
+
+    $ python -m benchmarks.trade_batch --trades 2000 --batch 200
+"""
+import argparse
+
+from benchmarks.common import API, create_client, create_exchange, exit_on_errors, failed, report, timed
+
+
+def single(client, exchange_id, trades):
+    """ Return number of the failed trades """
+    return failed([client.post(f'{API}/exchanges/{exchange_id}/trades', json=trade).status_code for trade in trades])
+
+
+def batch(client, exchange_id, trades, size):
+    """ Return number of the failed trades, the batch responds 200 also with the failed items """
+    errors = 0
+    for start in range(0, len(trades), size):
+        response = client.post(f'{API}/exchanges/{exchange_id}/trades/batch', json=trades[start:start + size])
+        errors += response.json['failed'] if response.status_code == 200 else len(trades[start:start + size])
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--trades', type=int, default=2000, help='Number of trades per run')
+    parser.add_argument('--batch', type=int, default=200, help='Trades in one batch request')
+    parser.add_argument('--db', help='Database URL, default is a temporary SQLite file')
+    args = parser.parse_args()
+
+    client = create_client(args.db)
+    trades = [{'amount': 1, 'currency_in': 'BEN', 'currency_out': ('FOO', 'BOO')[i % 2]} for i in range(args.trades)]
+
+    exchange_id = create_exchange(client, name='single')
+    single_errors, elapsed = timed(single, client, exchange_id, trades)
+    report('single trade', args.trades, elapsed, single_errors)
+
+    exchange_id = create_exchange(client, name='batch')
+    batch_errors, elapsed = timed(batch, client, exchange_id, trades, args.batch)
+    report(f'batch of {args.batch}', args.trades, elapsed, batch_errors)
+    exit_on_errors(single_errors + batch_errors)
+
+
+if __name__ == '__main__':
+    main()
@@ -76,19 +76,56 @@ class Config(object):
     RESTPLUS_MASK_SWAGGER = False
     SQLALCHEMY_ECHO = False
     SQLALCHEMY_TRACK_MODIFICATIONS = True
+    RATE_CACHE_SIZE = int(os.environ.get('RATE_CACHE_SIZE', 10000))
+    RATE_CACHE_TTL = float(os.environ.get('RATE_CACHE_TTL', 5))  # seconds, bounds staleness between workers
+    LEDGER_MODE = os.environ.get('LEDGER_MODE', '0') == '1'  # balances by the appended ledger entries
+    IDEMPOTENCY_TTL = float(os.environ.get('IDEMPOTENCY_TTL', 86400))  # seconds, retries are accepted within it
+    IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', 10000))  # stored responses per worker
+    HTTP_CACHE_SIZE = int(os.environ.get('HTTP_CACHE_SIZE', 1000))  # cached read responses per worker
+    HTTP_CACHE_VERSION_TTL = float(os.environ.get('HTTP_CACHE_VERSION_TTL', 1))  # seconds, staleness between workers
+    LOG_QUEUE = os.environ.get('LOG_QUEUE', '1') == '1'  # log handlers run on a background thread
+    QUERY_GUARD = False  # test mode check of the query budgets of the endpoints
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+    ASYNC_DATABASE_URL = os.environ.get('ASYNC_DATABASE_URL')  # database of the ASGI app, default is the same DB
+    AUTO_CREATE_SCHEMA = os.environ.get('AUTO_CREATE_SCHEMA', '1') == '1'  # create the tables on create_app
+    # read only endpoints are served by the replicas of the primary DB, comma separated URLs
+    SQLALCHEMY_BINDS = {f'replica{index}': url for index, url in
+                        enumerate(filter(None, os.environ.get('DATABASE_REPLICA_URLS', '').split(',')))}
+    REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 5))  # seconds, reads of a lagging replica go to primary
+    REPLICA_CHECK_INTERVAL = float(os.environ.get('REPLICA_CHECK_INTERVAL', 1))  # seconds between the lag checks
+    TRADE_ARCHIVE_DIR = os.environ.get('TRADE_ARCHIVE_DIR', '/var/lib/backend/archive')  # archived trade months
+    TRADE_HOT_MONTHS = int(os.environ.get('TRADE_HOT_MONTHS', 12))  # months kept in the trade table by the archival
 
 
 class ProductionConfig(Config):
     SERVER_NAME = "0.0.0.0:5000"
     LOG_CONFIG = info_log_config
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL')
+    # the schema is created by the `flask init-db` deployment step, not by every booted worker
+    AUTO_CREATE_SCHEMA = os.environ.get('AUTO_CREATE_SCHEMA', '0') == '1'
+    # every gunicorn worker has its own pool: workers * (pool_size + max_overflow) must fit max_connections of DB
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 5)),
+        'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 5)),  # seconds, fail fast on exhausted pool
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),  # seconds, before DB or proxy idle timeouts
+        'pool_pre_ping': True
+    }
 
 
 class TestingConfig(Config):
     TESTING = True
+    QUERY_GUARD = True
     SERVER_NAME = "0.0.0.0:5050"
     LOG_CONFIG = debug_log_config
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL')
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': 5,
+        'max_overflow': 10,  # concurrent test clients
+        'pool_timeout': 10,
+        'pool_recycle': 3600,
+        'pool_pre_ping': True
+    }
 
 
 class DevelopmentConfig(Config):
@@ -96,6 +133,13 @@ class DevelopmentConfig(Config):
     SERVER_NAME = "0.0.0.0:5001"
     LOG_CONFIG = debug_log_config
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', "sqlite:///")
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': 2,
+        'max_overflow': 3,
+        'pool_timeout': 30,
+        'pool_recycle': 3600,
+        'pool_pre_ping': True
+    }
 
 
 config_by_env = {
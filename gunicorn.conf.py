@@ -0,0 +1,31 @@
+"""
+Gunicorn settings of the production server
+
+    $ FLASK_APP=wsgi.py flask init-db
+    $ gunicorn --config gunicorn.conf.py wsgi:app
+
+The application is built once in the master and the workers are forked with it, they share the imported
+modules and do not repeat the startup. The schema is created by the init-db step before.
+"""
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('GUNICORN_WORKERS', 1))
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+
+def when_ready(server):
+    if not server.cfg.preload_app:
+        return
+    from app.logs import stop_listener
+
+    # forked worker gets a copy of the queue without the listener thread, the master writes its records directly
+    stop_listener(restore=True)
+
+
+def post_fork(server, worker):
+    if not server.cfg.preload_app:
+        return
+    from app import init_worker
+
+    init_worker(server.app.wsgi())